@@ -1,6 +1,7 @@
 import imaplib
 import os
 import email
+import email.utils
 from email.header import decode_header
 import datetime
 import shutil
@@ -10,18 +11,33 @@ import time
 import re
 import csv
 import sys
-from io import BytesIO
+import traceback
+import json
+import multiprocessing
+import multiprocessing.util
+import threading
+import queue
+import itertools
+import binascii
+import hashlib
+import uuid
+import sqlite3
+import importlib.util
+import socket
+import select
+import argparse
+import tempfile
+import zlib
+import html
+import mimetypes
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO, StringIO
 from dotenv import load_dotenv
 
-# --- Библиотеки для генерации PDF и работы с файлами ---
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import mm
-from reportlab.platypus import Paragraph, Image
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from bs4 import BeautifulSoup
+# Библиотеки для генерации PDF и работы с файлами (reportlab, pypdf, BeautifulSoup, lxml, pywin32, uno)
+# импортируются в функциях, которые их используют: запуск, проверка почты и поиск по журналу
+# обходятся без них, а загружаются они при создании PDF первого письма.
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -31,6 +47,87 @@ IMAP_SERVER = os.getenv('IMAP_SERVER')
 MAIL_RU_EMAIL = os.getenv('MAIL_RU_EMAIL')
 MAIL_RU_PASSWORD = os.getenv('MAIL_RU_PASSWORD')
 
+# --- Параметры скачивания ---
+# Папка почтового ящика, из которой скачиваются письма
+IMAP_MAILBOX = os.getenv('IMAP_MAILBOX', 'inbox')
+# 'checkpoint' - скачивать только письма новее последнего обработанного UID, 'unseen' - все непрочитанные
+IMAP_SYNC_MODE = os.getenv('IMAP_SYNC_MODE', 'checkpoint')
+# 'batch' - пакетная загрузка по UID с конвейером команд, 'single' - по одному письму (старый режим)
+IMAP_FETCH_MODE = os.getenv('IMAP_FETCH_MODE', 'batch')
+# Сколько писем запрашивать одной командой UID FETCH
+IMAP_FETCH_BATCH_SIZE = int(os.getenv('IMAP_FETCH_BATCH_SIZE', '50'))
+# ...но не больше стольких байт (по RFC822.SIZE) в одной команде
+IMAP_FETCH_BATCH_BYTES = int(os.getenv('IMAP_FETCH_BATCH_BYTES', str(16 * 1024 * 1024)))
+# Сколько команд UID FETCH одновременно отправлено на сервер без ожидания ответа
+# (в памяти не больше IMAP_PIPELINE_DEPTH * IMAP_FETCH_BATCH_BYTES скачанных писем)
+IMAP_PIPELINE_DEPTH = int(os.getenv('IMAP_PIPELINE_DEPTH', '4'))
+# Письма больше этого размера (в байтах) скачиваются по частям прямо в файл, минуя память
+IMAP_LARGE_MESSAGE_BYTES = int(os.getenv('IMAP_LARGE_MESSAGE_BYTES', str(20 * 1024 * 1024)))
+# Размер одной части при скачивании большого письма
+IMAP_STREAM_CHUNK_BYTES = int(os.getenv('IMAP_STREAM_CHUNK_BYTES', str(1024 * 1024)))
+# Несколько ящиков (файл MAIL_ACCOUNTS_FILE): не больше стольких соединений IMAP одновременно
+IMAP_MAX_CONNECTIONS = int(os.getenv('IMAP_MAX_CONNECTIONS', '8'))
+# ...из них не больше стольких к одному серверу (ограничение почтовых серверов)
+IMAP_MAX_CONNECTIONS_PER_SERVER = int(os.getenv('IMAP_MAX_CONNECTIONS_PER_SERVER', '4'))
+# ...и не больше стольких для одной учетной записи (папки учетной записи делят эти соединения)
+IMAP_CONNECTIONS_PER_ACCOUNT = int(os.getenv('IMAP_CONNECTIONS_PER_ACCOUNT', '2'))
+# Режим службы (--daemon): сколько держать команду IDLE до ее перезапуска (сек.)
+DAEMON_IDLE_TIMEOUT = int(os.getenv('DAEMON_IDLE_TIMEOUT', '300'))
+# Интервал опроса ящика, если сервер не поддерживает IDLE (сек.)
+DAEMON_POLL_INTERVAL = int(os.getenv('DAEMON_POLL_INTERVAL', '30'))
+# Максимальная пауза между попытками переподключения (сек.)
+DAEMON_MAX_BACKOFF = int(os.getenv('DAEMON_MAX_BACKOFF', '300'))
+# Число процессов для создания PDF (1 - создавать PDF в основном процессе, как раньше)
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', str(os.cpu_count() or 1)))
+# Сколько раз пытаться обработать письмо, на котором создание PDF не удалось (при следующих проходах)
+RENDER_MAX_ATTEMPTS = int(os.getenv('RENDER_MAX_ATTEMPTS', '3'))
+# Сколько готовых писем может ждать просмотра: при заполнении очереди скачивание приостанавливается
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '10'))
+# Максимальный размер (в символах) одного абзаца при выводе текста письма в PDF
+BODY_CHUNK_CHARS = int(os.getenv('BODY_CHUNK_CHARS', '4000'))
+
+# --- Изображения в PDF ---
+# Изображения-вложения и встроенные (cid:) картинки выводятся в PDF после текста письма,
+# уменьшенные до IMAGE_EMBED_DPI при размере во всю ширину страницы и пересжатые в JPEG
+IMAGE_EMBED_DPI = int(os.getenv('IMAGE_EMBED_DPI', '150'))
+# Качество JPEG (1-95) для фотографий; картинки с прозрачностью сохраняются в PNG
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '75'))
+# Сколько изображений одного письма выводить в PDF (остальные только в оригиналах)
+IMAGE_MAX_PER_EMAIL = int(os.getenv('IMAGE_MAX_PER_EMAIL', '30'))
+# Картинки меньше этого размера (пикселей по любой стороне) не выводятся: счетчики, значки, разделители
+IMAGE_MIN_SIZE_PX = int(os.getenv('IMAGE_MIN_SIZE_PX', '32'))
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp']
+
+# Сбор метрик конвейера (время этапов, объемы данных, счетчики ошибок): '1' - включен.
+# При выключенных метриках замеры почти ничего не стоят
+PIPELINE_METRICS = os.getenv('PIPELINE_METRICS', '0').lower() in ('1', 'true', 'yes')
+
+# Архив оригиналов: '1' - после регистрации папка оригиналов письма упаковывается в сжатый архив
+ARCHIVE_ORIGINALS = os.getenv('ARCHIVE_ORIGINALS', '0').lower() in ('1', 'true', 'yes')
+# Максимальный размер одного файла-сегмента архива (новый сегмент начинается и каждый день)
+ARCHIVE_SEGMENT_MAX_BYTES = int(os.getenv('ARCHIVE_SEGMENT_MAX_BYTES', str(1024 * 1024 * 1024)))
+# Полнотекстовый индекс: сколько символов текста брать из тела письма и из каждого вложения
+SEARCH_INDEX_MAX_CHARS = int(os.getenv('SEARCH_INDEX_MAX_CHARS', '500000'))
+
+# --- Конвертация документов Office в PDF ---
+# 'auto' - MS Office (pywin32) на Windows, иначе LibreOffice; 'win32com', 'libreoffice' или 'none'
+OFFICE_CONVERTER = os.getenv('OFFICE_CONVERTER', 'auto')
+# Путь к LibreOffice (soffice); по умолчанию ищется в PATH
+LIBREOFFICE_PATH = os.getenv('LIBREOFFICE_PATH') or shutil.which('soffice') or shutil.which('libreoffice')
+# Число постоянно запущенных процессов LibreOffice: один пул с общей очередью заданий в основном
+# процессе, процессы создания PDF отправляют в него документы
+LIBREOFFICE_WORKERS = int(os.getenv('LIBREOFFICE_WORKERS', '2'))
+# Максимальное время конвертации одного документа (сек.); зависший LibreOffice перезапускается
+LIBREOFFICE_JOB_TIMEOUT = int(os.getenv('LIBREOFFICE_JOB_TIMEOUT', '120'))
+# Сколько ждать запуска LibreOffice (сек.)
+LIBREOFFICE_START_TIMEOUT = int(os.getenv('LIBREOFFICE_START_TIMEOUT', '30'))
+
+# Расширения документов, которые можно конвертировать в PDF, по типу приложения
+OFFICE_DOCUMENT_EXTENSIONS = ['.doc', '.docx', '.rtf', '.odt', '.txt']
+OFFICE_SPREADSHEET_EXTENSIONS = ['.xls', '.xlsx', '.ods', '.xlsm']
+OFFICE_PRESENTATION_EXTENSIONS = ['.ppt', '.pptx', '.odp']
+CONVERTIBLE_EXTENSIONS = OFFICE_DOCUMENT_EXTENSIONS + OFFICE_SPREADSHEET_EXTENSIONS + OFFICE_PRESENTATION_EXTENSIONS
+
 # --- Структура папок ---
 # Главная папка для всех операций
 BASE_OUTPUT_DIRECTORY = "email_processor"
@@ -42,6 +139,27 @@ DOWNLOADED_ORIGINALS_DIR = os.path.join(BASE_OUTPUT_DIRECTORY, "2_downloaded_ori
 REGISTERED_DIR = os.path.join(BASE_OUTPUT_DIRECTORY, "3_registered_emails")
 # Имя файла журнала регистрации
 JOURNAL_CSV_FILE = os.path.join(BASE_OUTPUT_DIRECTORY, "registration_journal.csv")
+# База данных журнала регистрации (основной журнал; CSV дополняется для совместимости)
+JOURNAL_DB_FILE = os.path.join(BASE_OUTPUT_DIRECTORY, "registration_journal.db")
+# Файл с состоянием синхронизации (последний обработанный UID для каждого ящика)
+SYNC_STATE_FILE = os.path.join(BASE_OUTPUT_DIRECTORY, "sync_state.json")
+# Архив оригиналов: файлы-сегменты и индекс (SQLite) с положением каждого файла в сегменте
+ORIGINALS_ARCHIVE_DIR = os.path.join(BASE_OUTPUT_DIRECTORY, "originals_archive")
+ORIGINALS_ARCHIVE_INDEX_FILE = os.path.join(ORIGINALS_ARCHIVE_DIR, "archive_index.db")
+# Список учетных записей и папок для скачивания (если файла нет - одна учетная запись из .env)
+MAIL_ACCOUNTS_FILE = os.getenv('MAIL_ACCOUNTS_FILE', os.path.join(BASE_OUTPUT_DIRECTORY, "mail_accounts.json"))
+# Отчет метрик: по строке JSON на каждое письмо и строка с итогами после каждого прохода
+METRICS_REPORT_FILE = os.path.join(BASE_OUTPUT_DIRECTORY, "metrics_report.jsonl")
+# Снимок итоговых метрик в текстовом формате Prometheus (перезаписывается после каждого прохода)
+METRICS_SNAPSHOT_FILE = os.path.join(BASE_OUTPUT_DIRECTORY, "metrics.prom")
+# Правила автоматической сортировки писем на этапе 2 (если файла нет - все письма просматриваются вручную)
+TRIAGE_RULES_FILE = os.getenv('TRIAGE_RULES_FILE', os.path.join(BASE_OUTPUT_DIRECTORY, "triage_rules.json"))
+# Хранилище вложений по содержимому (SHA-256): одинаковые вложения хранятся на диске один раз
+BLOB_STORE_DIR = os.path.join(BASE_OUTPUT_DIRECTORY, "blob_store")
+# Кэш уменьшенных изображений для PDF по хешу исходного файла (логотипы и подписи обрабатываются один раз)
+IMAGE_CACHE_DIR = os.path.join(BASE_OUTPUT_DIRECTORY, "image_cache")
+# Имя файла-манифеста в папке оригиналов письма (список вложений и их хешей)
+ORIGINALS_MANIFEST_NAME = "manifest.json"
 
 
 # --- Шрифты и прочее ---
@@ -56,25 +174,52 @@ def resource_path(relative_path):
 DEJAVU_SANS_FONT_PATH = resource_path("DejaVuSans.ttf")
 
 # --- Проверка зависимостей (взято из вашего кода) ---
-try:
-    from pypdf import PdfWriter
-    PYPDF_AVAILABLE = True
-    print("INFO: Библиотека pypdf найдена, объединение PDF будет доступно.")
-except ImportError:
-    PYPDF_AVAILABLE = False
-    print("ПРЕДУПРЕЖДЕНИЕ: Библиотека pypdf не найдена. PDF-вложения не будут объединены.")
-
-WIN32COM_AVAILABLE = False
-if os.name == 'nt':
+# Библиотеки только ищутся (find_spec), а не импортируются - это не замедляет запуск
+def _module_installed(module_name):
     try:
-        import win32com.client
-        WIN32COM_AVAILABLE = True
-        CONVERTIBLE_EXTENSIONS = ['.doc','.docx','.rtf','.odt','.txt', '.xls','.xlsx','.ods', '.ppt','.pptx','.odp','.xlsm']
+        return importlib.util.find_spec(module_name) is not None
+    except (ImportError, ValueError):
+        return False
+
+PYPDF_AVAILABLE = _module_installed('pypdf')
+PIL_AVAILABLE = _module_installed('PIL')
+LXML_AVAILABLE = _module_installed('lxml')
+WIN32COM_AVAILABLE = os.name == 'nt' and _module_installed('win32com')
+# LibreOffice управляется через UNO (модуль uno из пакета LibreOffice / python3-uno)
+UNO_AVAILABLE = (OFFICE_CONVERTER in ('auto', 'libreoffice') and not (OFFICE_CONVERTER == 'auto' and WIN32COM_AVAILABLE)
+                 and bool(LIBREOFFICE_PATH) and _module_installed('uno'))
+
+# Выбранный способ конвертации документов Office в PDF (None - конвертация недоступна)
+if OFFICE_CONVERTER == 'auto':
+    OFFICE_CONVERTER_BACKEND = 'win32com' if WIN32COM_AVAILABLE else ('libreoffice' if UNO_AVAILABLE else None)
+elif OFFICE_CONVERTER == 'win32com':
+    OFFICE_CONVERTER_BACKEND = 'win32com' if WIN32COM_AVAILABLE else None
+elif OFFICE_CONVERTER == 'libreoffice':
+    OFFICE_CONVERTER_BACKEND = 'libreoffice' if UNO_AVAILABLE else None
+else:
+    OFFICE_CONVERTER_BACKEND = None
+
+def print_dependency_report():
+    """Печатает, какие возможности доступны (вызывается перед обработкой писем, а не при каждом запуске)."""
+    if PYPDF_AVAILABLE:
+        print("INFO: Библиотека pypdf найдена, объединение PDF будет доступно.")
+    else:
+        print("ПРЕДУПРЕЖДЕНИЕ: Библиотека pypdf не найдена. PDF-вложения не будут объединены.")
+    if not PIL_AVAILABLE:
+        print("ПРЕДУПРЕЖДЕНИЕ: Библиотека Pillow не найдена. Изображения не будут выводиться в PDF.")
+    if not LXML_AVAILABLE:
+        print("INFO: Библиотека lxml не найдена, текст из HTML будет извлекаться медленнее (через html.parser).")
+    if os.name != 'nt':
+        print("INFO: Скрипт запущен не на Windows. Конвертация файлов через MS Office будет недоступна.")
+    elif WIN32COM_AVAILABLE:
         print("INFO: Библиотека pywin32 найдена, конвертация файлов MS Office в PDF будет доступна.")
-    except ImportError:
+    else:
         print("ПРЕДУПРЕЖДЕНИЕ: Библиотека pywin32 не найдена. Конвертация файлов MS Office в PDF будет недоступна.")
-else:
-    print("INFO: Скрипт запущен не на Windows. Конвертация файлов MS Office в PDF будет недоступна.")
+    if OFFICE_CONVERTER in ('auto', 'libreoffice') and not (OFFICE_CONVERTER == 'auto' and WIN32COM_AVAILABLE):
+        if UNO_AVAILABLE:
+            print("INFO: LibreOffice найден, конвертация документов Office в PDF будет доступна.")
+        else:
+            print("ПРЕДУПРЕЖДЕНИЕ: LibreOffice или модуль uno не найдены. Конвертация через LibreOffice будет недоступна.")
 
 #
 # --- БЛОК 1: СКАЧИВАНИЕ И ПЕРВИЧНАЯ ОБРАБОТКА ---
@@ -83,93 +228,896 @@ else:
 
 def download_all_unseen_emails():
     """
-    Основная функция этапа 1. Подключается к почте и скачивает все непрочитанные письма,
-    создавая для каждого PDF-версию и сохраняя оригиналы.
+    Основная функция этапа 1. Подключается к почте и скачивает все новые письма,
+    создавая для каждого PDF-версию и сохраняя оригиналы. Возвращает список метаданных писем.
+    """
+    return list(iter_downloaded_emails())
+
+
+def iter_downloaded_emails():
+    """
+    Потоковый вариант этапа 1: генератор, отдающий метаданные каждого письма сразу после
+    создания его PDF, не дожидаясь скачивания остальных писем.
+    Если есть файл MAIL_ACCOUNTS_FILE, письма скачиваются из всех перечисленных в нем ящиков и папок.
     """
+    if os.path.exists(MAIL_ACCOUNTS_FILE):
+        yield from iter_downloaded_emails_from_accounts(load_mail_accounts())
+        return
+
     if not all([IMAP_SERVER, MAIL_RU_EMAIL, MAIL_RU_PASSWORD]):
         print("CRITICAL: Переменные окружения для почты не найдены в .env файле. Завершение работы.")
-        return []
+        return
 
     mail = None
-    processed_emails_metadata = []
     try:
-        print(f"Подключение к {IMAP_SERVER}...")
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, 993)
-        mail.login(MAIL_RU_EMAIL, MAIL_RU_PASSWORD)
-        mail.select('inbox')
-        print("Успешно подключено к 'Входящие'.")
+        mail = _connect_to_mailbox()
+        yield from _iter_new_emails(mail)
+    except Exception as e:
+        # Уже отданные письма отмечены в состоянии синхронизации и дойдут до просмотра
+        print(f"CRITICAL: Произошла критическая ошибка при скачивании писем: {e}")
+        traceback.print_exc()
+    finally:
+        if mail:
+            mail.logout()
+        print("\n--- Завершено скачивание писем ---")
 
-        status, data = mail.search(None, 'UNSEEN')
-        if status != 'OK':
-            print("ERROR: Ошибка поиска писем.")
-            return []
 
-        email_ids = data[0].split()
-        num_unread = len(email_ids)
-        print(f"Найдено {num_unread} непрочитанных писем. Начинаю скачивание...")
+def find_unreviewed_emails():
+    """
+    Письма, скачанные в прошлых запусках, но так и не просмотренные (программа была прервана во время
+    просмотра): их UID уже сохранены в состоянии синхронизации, поэтому с сервера они больше не придут.
+    Это PDF, оставшиеся в DOWNLOADED_PDF_DIR (просмотренные письма оттуда удаляются или переносятся
+    при регистрации). Отправитель и тема берутся из заголовков original_email.eml.
+    Вызывать до начала скачивания. Возвращает список метаданных писем (как у iter_downloaded_emails).
+    """
+    if not os.path.isdir(DOWNLOADED_PDF_DIR):
+        return []
+    pdf_names = [name for name in os.listdir(DOWNLOADED_PDF_DIR) if name.startswith("email_") and name.endswith(".pdf")]
+    unreviewed = []
+    for pdf_name in sorted(pdf_names):
+        unique_email_id = os.path.splitext(pdf_name)[0]
+        originals_path = os.path.join(DOWNLOADED_ORIGINALS_DIR, unique_email_id)
+        headers = {'sender': "(отправитель неизвестен)", 'subject': "(тема неизвестна)"}
+        eml_path = os.path.join(originals_path, "original_email.eml")
+        if os.path.exists(eml_path):
+            try:
+                # Только заголовки: само письмо может быть очень большим
+                with open(eml_path, 'rb') as f:
+                    header_bytes = b"".join(itertools.takewhile(lambda line: line.strip(), f))
+                headers = _extract_email_headers(email.message_from_bytes(header_bytes))
+            except (OSError, ValueError) as e:
+                print(f"WARNING: Не удалось прочитать заголовки письма {unique_email_id}: {e}")
+        unreviewed.append({
+            "unique_id": unique_email_id,
+            "pdf_path": os.path.join(DOWNLOADED_PDF_DIR, pdf_name),
+            "originals_path": originals_path,
+            "sender": headers['sender'],
+            "subject": headers['subject'],
+        })
+    if unreviewed:
+        print(f"INFO: Найдено {len(unreviewed)} писем, скачанных ранее, но не просмотренных - они будут показаны первыми.")
+    return unreviewed
+
+
+def run_ingestion_daemon():
+    """
+    Режим службы: держит одно соединение с почтой и обрабатывает новые письма в течение
+    нескольких секунд после их прихода. О новых письмах узнает через IMAP IDLE, а если сервер
+    его не поддерживает (или отклоняет команду) - опросом NOOP с интервалом DAEMON_POLL_INTERVAL.
+    При обрыве соединения переподключается с растущей паузой (до DAEMON_MAX_BACKOFF); пауза
+    сбрасывается только после успешного прохода по папке. Пул процессов создания PDF один
+    на все время работы службы. Бесконечный генератор метаданных писем (как iter_downloaded_emails).
+    """
+    if not all([IMAP_SERVER, MAIL_RU_EMAIL, MAIL_RU_PASSWORD]):
+        print("CRITICAL: Переменные окружения для почты не найдены в .env файле. Завершение работы.")
+        return
+
+    render_pool = RenderProcessPool(RENDER_WORKERS) if RENDER_WORKERS > 1 else None
+    backoff = 1
+    try:
+        while True:
+            mail = None
+            try:
+                mail = _connect_to_mailbox()
+                use_idle = 'IDLE' in mail.capabilities
+                print(f"INFO: Режим службы: ожидание новых писем ({'IMAP IDLE' if use_idle else 'опрос каждые ' + str(DAEMON_POLL_INTERVAL) + ' с'}).")
+                while True:
+                    # Уведомления, пришедшие до прохода, им и обрабатываются; пришедшие во время - останутся
+                    _pop_new_mail_notifications(mail)
+                    yield from _iter_new_emails(mail, render_pool)
+                    backoff = 1
+                    if use_idle and _wait_for_new_mail_idle(mail, DAEMON_IDLE_TIMEOUT) is None:
+                        print(f"WARNING: Сервер отклонил IDLE, переход на опрос каждые {DAEMON_POLL_INTERVAL} с.")
+                        use_idle = False
+                    if not use_idle:
+                        time.sleep(DAEMON_POLL_INTERVAL)
+                        mail.noop()
+            except (imaplib.IMAP4.error, OSError) as e:
+                print(f"WARNING: Соединение с почтой потеряно ({e}). Переподключение через {backoff} с...")
+            finally:
+                if mail:
+                    _logout_quietly(mail)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, DAEMON_MAX_BACKOFF)
+    finally:
+        if render_pool:
+            render_pool.shutdown()
+
 
-        if num_unread == 0:
+def check_new_mail():
+    """
+    Быстрая проверка почты без скачивания: для каждой папки (из MAIL_ACCOUNTS_FILE или .env)
+    печатает число новых писем. Папки открываются только для чтения, прогресс не меняется,
+    библиотеки создания PDF не загружаются. Возвращает общее число новых писем (None при ошибке).
+    """
+    accounts = load_mail_accounts()
+    if not accounts:
+        print("CRITICAL: Переменные окружения для почты не найдены в .env файле. Завершение работы.")
+        return None
+    sync_state = load_sync_state()
+    total_new = 0
+    for account in accounts:
+        mail = None
+        try:
+            mail = _connect_account(account)
+            for folder in account["folders"]:
+                status, _ = mail.select(folder, readonly=True)
+                if status != 'OK':
+                    print(f"ERROR: Папка '{folder}' учетной записи {account['email']} не найдена.")
+                    continue
+                sync_key = _sync_state_key(account["email"], account["server"], folder)
+                email_ids, _ = _search_new_uids(mail, sync_state, sync_key)
+                print(f"Найдено {len(email_ids)} новых писем в {sync_key}.")
+                total_new += len(email_ids)
+        except (imaplib.IMAP4.error, OSError) as e:
+            print(f"ERROR: Не удалось проверить почту {account['email']}: {e}")
+            return None
+        finally:
+            if mail:
+                _logout_quietly(mail)
+    return total_new
+
+
+def _connect_to_mailbox():
+    """Подключается к серверу, входит в учетную запись и открывает папку IMAP_MAILBOX."""
+    print(f"Подключение к {IMAP_SERVER}...")
+    mail = imaplib.IMAP4_SSL(IMAP_SERVER, 993)
+    mail.login(MAIL_RU_EMAIL, MAIL_RU_PASSWORD)
+    mail.select(IMAP_MAILBOX)
+    print(f"Успешно подключено к '{IMAP_MAILBOX}'.")
+    return mail
+
+
+def _iter_new_emails(mail, render_pool=None):
+    """
+    Один проход по открытой папке: находит новые письма (по сохраненному UID или UNSEEN),
+    скачивает их, создает PDF и отдает метаданные, сохраняя прогресс после каждого письма.
+    render_pool - уже запущенный пул процессов создания PDF (режим службы) или None.
+    """
+    sync_state = load_sync_state()
+    sync_key = _sync_state_key(MAIL_RU_EMAIL, IMAP_SERVER, IMAP_MAILBOX)
+    email_ids, uidvalidity = _search_new_uids(mail, sync_state, sync_key)
+    num_unread = len(email_ids)
+    print(f"Найдено {num_unread} новых писем. Начинаю скачивание...")
+
+    if num_unread == 0:
+        return
+
+    fetched_messages = _fetch_messages(mail, email_ids)
+    rendered_emails = _render_emails(fetched_messages, RENDER_WORKERS, render_pool)
+    for i, (email_id_str, email_metadata) in enumerate(rendered_emails):
+        print(f"\n--- Обработано письмо {i + 1}/{num_unread} (UID: {email_id_str}) ---")
+        # Фиксируем прогресс после каждого письма, чтобы после сбоя не обрабатывать его повторно;
+        # письмо, которое обработать не удалось, запоминается для повторной попытки
+        save_sync_checkpoint(sync_state, sync_key, uidvalidity, int(email_id_str), failed=email_metadata is None)
+        if email_metadata:
+            print(f"  От: {email_metadata['sender']}")
+            print(f"  Тема: {email_metadata['subject']}")
+            yield email_metadata
+
+
+def _search_new_uids(mail, sync_state, sync_key):
+    """
+    Ищет в открытой папке новые письма: с UID больше сохраненного (режим checkpoint) или UNSEEN,
+    а также письма, которые не удалось обработать в прошлых проходах (retry_uids) и которые еще есть в папке.
+    Возвращает (отсортированный список UID, UIDVALIDITY папки); при ошибке поиска список пуст.
+    """
+    _, uidvalidity_data = mail.response('UIDVALIDITY')
+    uidvalidity = uidvalidity_data[0].decode() if uidvalidity_data and uidvalidity_data[0] else None
+    # После первого прохода ответа UIDVALIDITY в буфере уже нет - берем значение из состояния
+    if uidvalidity is None and sync_key in sync_state:
+        uidvalidity = sync_state[sync_key].get("uidvalidity")
+    last_uid = _get_last_processed_uid(sync_state, sync_key, uidvalidity) if IMAP_SYNC_MODE == 'checkpoint' else None
+
+    if last_uid is not None:
+        # Только письма с UID больше последнего обработанного, флаг \Seen не важен
+        status, data = mail.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+    else:
+        status, data = mail.uid('SEARCH', None, 'UNSEEN')
+    if status != 'OK':
+        print(f"ERROR: Ошибка поиска писем ({sync_key}).")
+        return [], uidvalidity
+
+    # Диапазон 'N:*' всегда включает последнее письмо ящика, даже если его UID меньше N
+    email_ids = {u for u in data[0].split() if last_uid is None or int(u) > last_uid}
+    email_ids.update(_search_retry_uids(mail, sync_state, sync_key, uidvalidity))
+    return sorted(email_ids, key=int), uidvalidity
+
+
+def _search_retry_uids(mail, sync_state, sync_key, uidvalidity):
+    """UID писем для повторной обработки, которые еще есть в папке (удаленные из нее не ищутся)."""
+    entry = sync_state.get(sync_key) or {}
+    retry_uids = entry.get("retry_uids") if entry.get("uidvalidity") == uidvalidity else None
+    if not retry_uids:
+        return []
+    status, data = mail.uid('SEARCH', None, f'UID {_compress_uid_set(retry_uids)}')
+    if status != 'OK':
+        return []
+    return [u for u in data[0].split() if u.decode() in retry_uids]
+
+
+def _fetch_messages(mail, uids):
+    """
+    Скачивает письма выбранным способом (IMAP_FETCH_MODE). Генератор пар (UID письма, сырые байты
+    или None, если письмо получить не удалось - тогда оно считается необработанным и скачивается повторно).
+    """
+    if IMAP_FETCH_MODE == 'single':
+        return _fetch_messages_one_by_one(mail, uids)
+    return _fetch_messages_batched(mail, uids, IMAP_FETCH_BATCH_SIZE, IMAP_PIPELINE_DEPTH, IMAP_FETCH_BATCH_BYTES)
+
+
+def _wait_for_new_mail_idle(mail, timeout):
+    """
+    Команда IMAP IDLE: ждет, пока сервер сообщит о новых письмах (EXISTS/RECENT), но не дольше timeout.
+    Ответы читаются через imaplib (его буфер и разбор ответов), поэтому уведомления, уже полученные
+    вместе с ответами на прошлые команды, не теряются: если они есть, IDLE не отправляется.
+    Возвращает True, если пришли новые письма, False по тайм-ауту, None, если сервер отклонил IDLE.
+    """
+    if _has_new_mail_notifications(mail):
+        return True
+    tag = mail._new_tag()
+    mail.tagged_commands[tag] = None
+    mail.send(tag + b' IDLE\r\n')
+    # Ждем продолжения '+': _get_response возвращает None именно на него
+    while mail._get_response() is not None:
+        if mail.tagged_commands[tag] is not None:
+            status, data = mail.tagged_commands.pop(tag)
+            print(f"WARNING: IDLE отклонен сервером: {status} {data}")
+            return None
+
+    # Тайм-аут на сокете ставить нельзя: после socket.timeout файл ответов imaplib (mail.file)
+    # больше не читается. Поэтому ждем данных через select, а строку читает imaplib.
+    # Строки, уже прочитанные в буфер mail.file вместе с предыдущими, select не видит - такое
+    # уведомление будет разобрано при завершении IDLE (не позже timeout) и не потеряется.
+    deadline = time.monotonic() + timeout
+    while not _has_new_mail_notifications(mail):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # У SSL-сокета расшифрованные данные могут уже лежать в его буфере - select их не покажет
+        if not (hasattr(mail.sock, 'pending') and mail.sock.pending()):
+            readable, _, _ = select.select([mail.sock], [], [], remaining)
+            if not readable:
+                break # Сервер молчал до конца ожидания
+        mail._get_response()
+        if 'BYE' in mail.untagged_responses:
+            raise mail.abort("сервер закрыл соединение во время IDLE")
+
+    mail.send(b'DONE\r\n')
+    mail._command_complete('IDLE', tag)
+    return _has_new_mail_notifications(mail)
+
+
+def _has_new_mail_notifications(mail):
+    """Есть ли среди ответов сервера, сохраненных imaplib, уведомления о новых письмах."""
+    return 'EXISTS' in mail.untagged_responses or 'RECENT' in mail.untagged_responses
+
+
+def _pop_new_mail_notifications(mail):
+    """Удаляет сохраненные уведомления о новых письмах (перед проходом, который их обработает)."""
+    mail.untagged_responses.pop('EXISTS', None)
+    mail.untagged_responses.pop('RECENT', None)
+
+
+# --- Скачивание из нескольких ящиков ---
+def load_mail_accounts():
+    """
+    Загружает список учетных записей из MAIL_ACCOUNTS_FILE (JSON), например:
+    [{"server": "imap.mail.ru", "email": "office@mail.ru", "password_env": "OFFICE_PASSWORD",
+      "folders": ["inbox", "Reports"]}]
+    Пароль берется из переменной окружения password_env (или из поля password).
+    Если файла нет, возвращает одну учетную запись из .env с папкой IMAP_MAILBOX.
+    """
+    if not os.path.exists(MAIL_ACCOUNTS_FILE):
+        if not all([IMAP_SERVER, MAIL_RU_EMAIL, MAIL_RU_PASSWORD]):
             return []
+        return [{"server": IMAP_SERVER, "port": 993, "email": MAIL_RU_EMAIL,
+                 "password": MAIL_RU_PASSWORD, "folders": [IMAP_MAILBOX]}]
 
-        for i, email_id_bytes in enumerate(email_ids):
-            email_id_str = email_id_bytes.decode()
-            print(f"\n--- Скачиваю письмо {i + 1}/{num_unread} (ID: {email_id_str}) ---")
-            
-            # Получаем объект письма
-            status, msg_data = mail.fetch(email_id_str, '(RFC822)')
-            if status != 'OK':
-                print(f"ERROR: Не удалось получить письмо с ID {email_id_str}.")
+    with open(MAIL_ACCOUNTS_FILE, 'r', encoding='utf-8') as f:
+        accounts = json.load(f)
+    for account in accounts:
+        account.setdefault("port", 993)
+        account.setdefault("folders", [IMAP_MAILBOX])
+        if account.get("password_env"):
+            account["password"] = os.getenv(account["password_env"])
+        if not account.get("password"):
+            print(f"WARNING: Не задан пароль для {account['email']}.")
+    return accounts
+
+
+def iter_downloaded_emails_from_accounts(accounts):
+    """
+    Этап 1 для нескольких ящиков: папки всех учетных записей скачиваются одновременно
+    (asyncio, см. _ingest_mailboxes), а письма попадают в общий поток создания PDF.
+    Генератор метаданных писем, как iter_downloaded_emails; прогресс сохраняется для каждой папки.
+    """
+    import asyncio
+    print(f"--- Скачивание из {sum(len(a['folders']) for a in accounts)} папок {len(accounts)} учетных записей ---")
+    sync_state = load_sync_state()
+    # Скачанные, но еще не обработанные письма; при заполнении очереди скачивание приостанавливается
+    fetched_queue = queue.Queue(maxsize=max(1, PIPELINE_QUEUE_SIZE))
+    finished = object() # Маркер окончания скачивания
+
+    def run_ingestion():
+        try:
+            asyncio.run(_ingest_mailboxes(accounts, sync_state, fetched_queue))
+        except Exception as e:
+            print(f"CRITICAL: Произошла критическая ошибка при скачивании писем: {e}")
+            traceback.print_exc()
+        finally:
+            fetched_queue.put(finished)
+
+    # Письма разных папок могут иметь одинаковые UID, поэтому для обработки используется
+    # метка "номер папки_UID", а по ней - куда записать прогресс
+    checkpoints = {}
+
+    def fetched_messages():
+        while True:
+            item = fetched_queue.get()
+            if item is finished:
+                return
+            label, sync_key, uidvalidity, uid_str, raw_email = item
+            checkpoints[label] = (sync_key, uidvalidity, int(uid_str))
+            yield label, raw_email
+
+    threading.Thread(target=run_ingestion, daemon=True).start()
+    try:
+        for label, email_metadata in _render_emails(fetched_messages(), RENDER_WORKERS):
+            sync_key, uidvalidity, uid = checkpoints.pop(label)
+            save_sync_checkpoint(sync_state, sync_key, uidvalidity, uid, failed=email_metadata is None)
+            print(f"\n--- Обработано письмо {sync_key} (UID: {uid}) ---")
+            if email_metadata:
+                print(f"  От: {email_metadata['sender']}")
+                print(f"  Тема: {email_metadata['subject']}")
+                yield email_metadata
+    finally:
+        print("\n--- Завершено скачивание писем ---")
+
+
+async def _ingest_mailboxes(accounts, sync_state, fetched_queue):
+    """
+    Одновременно скачивает новые письма из всех папок всех учетных записей.
+    Для каждой учетной записи работает не больше IMAP_CONNECTIONS_PER_ACCOUNT соединений,
+    которые по очереди берут ее папки; общее число соединений ограничено IMAP_MAX_CONNECTIONS
+    и IMAP_MAX_CONNECTIONS_PER_SERVER. imaplib блокирующий, поэтому команды IMAP выполняются
+    в потоках, а asyncio распределяет соединения и папки.
+    """
+    import asyncio
+    connection_limit = asyncio.Semaphore(IMAP_MAX_CONNECTIONS)
+    server_limits = {}
+    mailbox_numbers = itertools.count(1)
+    workers = []
+    with ThreadPoolExecutor(max_workers=IMAP_MAX_CONNECTIONS) as executor:
+        for account in accounts:
+            server_limit = server_limits.setdefault(
+                account["server"].lower(), asyncio.Semaphore(IMAP_MAX_CONNECTIONS_PER_SERVER))
+            folders = asyncio.Queue()
+            for folder in account["folders"]:
+                folders.put_nowait((next(mailbox_numbers), folder))
+            for _ in range(min(IMAP_CONNECTIONS_PER_ACCOUNT, len(account["folders"]))):
+                workers.append(_mailbox_connection_worker(
+                    account, folders, server_limit, connection_limit, executor, sync_state, fetched_queue))
+        await asyncio.gather(*workers)
+
+
+async def _mailbox_connection_worker(account, folders, server_limit, connection_limit, executor, sync_state, fetched_queue):
+    """
+    Одно соединение учетной записи: занимает место в лимитах сервера и общем лимите,
+    затем скачивает папки из очереди folders, пока они не закончатся.
+    Ошибка в одной папке не мешает остальным: при обрыве соединение открывается заново.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    # Сначала лимит сервера, потом общий: соединение, ждущее свой сервер, не занимает общий лимит
+    async with server_limit, connection_limit:
+        mail = None
+        try:
+            while not folders.empty():
+                mailbox_number, folder = folders.get_nowait()
+                try:
+                    if mail is None:
+                        mail = await loop.run_in_executor(executor, _connect_account, account)
+                    await loop.run_in_executor(executor, _fetch_new_from_folder,
+                                               mail, account, mailbox_number, folder, sync_state, fetched_queue)
+                except (imaplib.IMAP4.abort, OSError) as e:
+                    print(f"ERROR: Соединение с {account['email']} прервано при скачивании папки '{folder}': {e}")
+                    mail = None
+                except imaplib.IMAP4.error as e:
+                    print(f"ERROR: Не удалось скачать папку '{folder}' учетной записи {account['email']}: {e}")
+        finally:
+            if mail:
+                await loop.run_in_executor(executor, _logout_quietly, mail)
+
+
+def _connect_account(account):
+    """Подключается к серверу учетной записи и входит в нее."""
+    print(f"Подключение к {account['server']} ({account['email']})...")
+    mail = imaplib.IMAP4_SSL(account["server"], account["port"])
+    mail.login(account["email"], account["password"])
+    return mail
+
+
+def _fetch_new_from_folder(mail, account, mailbox_number, folder, sync_state, fetched_queue):
+    """Открывает папку, находит новые письма и кладет их в fetched_queue (выполняется в потоке)."""
+    status, _ = mail.select(folder)
+    if status != 'OK':
+        print(f"ERROR: Папка '{folder}' учетной записи {account['email']} не найдена.")
+        return
+    sync_key = _sync_state_key(account["email"], account["server"], folder)
+    email_ids, uidvalidity = _search_new_uids(mail, sync_state, sync_key)
+    print(f"Найдено {len(email_ids)} новых писем в {sync_key}.")
+    if not email_ids:
+        return
+    for uid_str, raw_email in _fetch_messages(mail, email_ids):
+        fetched_queue.put((f"{mailbox_number}_{uid_str}", sync_key, uidvalidity, uid_str, raw_email))
+
+
+def _logout_quietly(mail):
+    """Закрывает соединение, не обращая внимания на ошибки (соединение может быть уже разорвано)."""
+    try:
+        mail.logout()
+    except Exception:
+        pass
+
+
+def stream_in_background(items, max_queued):
+    """
+    Выполняет генератор items в фоновом потоке и отдает его элементы через очередь
+    размером max_queued. Когда очередь заполнена, фоновый поток ждет (обратное давление),
+    поэтому в памяти одновременно находится не больше max_queued готовых элементов.
+    """
+    items_queue = queue.Queue(maxsize=max(1, max_queued))
+    finished = object() # Маркер окончания генератора
+
+    def producer():
+        try:
+            for item in items:
+                items_queue.put(item)
+        except Exception as e:
+            print(f"CRITICAL: Ошибка в фоновом этапе обработки: {e}")
+            traceback.print_exc()
+        finally:
+            items_queue.put(finished)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item = items_queue.get()
+        if item is finished:
+            return
+        yield item
+
+
+def _render_emails(fetched_messages, workers, render_pool=None):
+    """
+    Создает PDF для писем из генератора (UID, сырые байты). При workers > 1 письма
+    обрабатываются пулом процессов, но результаты отдаются строго в исходном порядке.
+    Письма, которые не удалось скачать (None вместо байтов), отдаются как необработанные.
+    render_pool - уже запущенный RenderProcessPool (не закрывается) или None - пул создается на этот вызов.
+    Генератор пар (UID письма, метаданные письма или None при ошибке).
+    """
+    if workers <= 1:
+        for uid_str, raw_email in fetched_messages:
+            if raw_email is None:
+                yield _report_render_result((uid_str, None, None))
                 continue
-            
-            msg = email.message_from_bytes(msg_data[0][1])
-            email_headers = _extract_email_headers(msg)
-            
-            print(f"  От: {email_headers['sender']}")
-            print(f"  Тема: {email_headers['subject']}")
-
-            # Генерируем уникальное имя для этого письма, чтобы связать PDF и папку с оригиналами
-            timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-            unique_email_id = f"email_{timestamp}"
-
-            # Создаем PDF и сохраняем оригиналы
-            pdf_path, originals_path = _generate_pdf_and_save_originals(msg, unique_email_id, email_headers)
-
-            if pdf_path:
-                processed_emails_metadata.append({
-                    "unique_id": unique_email_id,
-                    "pdf_path": pdf_path,
-                    "originals_path": originals_path,
-                    "sender": email_headers['sender'],
-                    "subject": email_headers['subject']
-                })
-        
-        return processed_emails_metadata
+            yield _report_render_result(_render_email_worker(uid_str, raw_email))
+        flush_metrics_report()
+        return
+
+    # Держим в работе не больше workers * 2 писем, чтобы не хранить в памяти весь ящик
+    max_pending = workers * 2
+    pending = [] # [UID, сырые байты, Future] писем в работе
+    owns_pool = render_pool is None
+    if owns_pool:
+        render_pool = RenderProcessPool(workers)
+    try:
+        for uid_str, raw_email in fetched_messages:
+            if raw_email is None:
+                # Очередь результатов упорядочена - неудачное скачивание занимает в ней свое место
+                future = Future()
+                future.set_result((uid_str, None, None))
+            else:
+                future = render_pool.submit(uid_str, raw_email)
+            pending.append([uid_str, raw_email, future])
+            if len(pending) >= max_pending:
+                yield _report_render_result(_collect_render_result(render_pool, pending))
+        while pending:
+            yield _report_render_result(_collect_render_result(render_pool, pending))
+    finally:
+        if owns_pool:
+            render_pool.shutdown()
+    flush_metrics_report()
+
+
+class RenderProcessPool:
+    """
+    Пул процессов создания PDF, который переживает аварийное завершение своего процесса
+    (письмо, на котором падает библиотека, нехватка памяти): сломанный пул заменяется новым.
+    Каждый процесс пула один раз готовит шрифты и стили PDF при запуске, а документы Office
+    отправляет в общий пул LibreOffice основного процесса.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = self._start()
 
+    def _start(self):
+        office_conversion_address = None
+        if OFFICE_CONVERTER_BACKEND == 'libreoffice':
+            office_conversion_address = get_office_conversion_server().address
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_render_process,
+                                   initargs=(office_conversion_address,))
+
+    def submit(self, uid_str, raw_email):
+        try:
+            return self.executor.submit(_render_email_worker, uid_str, raw_email)
+        except BrokenProcessPool:
+            self.restart()
+            return self.executor.submit(_render_email_worker, uid_str, raw_email)
+
+    def restart(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._start()
+
+    def render_alone(self, uid_str, raw_email):
+        """Обрабатывает письмо, пока в пуле нет других: если процесс упадет, виновато именно это письмо."""
+        try:
+            return self.submit(uid_str, raw_email).result()
+        except BrokenProcessPool:
+            print(f"ERROR: Процесс обработки письма с UID {uid_str} аварийно завершился.")
+            count_event('render_process_errors')
+            self.restart()
+            return uid_str, None, None
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def _init_render_process(office_conversion_address):
+    """Подготовка процесса пула создания PDF: шрифты и стили PDF, адрес общего пула LibreOffice."""
+    global _OFFICE_CONVERSION_ADDRESS, _LIBREOFFICE_POOL, _office_conversion_lock
+    _OFFICE_CONVERSION_ADDRESS = office_conversion_address
+    # При fork процесс получает копию пула основного процесса без его потоков - создаем клиент заново
+    _LIBREOFFICE_POOL = None
+    _office_conversion_lock = threading.Lock()
+    get_pdf_render_context()
+
+
+def _collect_render_result(render_pool, pending):
+    """
+    Дожидается результата обработки первого письма из pending. Сбой процесса не останавливает
+    остальные письма: при падении процесса ошибку получают все письма в работе, поэтому пул
+    перезапускается, первое письмо обрабатывается заново в одиночку, а остальные пострадавшие
+    отправляются в новый пул (уже готовые результаты сохраняются).
+    """
+    uid_str, raw_email, future = pending.pop(0)
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        print("WARNING: Процесс пула создания PDF аварийно завершился, письма в работе обрабатываются заново.")
+        wait_futures([entry[2] for entry in pending])
+        render_pool.restart()
+        render_result = render_pool.render_alone(uid_str, raw_email)
+        for entry in pending:
+            if entry[2].cancelled() or isinstance(entry[2].exception(), BrokenProcessPool):
+                entry[2] = render_pool.submit(entry[0], entry[1])
+        return render_result
     except Exception as e:
-        print(f"CRITICAL: Произошла критическая ошибка при скачивании писем: {e}")
+        print(f"ERROR: Процесс обработки письма с UID {uid_str} завершился с ошибкой: {e}")
+        count_event('render_process_errors')
+        return uid_str, None, None
+
+
+def _report_render_result(render_result):
+    """Учитывает метрики обработанного письма и возвращает пару (UID письма, метаданные)."""
+    uid_str, email_metadata, email_metrics = render_result
+    report_email_metrics(uid_str, email_metadata, email_metrics)
+    return uid_str, email_metadata
+
+
+def _render_email_worker(uid_str, raw_email):
+    """
+    Обработка одного письма (в основном процессе или в процессе пула).
+    Ошибка обработки одного письма не прерывает обработку остальных.
+    Возвращает (UID, метаданные или None, метрики письма или None, если метрики выключены).
+    """
+    begin_email_metrics()
+    try:
+        email_metadata = _process_downloaded_email(raw_email, uid_str)
+    except Exception as e:
+        print(f"ERROR: Не удалось обработать письмо с UID {uid_str}: {e}")
         traceback.print_exc()
-        return []
-    finally:
-        if mail:
-            mail.logout()
-        print("\n--- Завершено скачивание писем ---")
+        email_metadata = None
+    return uid_str, email_metadata, end_email_metrics()
+
+
+def _process_downloaded_email(raw_email, uid_str):
+    """
+    Обрабатывает одно скачанное письмо: создает PDF и сохраняет оригиналы.
+    raw_email - сырые байты RFC822 или путь к файлу, в который большое письмо скачано по частям.
+    Возвращает словарь с метаданными письма или None, если PDF создать не удалось.
+    """
+    # Генерируем уникальное имя для этого письма, чтобы связать PDF и папку с оригиналами.
+    # UID добавлен, т.к. процессы пула могут получить одинаковую отметку времени
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    unique_email_id = f"email_{timestamp}_{uid_str}"
+
+    # Создаем PDF и сохраняем оригиналы
+    pdf_path, originals_path, email_headers = _generate_pdf_and_save_originals(raw_email, unique_email_id)
+
+    if not pdf_path:
+        return None
+    return {
+        "unique_id": unique_email_id,
+        "pdf_path": pdf_path,
+        "originals_path": originals_path,
+        "sender": email_headers['sender'],
+        "subject": email_headers['subject']
+    }
 
 
-def _generate_pdf_and_save_originals(msg, unique_email_id, headers):
+def _fetch_messages_one_by_one(mail, uids):
+    """
+    Старый режим: отдельная команда UID FETCH (и отдельный сетевой запрос) на каждое письмо.
+    Генератор пар (UID письма, сырые байты письма или None, если письмо получить не удалось).
+    """
+    for uid_bytes in uids:
+        uid_str = uid_bytes.decode()
+        with measure_stage('imap_fetch') as timer:
+            status, msg_data = mail.uid('FETCH', uid_str, '(RFC822)')
+            fetched = status == 'OK' and msg_data and isinstance(msg_data[0], tuple)
+            if fetched:
+                timer.nbytes = len(msg_data[0][1])
+        if not fetched:
+            print(f"ERROR: Не удалось получить письмо с UID {uid_str}.")
+            count_event('fetch_errors')
+            yield uid_str, None
+            continue
+        yield uid_str, msg_data[0][1]
+
+
+def _fetch_messages_batched(mail, uids, batch_size, pipeline_depth, batch_bytes=IMAP_FETCH_BATCH_BYTES):
+    """
+    Пакетный режим: письма запрашиваются командами UID FETCH по batch_size штук (и не больше
+    batch_bytes по RFC822.SIZE), при этом до pipeline_depth команд отправлены на сервер, не дожидаясь
+    ответов (скользящее окно): как только дочитан ответ на самую старую команду, ее письма отдаются
+    и отправляется следующая. Письма больше IMAP_LARGE_MESSAGE_BYTES скачиваются по частям во временный файл.
+    Генератор пар (UID письма, сырые байты письма или путь к файлу) в порядке списка uids;
+    для письма, которое получить не удалось, вместо байтов - None.
     """
-    Для одного письма: создает PDF и сохраняет оригинал письма (.eml) и вложения.
-    Возвращает пути к созданному PDF и папке с оригиналами.
+    batch_size = max(1, batch_size)
+    pipeline_depth = max(1, pipeline_depth)
+    message_sizes = _fetch_message_sizes(mail, uids)
+
+    # Делим UID на пачки; каждое большое письмо - отдельная "пачка", которая скачивается по частям
+    segments = [] # (большое ли письмо, список UID, размер пачки в байтах)
+    for uid_bytes in uids:
+        message_size = message_sizes.get(uid_bytes.decode(), 0)
+        is_large = message_size > IMAP_LARGE_MESSAGE_BYTES
+        if (not is_large and segments and not segments[-1][0] and len(segments[-1][1]) < batch_size
+                and segments[-1][2] + message_size <= batch_bytes):
+            segments[-1][1].append(uid_bytes)
+            segments[-1][2] += message_size
+        else:
+            segments.append([is_large, [uid_bytes], message_size])
+
+    pending = [] # (тег команды, UID пачки) для отправленных, но еще не завершенных команд
+    fetched = {} # Письма, пришедшие раньше ответа на свою команду
+    for is_large, batch, _ in segments:
+        if is_large:
+            # Перед отдельными командами для большого письма дочитываем уже отправленные
+            while pending:
+                yield from _complete_oldest_fetch(mail, pending, fetched)
+            uid_str = batch[0].decode()
+            yield uid_str, _stream_message_to_file(mail, uid_str, message_sizes[uid_str])
+            continue
+
+        # Окно заполнено: сначала дочитываем и отдаем самую старую команду, потом отправляем следующую
+        if len(pending) >= pipeline_depth:
+            yield from _complete_oldest_fetch(mail, pending, fetched)
+        tag = mail._command('UID', 'FETCH', _compress_uid_set(batch), '(RFC822)')
+        pending.append((tag, batch))
+    while pending:
+        yield from _complete_oldest_fetch(mail, pending, fetched)
+
+
+def _complete_oldest_fetch(mail, pending, fetched):
+    """Дожидается ответа на самую старую отправленную команду UID FETCH и отдает ее письма в порядке UID."""
+    pending_tag, pending_batch = pending.pop(0)
+    with measure_stage('imap_fetch') as timer:
+        try:
+            status, _ = mail._command_complete('FETCH', pending_tag)
+            if status != 'OK':
+                print("ERROR: Сервер отклонил пакетный запрос писем.")
+        except mail.abort:
+            raise
+        except mail.error as e:
+            print(f"ERROR: Ошибка пакетного получения писем: {e}")
+        # Ответы дочитаны до тега этой команды: в буфере ее письма (и, возможно, начало следующих)
+        _, fetch_data = mail._untagged_response('OK', [None], 'FETCH')
+        batch_messages = _parse_uid_fetch_response(fetch_data)
+        timer.nbytes = sum(len(raw_email) for raw_email in batch_messages.values())
+    fetched.update(batch_messages)
+
+    for uid_bytes in pending_batch:
+        uid_str = uid_bytes.decode()
+        raw_email = fetched.pop(uid_str, None)
+        if raw_email is None:
+            print(f"ERROR: Не удалось получить письмо с UID {uid_str}.")
+            count_event('fetch_errors')
+        yield uid_str, raw_email
+
+
+def _fetch_message_sizes(mail, uids):
+    """Одной командой узнает размеры писем: возвращает словарь {UID: размер в байтах}."""
+    status, data = mail.uid('FETCH', _compress_uid_set(uids), '(RFC822.SIZE)')
+    if status != 'OK':
+        print("WARNING: Не удалось получить размеры писем, все письма будут скачаны целиком.")
+        return {}
+    sizes = {}
+    for item in data:
+        line = item[0] if isinstance(item, tuple) else item
+        uid_match = re.search(rb'UID (\d+)', line or b'')
+        size_match = re.search(rb'RFC822\.SIZE (\d+)', line or b'')
+        if uid_match and size_match:
+            sizes[uid_match.group(1).decode()] = int(size_match.group(1))
+    return sizes
+
+
+def _stream_message_to_file(mail, uid_str, message_size):
+    """
+    Скачивает большое письмо частями BODY.PEEK[]<смещение.размер> во временный файл,
+    не держа его целиком в памяти. Возвращает путь к файлу или None при ошибке.
+    """
+    spool_path = os.path.join(DOWNLOADED_ORIGINALS_DIR, f"_incoming_{uid_str}_{uuid.uuid4().hex}.eml")
+    print(f"INFO: Письмо с UID {uid_str} ({message_size // (1024 * 1024)} МБ) скачивается по частям...")
+    try:
+        with measure_stage('imap_fetch') as timer, open(spool_path, 'wb') as f:
+            offset = 0
+            while offset < message_size:
+                status, data = mail.uid('FETCH', uid_str, f'(BODY.PEEK[]<{offset}.{IMAP_STREAM_CHUNK_BYTES}>)')
+                chunk = next((item[1] for item in data if isinstance(item, tuple)), None) if status == 'OK' else None
+                if not chunk:
+                    break
+                f.write(chunk)
+                offset += len(chunk)
+            timer.nbytes = offset
+        if offset < message_size:
+            # Сервер отказал или вернул пустую часть: обрезанное письмо не отдаем и не помечаем прочитанным
+            raise mail.error(f"скачано {offset} из {message_size} байт")
+        # BODY.PEEK не ставит флаг \Seen, а RFC822 ставит - выравниваем поведение
+        mail.uid('STORE', uid_str, '+FLAGS', '(\\Seen)')
+        return spool_path
+    except Exception as e:
+        print(f"ERROR: Не удалось скачать письмо с UID {uid_str} по частям: {e}")
+        count_event('fetch_errors')
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+        return None
+
+
+def _parse_uid_fetch_response(fetch_data):
+    """Разбирает ответ UID FETCH в словарь {UID: сырые байты письма}."""
+    messages = {}
+    for item in fetch_data:
+        if not isinstance(item, tuple):
+            continue # Закрывающие скобки b')' и прочие служебные строки
+        uid_match = re.search(rb'UID (\d+)', item[0])
+        if uid_match:
+            messages[uid_match.group(1).decode()] = item[1]
+    return messages
+
+
+def load_sync_state():
+    """Загружает состояние синхронизации из SYNC_STATE_FILE (пустой словарь, если файла нет)."""
+    if not os.path.exists(SYNC_STATE_FILE):
+        return {}
+    try:
+        with open(SYNC_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"WARNING: Не удалось прочитать состояние синхронизации, начинаю с нуля: {e}")
+        return {}
+
+
+def save_sync_checkpoint(sync_state, sync_key, uidvalidity, uid, failed=False):
+    """
+    Запоминает UID последнего обработанного письма и атомарно перезаписывает SYNC_STATE_FILE
+    (через временный файл), чтобы сбой во время записи не испортил состояние.
+    Письмо, которое обработать не удалось (failed), попадает в retry_uids с числом попыток:
+    следующие проходы скачивают его снова, пока попыток меньше RENDER_MAX_ATTEMPTS.
+    """
+    entry = sync_state.get(sync_key) or {}
+    if entry.get("uidvalidity") != uidvalidity:
+        entry = {}
+    retry_uids = dict(entry.get("retry_uids") or {})
+    attempts = retry_uids.pop(str(uid), 0) + 1
+    if failed and attempts < RENDER_MAX_ATTEMPTS:
+        retry_uids[str(uid)] = attempts
+    elif failed:
+        print(f"ERROR: Письмо с UID {uid} не удалось обработать за {attempts} попыток, больше оно не скачивается.")
+    # Повторно обработанное письмо старше последнего UID - прогресс назад не сдвигается
+    sync_state[sync_key] = {"uidvalidity": uidvalidity, "last_uid": max(uid, entry.get("last_uid") or 0)}
+    if retry_uids:
+        sync_state[sync_key]["retry_uids"] = retry_uids
+    temp_path = SYNC_STATE_FILE + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(sync_state, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, SYNC_STATE_FILE)
+
+
+def _sync_state_key(account, server, mailbox):
+    """Ключ состояния синхронизации: учетная запись, сервер и папка."""
+    return f"{account}@{server}/{mailbox}"
+
+
+def _get_last_processed_uid(sync_state, sync_key, uidvalidity):
+    """
+    Возвращает последний обработанный UID для ящика или None, если состояния нет
+    или сервер сменил UIDVALIDITY (старые UID больше недействительны).
+    """
+    entry = sync_state.get(sync_key)
+    if not entry:
+        return None
+    if entry.get("uidvalidity") != uidvalidity:
+        print("WARNING: UIDVALIDITY ящика изменился, сохраненное состояние синхронизации сброшено.")
+        return None
+    return entry.get("last_uid")
+
+
+def _compress_uid_set(uids):
+    """Сворачивает список UID в набор IMAP с диапазонами: [1, 2, 3, 7] -> '1:3,7'."""
+    numbers = sorted(int(u) for u in uids)
+    ranges = []
+    start = prev = numbers[0]
+    for n in numbers[1:]:
+        if n == prev + 1:
+            prev = n
+            continue
+        ranges.append(f"{start}:{prev}" if start != prev else str(start))
+        start = prev = n
+    ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(ranges)
+
+
+def _generate_pdf_and_save_originals(raw_email, unique_email_id):
+    """
+    Для одного письма: сохраняет оригинал письма (.eml) и вложения и создает PDF.
+    raw_email - сырые байты RFC822 или путь к файлу с письмом, скачанным по частям.
+    Возвращает пути к созданному PDF и папке с оригиналами, а также заголовки письма.
     """
     # --- Путь для PDF ---
     pdf_path = os.path.join(DOWNLOADED_PDF_DIR, f"{unique_email_id}.pdf")
     
     # --- Пути для оригиналов ---
     originals_folder_path = os.path.join(DOWNLOADED_ORIGINALS_DIR, unique_email_id)
-    os.makedirs(originals_folder_path, exist_ok=True)
-    
-    # Сохраняем все письмо как .eml файл
-    with open(os.path.join(originals_folder_path, "original_email.eml"), "wb") as f:
-        f.write(msg.as_bytes())
+
+    # Сохраняем письмо как .eml файл (байты как есть, без повторной сериализации) и вложения
+    msg, saved_attachment_paths = _save_email_originals(raw_email, originals_folder_path)
+    headers = _extract_email_headers(msg)
 
     # --- Создание PDF (логика из вашего кода) ---
     # Этот блок почти полностью взят из вашего скрипта, т.к. он отлично работает
@@ -177,66 +1125,284 @@ def _generate_pdf_and_save_originals(msg, unique_email_id, headers):
     # Вспомогательные переменные
     pdf_attachments_to_merge = []
     
-    # 1. Создаем "тело" письма в PDF
-    pdf_canvas, styles, _, page_dims, current_y = _setup_pdf_canvas_and_styles(pdf_path)
+    # 1. Создаем "тело" письма в PDF (в памяти: на диск записывается только итоговый файл)
+    body_pdf_buffer = BytesIO()
     body = _extract_email_body(msg)
-    display_date_str = datetime.datetime.now().strftime("%d.%m.%Y")
-    
-    # Добавляем заголовки в PDF
-    current_y = _add_paragraph_to_pdf_util(pdf_canvas, f"<b>Дата получения (факт):</b> {headers['formatted_date']}", styles['N'], current_y, page_dims)
-    current_y = _add_paragraph_to_pdf_util(pdf_canvas, f"<b>От:</b> {headers['sender']}", styles['N'], current_y, page_dims)
-    current_y = _add_paragraph_to_pdf_util(pdf_canvas, f"<b>Кому:</b> {headers['recipients']}", styles['N'], current_y, page_dims)
-    current_y = _add_paragraph_to_pdf_util(pdf_canvas, f"<b>Тема:</b> {headers['subject']}", styles['N'], current_y, page_dims)
-    current_y = _add_paragraph_to_pdf_util(pdf_canvas, "<b>Содержание:</b>", styles['N'], current_y, page_dims)
-    _add_paragraph_to_pdf_util(pdf_canvas, body if body.strip() else "Содержимое отсутствует.", styles['Body'], current_y, page_dims)
-    
-    pdf_canvas.save() # Сохраняем основной PDF
+    with measure_stage('pdf_layout') as timer:
+        pdf_canvas, styles, _, page_dims, current_y = _setup_pdf_canvas_and_styles(body_pdf_buffer)
+        display_date_str = datetime.datetime.now().strftime("%d.%m.%Y")
 
-    # 2. Обрабатываем вложения
-    for part in msg.walk():
-        if part.get_content_maintype() == 'multipart' or part.get('Content-Disposition') is None:
-            continue
+        # Добавляем заголовки в PDF
+        current_y = _add_paragraph_to_pdf_util(pdf_canvas, f"<b>Дата получения (факт):</b> {headers['formatted_date']}", styles['N'], current_y, page_dims)
+        current_y = _add_paragraph_to_pdf_util(pdf_canvas, f"<b>От:</b> {headers['sender']}", styles['N'], current_y, page_dims)
+        current_y = _add_paragraph_to_pdf_util(pdf_canvas, f"<b>Кому:</b> {headers['recipients']}", styles['N'], current_y, page_dims)
+        current_y = _add_paragraph_to_pdf_util(pdf_canvas, f"<b>Тема:</b> {headers['subject']}", styles['N'], current_y, page_dims)
+        current_y = _add_paragraph_to_pdf_util(pdf_canvas, "<b>Содержание:</b>", styles['N'], current_y, page_dims)
+        current_y = _add_body_text_to_pdf(pdf_canvas, body if body.strip() else "Содержимое отсутствует.", styles['Body'], current_y, page_dims)
+        image_paths = [path for path in saved_attachment_paths if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS]
+        if image_paths and PIL_AVAILABLE:
+            _add_images_to_pdf(pdf_canvas, originals_folder_path, image_paths, styles['N'], current_y, page_dims)
 
-        filename = part.get_filename()
-        if filename:
-            # Декодируем имя файла
-            decoded_fn = "".join([p.decode(c or 'utf-8', 'replace') if isinstance(p, bytes) else str(p) for p, c in decode_header(filename)])
-            sanitized_fn = sanitize_filename(decoded_fn)
-            filepath = os.path.join(originals_folder_path, sanitized_fn)
-            
-            # Сохраняем оригинальное вложение
-            with open(filepath, 'wb') as f:
-                f.write(part.get_payload(decode=True))
-            print(f"  -> Сохранен оригинал вложения: {sanitized_fn}")
-
-            # Пытаемся конвертировать в PDF для слияния
-            file_ext = os.path.splitext(sanitized_fn)[1].lower()
-            if file_ext == '.pdf':
-                pdf_attachments_to_merge.append(filepath)
-            elif WIN32COM_AVAILABLE and file_ext in CONVERTIBLE_EXTENSIONS:
-                pdf_converted_path = os.path.join(originals_folder_path, f"CONVERTED_{os.path.splitext(sanitized_fn)[0]}.pdf")
-                conv_func = None
-                if file_ext in ['.doc', '.docx', '.rtf', '.odt', '.txt']: conv_func = convert_document_to_pdf_msword
-                elif file_ext in ['.xls', '.xlsx', '.ods', '.xlsm']: conv_func = convert_spreadsheet_to_pdf_msexcel
-                elif file_ext in ['.ppt', '.pptx', '.odp']: conv_func = convert_presentation_to_pdf_msppt
-                
-                if conv_func and conv_func(filepath, pdf_converted_path):
-                    pdf_attachments_to_merge.append(pdf_converted_path)
+        pdf_canvas.save() # Завершаем основной PDF в буфере
+        timer.nbytes = body_pdf_buffer.tell()
+
+    # 2. Обрабатываем вложения (уже сохраненные на диск)
+    # Документы Office отправляются на конвертацию все сразу (LibreOffice конвертирует их параллельно),
+    # а порядок PDF для слияния сохраняется как в письме
+    attachments_in_order = [] # путь к PDF или (путь к будущему PDF, Future конвертации)
+    for filepath in saved_attachment_paths:
+        sanitized_fn = os.path.basename(filepath)
+
+        # Пытаемся конвертировать в PDF для слияния
+        file_ext = os.path.splitext(sanitized_fn)[1].lower()
+        if file_ext == '.pdf':
+            attachments_in_order.append(filepath)
+        elif OFFICE_CONVERTER_BACKEND and file_ext in CONVERTIBLE_EXTENSIONS:
+            pdf_converted_path = os.path.join(originals_folder_path, f"CONVERTED_{os.path.splitext(sanitized_fn)[0]}.pdf")
+            attachments_in_order.append((pdf_converted_path, submit_office_conversion(filepath, pdf_converted_path)))
+
+    for attachment in attachments_in_order:
+        if isinstance(attachment, str):
+            pdf_attachments_to_merge.append(attachment)
+            continue
+        # Этап конвертации - время ожидания результата (документы конвертируются параллельно)
+        with measure_stage('office_conversion'):
+            is_converted = attachment[1].result()
+        if is_converted:
+            pdf_attachments_to_merge.append(attachment[0])
+            count_event('conversions_ok')
+        else:
+            count_event('conversions_failed')
     
-    # 3. Объединяем основной PDF с PDF-вложениями
+    # 3. Объединяем основной PDF с PDF-вложениями и записываем результат на диск одним файлом
     if pdf_attachments_to_merge and PYPDF_AVAILABLE:
-        merged_pdf_path = os.path.join(DOWNLOADED_PDF_DIR, f"{unique_email_id}_merged.pdf")
-        all_pdfs = [pdf_path] + pdf_attachments_to_merge
-        if merge_pdfs(all_pdfs, merged_pdf_path):
-            os.remove(pdf_path) # Удаляем временный PDF без вложений
-            pdf_path = merged_pdf_path # Теперь основной PDF - это объединенный
+        body_pdf_buffer.seek(0)
+        with measure_stage('pdf_merge') as timer:
+            is_merged = merge_pdfs([body_pdf_buffer] + pdf_attachments_to_merge, pdf_path)
+            if is_merged:
+                timer.nbytes = os.path.getsize(pdf_path)
+        if not is_merged:
+            count_event('pdf_merge_errors')
+        else:
             print(f"  -> PDF-вложения успешно объединены в главный файл.")
+            return pdf_path, originals_folder_path, headers
+
+    # Вложений для объединения нет (или объединить не удалось) - сохраняем только тело письма
+    with open(pdf_path, 'wb') as f:
+        f.write(body_pdf_buffer.getvalue())
+    return pdf_path, originals_folder_path, headers
+
+
+def _save_email_originals(raw_email, originals_folder_path):
+    """
+    Сохраняет письмо в original_email.eml и все вложения в папку оригиналов.
+    Вложения хранятся в BLOB_STORE_DIR по хешу содержимого, а в папке письма появляются
+    жесткими ссылками на них; список вложений с хешами записывается в manifest.json.
+    Вложения в base64/quoted-printable декодируются по частям.
+    Письмо, скачанное по частям в файл, разбирается потоково: вложения не загружаются в память,
+    а в возвращаемом объекте письма остаются только заголовки и текстовые части.
+    Возвращает объект письма и список путей к сохраненным вложениям.
+    """
+    os.makedirs(originals_folder_path, exist_ok=True)
+    eml_path = os.path.join(originals_folder_path, "original_email.eml")
+    manifest_entries = []
+
+    if not isinstance(raw_email, bytes):
+        os.replace(raw_email, eml_path)
+        # При потоковом разборе в этот этап входят и декодирование, и запись вложений
+        with measure_stage('mime_parse', os.path.getsize(eml_path)), open(eml_path, 'rb') as f:
+            msg, _ = _parse_mime_part_streaming(f, [], originals_folder_path, manifest_entries)
+    else:
+        with measure_stage('eml_write', len(raw_email)), open(eml_path, "wb") as f:
+            f.write(raw_email)
+        with measure_stage('mime_parse', len(raw_email)):
+            msg = email.message_from_bytes(raw_email)
+
+        for part in msg.walk():
+            sanitized_fn = _get_attachment_filename(part)
+            if not sanitized_fn:
+                continue
+            with measure_stage('attachment_write') as timer:
+                # Сначала только считаем хеш: если такое вложение уже есть в хранилище, на диск ничего не пишем
+                hashing_writer = _HashingWriter()
+                _decode_part_payload(part, hashing_writer)
+                _store_attachment(hashing_writer, originals_folder_path, sanitized_fn, manifest_entries,
+                                  write_payload=lambda f, part=part: _decode_part_payload(part, f))
+                timer.nbytes = hashing_writer.size
+
+    with open(os.path.join(originals_folder_path, ORIGINALS_MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump({"attachments": manifest_entries}, f, ensure_ascii=False, indent=2)
+    return msg, [os.path.join(originals_folder_path, entry["filename"]) for entry in manifest_entries]
+
+
+def _decode_part_payload(part, out_file):
+    """Декодирует содержимое части письма в out_file (base64/quoted-printable - по частям)."""
+    encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+    if encoding in ('base64', 'quoted-printable'):
+        decoder = _TransferDecoder(encoding, out_file)
+        encoded_payload = part.get_payload()
+        for start in range(0, len(encoded_payload), IMAP_STREAM_CHUNK_BYTES):
+            decoder.feed(encoded_payload[start:start + IMAP_STREAM_CHUNK_BYTES].encode('ascii', 'surrogateescape'))
+        decoder.close()
+    else:
+        out_file.write(part.get_payload(decode=True) or b'')
 
-    return pdf_path, originals_folder_path
+
+def _get_attachment_filename(part):
+    """
+    Возвращает очищенное имя файла вложения или None, если часть письма не является вложением.
+    Встроенные картинки (cid:) без имени файла тоже сохраняются - под именем из Content-ID.
+    """
+    if part.get_content_maintype() == 'multipart':
+        return None
+    filename = part.get_filename() if part.get('Content-Disposition') is not None else None
+    if not filename and part.get_content_maintype() == 'image' and part.get('Content-ID'):
+        filename = part.get_param('name') or _inline_image_filename(part)
+    if not filename:
+        return None
+    # Декодируем имя файла
+    decoded_fn = "".join([p.decode(c or 'utf-8', 'replace') if isinstance(p, bytes) else str(p) for p, c in decode_header(filename)])
+    return sanitize_filename(decoded_fn)
+
+
+def _inline_image_filename(part):
+    """Имя файла для встроенной картинки без имени: Content-ID и расширение по типу картинки."""
+    content_id = str(part.get('Content-ID')).strip().strip('<>').split('@')[0] or "image"
+    file_ext = mimetypes.guess_extension(part.get_content_type()) or '.img'
+    return content_id if content_id.lower().endswith(file_ext) else content_id + file_ext
+
+
+class _TransferDecoder:
+    """
+    Потоковый декодер base64 / quoted-printable: данные подаются кусками любого размера,
+    декодированный результат сразу записывается в файл.
+    """
+
+    def __init__(self, encoding, out_file):
+        self.encoding = encoding
+        self.out_file = out_file
+        self.tail = b''
+
+    def feed(self, data):
+        if self.encoding == 'base64':
+            self.tail += data.translate(None, b' \t\r\n')
+            usable = len(self.tail) // 4 * 4
+            if usable:
+                self.out_file.write(binascii.a2b_base64(self.tail[:usable]))
+                self.tail = self.tail[usable:]
+        elif self.encoding == 'quoted-printable':
+            # Декодируем только целые строки, чтобы не разрезать последовательность '=XX'
+            self.tail += data
+            line_end = self.tail.rfind(b'\n')
+            if line_end >= 0:
+                self.out_file.write(binascii.a2b_qp(self.tail[:line_end + 1]))
+                self.tail = self.tail[line_end + 1:]
+        else:
+            self.out_file.write(data)
+
+    def close(self):
+        if not self.tail:
+            return
+        if self.encoding == 'base64':
+            try:
+                self.out_file.write(binascii.a2b_base64(self.tail + b'=' * (-len(self.tail) % 4)))
+            except binascii.Error:
+                pass # Обрезанный хвост base64 пропускаем, как и email.message.get_payload
+        else:
+            self.out_file.write(binascii.a2b_qp(self.tail))
+        self.tail = b''
+
+
+def _parse_mime_part_streaming(lines, boundaries, originals_folder_path, manifest_entries):
+    """
+    Потоковый разбор одной MIME-части из итератора строк файла письма.
+    Вложения сразу декодируются в хранилище вложений (с подсчетом хеша на лету) и связываются
+    с папкой оригиналов, текстовые части сохраняются в письме.
+    Возвращает (объект части, разделитель, на котором закончилась часть, или None в конце файла).
+    """
+    header_lines = []
+    for line in lines:
+        if line in (b'\r\n', b'\n'):
+            break
+        header_lines.append(line)
+    part = email.message_from_bytes(b''.join(header_lines))
+
+    if part.get_content_maintype() == 'multipart' and part.get_boundary():
+        boundary = part.get_boundary().encode('ascii', 'surrogateescape')
+        inner_boundaries = boundaries + [boundary]
+        part.set_payload([])
+        end = _skip_to_mime_boundary(lines, inner_boundaries) # Пропускаем преамбулу
+        while end == ('open', boundary):
+            subpart, end = _parse_mime_part_streaming(lines, inner_boundaries, originals_folder_path, manifest_entries)
+            part.attach(subpart)
+        if end == ('close', boundary):
+            end = _skip_to_mime_boundary(lines, boundaries) # Пропускаем эпилог
+        return part, end
+
+    sanitized_fn = _get_attachment_filename(part)
+    encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+    body_lines = []
+    out_file = None
+    if sanitized_fn:
+        # Хеш станет известен только после декодирования, поэтому пишем во временный файл хранилища
+        temp_path = _new_blob_temp_path()
+        out_file = open(temp_path, 'wb')
+        hashing_writer = _HashingWriter(out_file)
+        decoder = _TransferDecoder(encoding, hashing_writer)
+
+    end = None
+    pending_eol = b'' # Перевод строки перед разделителем относится к разделителю, а не к данным
+    try:
+        for line in lines:
+            end = _match_mime_boundary(line, boundaries)
+            if end:
+                break
+            content = line.rstrip(b'\r\n')
+            data = pending_eol + content
+            pending_eol = line[len(content):]
+            if out_file:
+                decoder.feed(data)
+            else:
+                body_lines.append(data)
+        if out_file:
+            decoder.close()
+    finally:
+        if out_file:
+            out_file.close()
+
+    if out_file:
+        _store_attachment(hashing_writer, originals_folder_path, sanitized_fn, manifest_entries, temp_path=temp_path)
+        part.set_payload('')
+    else:
+        part.set_payload(b''.join(body_lines).decode('ascii', 'surrogateescape'))
+    return part, end
+
+
+def _skip_to_mime_boundary(lines, boundaries):
+    """Пропускает строки до ближайшего разделителя из boundaries и возвращает его (или None в конце файла)."""
+    for line in lines:
+        end = _match_mime_boundary(line, boundaries)
+        if end:
+            return end
+    return None
+
+
+def _match_mime_boundary(line, boundaries):
+    """Проверяет, является ли строка разделителем MIME: ('open' | 'close', boundary) или None."""
+    if not line.startswith(b'--'):
+        return None
+    stripped = line.rstrip()
+    for boundary in reversed(boundaries):
+        if stripped == b'--' + boundary:
+            return ('open', boundary)
+        if stripped == b'--' + boundary + b'--':
+            return ('close', boundary)
+    return None
 
 #
 # --- БЛОК 2: ИНТЕРАКТИВНОЕ ПРИНЯТИЕ РЕШЕНИЙ ---
 # Пользователь просматривает скачанные PDF и решает их судьбу.
+# Письма, подходящие под правила из TRIAGE_RULES_FILE, обрабатываются автоматически.
 #
 
 def process_user_decisions(emails_metadata):
@@ -245,22 +1411,42 @@ def process_user_decisions(emails_metadata):
     открывает PDF для просмотра и запрашивает у пользователя решение.
     Возвращает отфильтрованный список писем, которые нужно сохранить.
     """
-    if not emails_metadata:
-        print("Не найдено писем для обработки.")
-        return []
+    return list(iter_user_decisions(emails_metadata))
 
-    emails_to_register = []
-    total_emails = len(emails_metadata)
-    
-    print(f"\n--- Начат этап принятия решений ({total_emails} писем) ---")
+
+def iter_user_decisions(emails_metadata):
+    """
+    Потоковый вариант этапа 2: принимает любой итерируемый объект с метаданными писем
+    (в том числе генератор этапа 1) и отдает письма, которые пользователь решил сохранить,
+    сразу после принятия решения.
+    """
+    # Для генератора общее число писем заранее неизвестно
+    total_emails = len(emails_metadata) if hasattr(emails_metadata, '__len__') else '?'
+    reviewed_count = 0
+    triage_rules = load_triage_rules()
 
     for i, email_data in enumerate(emails_metadata):
+        if i == 0:
+            print(f"\n--- Начат этап принятия решений ---")
+        reviewed_count += 1
         print(f"\n--- Обработка письма {i + 1}/{total_emails} ---")
         print(f"  От: {email_data['sender']}")
         print(f"  Тема: {email_data['subject']}")
 
         pdf_path = email_data["pdf_path"]
         originals_path = email_data["originals_path"]
+
+        # Сначала правила: вручную просматриваются только письма, не подошедшие ни под одно правило
+        rule = triage_rules.match(email_data) if triage_rules else None
+        if rule:
+            print(f"  -> Правило '{rule['name']}': {TRIAGE_ACTIONS[rule['action']]}.")
+            if rule['action'] == 'drop':
+                _delete_email_files(pdf_path, originals_path)
+                continue
+            if rule['action'] == 'keep_pdf_only':
+                _delete_email_originals(originals_path)
+            yield email_data
+            continue
         
         open_file_for_review(pdf_path)
         time.sleep(2) # Даем время на открытие файла
@@ -274,91 +1460,554 @@ def process_user_decisions(emails_metadata):
                     keep_originals_choice = input("  -> Сохранить папку с оригиналами этого письма? (да/нет): ").lower().strip()
                     if keep_originals_choice in ['да', 'д', 'yes', 'y']:
                         print(f"  -> PDF и папка с оригиналами '{os.path.basename(originals_path)}' сохранены.")
-                        emails_to_register.append(email_data)
+                        yield email_data
                         break
                     elif keep_originals_choice in ['нет', 'н', 'no', 'n']:
-                        try:
-                            shutil.rmtree(originals_path)
-                            print(f"  -> Папка с оригиналами '{os.path.basename(originals_path)}' удалена. PDF сохранен.")
-                        except Exception as e:
-                            print(f"  ERROR: Не удалось удалить папку с оригиналами: {e}")
-                        emails_to_register.append(email_data)
+                        _delete_email_originals(originals_path)
+                        yield email_data
                         break
                     else:
                         print("  ERROR: Неверный ввод. Пожалуйста, введите 'да' или 'нет'.")
                 break # Выход из основного цикла while
             
             elif choice == '2':
-                try:
-                    os.remove(pdf_path)
-                    shutil.rmtree(originals_path)
-                    print(f"  -> PDF и папка с оригиналами '{os.path.basename(originals_path)}' удалены.")
-                except Exception as e:
-                    print(f"  ERROR: Ошибка при удалении файлов: {e}")
+                _delete_email_files(pdf_path, originals_path)
                 break # Выход из основного цикла while
             else:
                 print("ERROR: Неверный выбор. Пожалуйста, введите 1 или 2.")
+
+    if reviewed_count == 0:
+        print("Не найдено писем для обработки.")
+
+
+def _delete_email_originals(originals_path):
+    """Удаляет папку с оригиналами письма (PDF остается)."""
+    try:
+        remove_email_originals(originals_path)
+        print(f"  -> Папка с оригиналами '{os.path.basename(originals_path)}' удалена. PDF сохранен.")
+    except Exception as e:
+        print(f"  ERROR: Не удалось удалить папку с оригиналами: {e}")
+
+
+def _delete_email_files(pdf_path, originals_path):
+    """Удаляет PDF письма и папку с его оригиналами."""
+    try:
+        os.remove(pdf_path)
+        remove_email_originals(originals_path)
+        print(f"  -> PDF и папка с оригиналами '{os.path.basename(originals_path)}' удалены.")
+    except Exception as e:
+        print(f"  ERROR: Ошибка при удалении файлов: {e}")
+
+
+# --- Автоматическая сортировка писем по правилам ---
+# Действия правил: сохранить письмо, сохранить только PDF (без оригиналов) или удалить
+TRIAGE_ACTIONS = {
+    'keep': "сохранить",
+    'keep_pdf_only': "сохранить PDF без оригиналов",
+    'drop': "удалить",
+}
+
+def load_triage_rules():
+    """
+    Загружает правила сортировки из TRIAGE_RULES_FILE (JSON). Возвращает TriageRules или None,
+    если файла нет. Пример файла:
+    [{"name": "Рассылки", "sender": "@news[.]example[.]ru>?$", "action": "drop"},
+     {"name": "Счета", "subject": "счет|invoice", "attachment": "[.]pdf$", "action": "keep"}]
+    sender, subject и attachment (имя любого вложения) - регулярные выражения без учета регистра;
+    заданные условия правила должны выполняться все сразу. Побеждает первое подходящее правило.
+    """
+    if not os.path.exists(TRIAGE_RULES_FILE):
+        return None
+    try:
+        with open(TRIAGE_RULES_FILE, 'r', encoding='utf-8') as f:
+            rules = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: Не удалось прочитать правила сортировки {TRIAGE_RULES_FILE}: {e}. Все письма - на ручной просмотр.")
+        return None
+    triage_rules = TriageRules(rules)
+    print(f"INFO: Загружено правил сортировки: {len(triage_rules.rules)}.")
+    return triage_rules
+
+
+class TriageRules:
+    """
+    Правила сортировки, скомпилированные один раз при загрузке. Каждое письмо проверяется
+    за один проход по списку правил: результат каждого шаблона для поля письма запоминается,
+    поэтому одинаковые шаблоны разных правил проверяются один раз, а список вложений
+    читается, только если до правила с условием на вложения дошла очередь.
+    Побеждает первое правило, у которого совпали все заданные поля.
+    """
+
+    FIELDS = ('sender', 'subject', 'attachment')
+
+    def __init__(self, rules):
+        self.rules = []
+        self._matchers = [] # для каждого правила: [(номер проверки, поле, скомпилированный шаблон)]
+        checks = {} # (поле, шаблон) -> номер проверки; одинаковые условия разных правил - одна проверка
+        for index, rule in enumerate(rules):
+            rule = dict(rule, name=rule.get('name') or f"правило {index + 1}")
+            if rule.get('action') not in TRIAGE_ACTIONS:
+                print(f"ERROR: Правило '{rule['name']}' пропущено: неизвестное действие {rule.get('action')!r}.")
+                continue
+            try:
+                # MULTILINE: ^ и $ в шаблоне вложения относятся к имени каждого вложения
+                matchers = [(checks.setdefault((field, rule[field]), len(checks)), field,
+                             re.compile(rule[field], re.IGNORECASE | re.MULTILINE))
+                            for field in self.FIELDS if rule.get(field)]
+            except re.error as e:
+                print(f"ERROR: Правило '{rule['name']}' пропущено: ошибка в шаблоне: {e}.")
+                continue
+            self.rules.append(rule)
+            self._matchers.append(matchers)
+        self._checks_count = len(checks)
+
+    def match(self, email_data):
+        """Возвращает первое правило, подходящее под письмо, или None."""
+        values = {
+            'sender': email_data['sender'],
+            'subject': email_data['subject'],
+        }
+        results = [None] * self._checks_count
+        for rule, matchers in zip(self.rules, self._matchers):
+            for check, field, pattern in matchers:
+                if results[check] is None:
+                    if field not in values:
+                        values[field] = self._attachment_names(email_data['originals_path'])
+                    results[check] = pattern.search(values[field]) is not None
+                if not results[check]:
+                    break
+            else:
+                return rule
+        return None
+
+    @staticmethod
+    def _attachment_names(originals_path):
+        """Имена вложений письма (по строке на вложение) из манифеста папки оригиналов."""
+        if not os.path.isdir(originals_path):
+            return ""
+        return "\n".join(entry["filename"] for entry in load_originals_manifest(originals_path))
+
+#
+# --- БЛОК 3: РЕГИСТРАЦИЯ И ФОРМИРОВАНИЕ ЖУРНАЛА ---
+# Финальный этап: переименование сохраненных PDF и запись в журнал.
+# Журнал хранится в SQLite (номера выдаются автоматически в транзакции),
+# а CSV-журнал дополняется теми же строками, что и раньше.
+#
+
+def register_saved_emails(emails_to_register):
+    """
+    Основная функция этапа 3. Присваивает письмам следующие входящие номера из журнала,
+    переименовывает сохраненные PDF и записывает их в журнал (SQLite и CSV).
+    Принимает список или генератор (тогда письма регистрируются по мере поступления).
+    """
+    emails_iter = iter(emails_to_register)
+    first_email = next(emails_iter, None)
+    if first_email is None:
+        print("\n--- Нет писем для регистрации. Завершение работы. ---")
+        return
+    emails_iter = itertools.chain([first_email], emails_iter)
     
-    return emails_to_register
+    print(f"\n--- Начат этап регистрации ---")
+    
+    registration_date = datetime.date.today()
+    date_str_for_filename = registration_date.strftime("%d.%m.%Y")
+    
+    # Проверяем, существует ли файл журнала, чтобы не перезаписывать заголовок
+    journal_exists = os.path.exists(JOURNAL_CSV_FILE)
+
+    try:
+        journal_db = open_journal_db()
+        archive_db = open_originals_archive() if ARCHIVE_ORIGINALS else None
+        with open(JOURNAL_CSV_FILE, 'a', newline='', encoding='utf-8-sig') as csvfile:
+            writer = csv.writer(csvfile)
+            
+            if not journal_exists:
+                writer.writerow(['Входящий номер', 'Дата регистрации', 'Отправитель', 'Тема письма'])
+            
+            for email_data in emails_iter:
+                old_filepath = email_data['pdf_path']
+                try:
+                    journal_num = _register_email_in_journal(journal_db, email_data, registration_date)
+                    new_filename = f"вх.№ {journal_num} от {date_str_for_filename}.pdf"
+                    _index_registered_email(journal_db, journal_num, email_data)
+                    if archive_db is not None:
+                        _archive_registered_originals(archive_db, email_data)
+                    
+                    # Дублируем запись в CSV-журнал
+                    writer.writerow([
+                        f"вх.№ {journal_num}",
+                        date_str_for_filename,
+                        email_data['sender'],
+                        email_data['subject']
+                    ])
+                    
+                    # Письма поступают постепенно, поэтому сразу сбрасываем запись на диск
+                    csvfile.flush()
+                    
+                    print(f"  -> Зарегистрирован: {new_filename}")
+                    
+                except Exception as e:
+                    print(f"  ERROR: Не удалось зарегистрировать файл '{os.path.basename(old_filepath)}': {e}")
+
+        journal_db.close()
+        if archive_db is not None:
+            archive_db.close()
+        print(f"\n--- Регистрация завершена. Журнал сохранен в: {JOURNAL_DB_FILE} и {JOURNAL_CSV_FILE} ---")
+        
+    except Exception as e:
+        print(f"CRITICAL: Ошибка при записи в журнал: {e}")
+
+
+def open_journal_db():
+    """
+    Открывает базу журнала регистрации, при необходимости создает таблицу и индексы.
+    Если база новая, а CSV-журнал уже есть, переносит в базу его записи, чтобы нумерация продолжилась.
+    """
+    journal_db = sqlite3.connect(JOURNAL_DB_FILE, isolation_level=None, timeout=30)
+    journal_db.execute("PRAGMA journal_mode=WAL")
+    journal_db.executescript("""
+        CREATE TABLE IF NOT EXISTS journal (
+            number INTEGER PRIMARY KEY,
+            registered_on TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            sender_address TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            pdf_path TEXT,
+            originals_path TEXT,
+            subject_key TEXT
+        );
+        CREATE INDEX IF NOT EXISTS journal_registered_on ON journal(registered_on);
+        CREATE INDEX IF NOT EXISTS journal_sender_address ON journal(sender_address);
+        CREATE TABLE IF NOT EXISTS journal_settings (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """)
+    _migrate_journal_subject_key(journal_db)
+    _create_search_index(journal_db)
+    if journal_db.execute("SELECT 1 FROM journal LIMIT 1").fetchone() is None and os.path.exists(JOURNAL_CSV_FILE):
+        _import_journal_csv(journal_db, JOURNAL_CSV_FILE)
+    return journal_db
+
+
+def _migrate_journal_subject_key(journal_db):
+    """
+    Тема для поиска без учета регистра: COLLATE NOCASE сравнивает без регистра только латиницу,
+    поэтому в subject_key хранится subject.casefold() (и для кириллицы), а индекс строится по нему.
+    В базах, созданных до появления столбца, он добавляется и заполняется.
+    """
+    columns = [row[1] for row in journal_db.execute("PRAGMA table_info(journal)")]
+    if 'subject_key' not in columns:
+        journal_db.execute("ALTER TABLE journal ADD COLUMN subject_key TEXT")
+    rows = journal_db.execute("SELECT number, subject FROM journal WHERE subject_key IS NULL").fetchall()
+    if rows:
+        journal_db.execute("BEGIN")
+        journal_db.executemany("UPDATE journal SET subject_key = ? WHERE number = ?",
+                               [(subject.casefold(), number) for number, subject in rows])
+        journal_db.execute("COMMIT")
+    journal_db.execute("DROP INDEX IF EXISTS journal_subject")
+    journal_db.execute("CREATE INDEX IF NOT EXISTS journal_subject_key ON journal(subject_key)")
+
+
+def _register_email_in_journal(journal_db, email_data, registration_date):
+    """
+    В одной транзакции выдает письму следующий входящий номер, переносит его PDF в папку
+    зарегистрированных и добавляет запись в журнал. При ошибке номер не расходуется.
+    Возвращает присвоенный номер.
+    """
+    _ensure_journal_start_number(journal_db)
+    journal_db.execute("BEGIN IMMEDIATE") # Блокирует запись, чтобы номер не выдали дважды
+    try:
+        journal_num = _next_journal_number(journal_db)
+        new_filename = f"вх.№ {journal_num} от {registration_date.strftime('%d.%m.%Y')}.pdf"
+        new_filepath = os.path.join(REGISTERED_DIR, new_filename)
+        journal_db.execute(
+            "INSERT INTO journal (number, registered_on, sender, sender_address, subject, pdf_path, originals_path, subject_key) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (journal_num, registration_date.isoformat(), email_data['sender'], _sender_address(email_data['sender']),
+             email_data['subject'], new_filepath, email_data.get('originals_path'), email_data['subject'].casefold()))
+        # Перемещаем и переименовываем PDF
+        shutil.move(email_data['pdf_path'], new_filepath)
+        journal_db.execute("COMMIT")
+    except Exception:
+        journal_db.execute("ROLLBACK")
+        raise
+    email_data['pdf_path'] = new_filepath
+    email_data['journal_number'] = journal_num
+    return journal_num
+
+
+def _ensure_journal_start_number(journal_db):
+    """
+    Для пустого журнала один раз запрашивает у пользователя последний номер и запоминает в базе.
+    Вопрос задается до блокировки записи (ответа можно ждать долго, а другие писатели ждут
+    блокировку не дольше 30 с); внутри транзакции проверяем, не записал ли номер кто-то другой.
+    """
+    if _stored_next_journal_number(journal_db) is not None:
+        return
+    start_next_num = prompt_for_starting_journal_number()
+    journal_db.execute("BEGIN IMMEDIATE")
+    try:
+        if _stored_next_journal_number(journal_db) is None:
+            journal_db.execute("INSERT INTO journal_settings (name, value) VALUES ('start_number', ?)", (str(start_next_num),))
+        else:
+            print("INFO: Начальный номер уже задан в другом окне программы, введенный номер не используется.")
+        journal_db.execute("COMMIT")
+    except Exception:
+        journal_db.execute("ROLLBACK")
+        raise
+
+
+def _stored_next_journal_number(journal_db):
+    """Следующий номер по записям журнала или сохраненному начальному номеру (None для нового журнала)."""
+    last_num = journal_db.execute("SELECT MAX(number) FROM journal").fetchone()[0]
+    if last_num is not None:
+        return last_num + 1
+    row = journal_db.execute("SELECT value FROM journal_settings WHERE name = 'start_number'").fetchone()
+    return int(row[0]) if row else None
+
+
+def _next_journal_number(journal_db):
+    """
+    Следующий свободный входящий номер (вызывается внутри транзакции регистрации, поэтому
+    пользователя не спрашивает - начальный номер задает _ensure_journal_start_number).
+    """
+    next_num = _stored_next_journal_number(journal_db)
+    if next_num is None:
+        raise RuntimeError("не задан начальный входящий номер журнала")
+    return next_num
+
+
+def _import_journal_csv(journal_db, csv_path):
+    """Переносит записи существующего CSV-журнала в пустую базу."""
+    imported = 0
+    with open(csv_path, 'r', newline='', encoding='utf-8-sig') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader, None) # Заголовок
+        journal_db.execute("BEGIN")
+        for row in reader:
+            number_match = re.search(r'(\d+)', row[0]) if row else None
+            if not number_match or len(row) < 4:
+                continue
+            try:
+                registered_on = datetime.datetime.strptime(row[1], "%d.%m.%Y").date().isoformat()
+            except ValueError:
+                registered_on = row[1]
+            journal_db.execute(
+                "INSERT OR IGNORE INTO journal (number, registered_on, sender, sender_address, subject, subject_key) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (int(number_match.group(1)), registered_on, row[2], _sender_address(row[2]), row[3], row[3].casefold()))
+            imported += 1
+        journal_db.execute("COMMIT")
+    print(f"INFO: В базу журнала перенесено {imported} записей из {csv_path}.")
+
+
+def _sender_address(sender):
+    """Адрес e-mail отправителя в нижнем регистре (для поиска по индексу)."""
+    return email.utils.parseaddr(sender)[1].lower() or sender.lower()
+
+
+def find_journal_entries(number=None, date_from=None, date_to=None, sender=None, subject=None, limit=100):
+    """
+    Поиск в журнале регистрации. Все условия необязательны и объединяются через И:
+    number - входящий номер; date_from/date_to - даты регистрации (datetime.date, включительно);
+    sender - адрес отправителя (точное совпадение) или часть имени/адреса;
+    subject - начало темы письма (без учета регистра).
+    Возвращает список словарей с полями журнала.
+    """
+    conditions, params = [], []
+    if number is not None:
+        conditions.append("number = ?"); params.append(number)
+    if date_from is not None:
+        conditions.append("registered_on >= ?"); params.append(date_from.isoformat())
+    if date_to is not None:
+        conditions.append("registered_on <= ?"); params.append(date_to.isoformat())
+    if sender:
+        if '@' in sender:
+            conditions.append("sender_address = ?"); params.append(sender.lower())
+        else:
+            conditions.append("sender LIKE ?"); params.append(f"%{sender}%")
+    if subject:
+        # Диапазон по индексу вместо LIKE: SQLite использует индекс journal_subject_key
+        subject_key = subject.casefold()
+        conditions.append("subject_key >= ? AND subject_key < ?")
+        params.extend([subject_key, subject_key + '\uffff'])
+    query = "SELECT number, registered_on, sender, subject, pdf_path, originals_path FROM journal"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY number DESC LIMIT ?"
+    params.append(limit)
+
+    journal_db = open_journal_db()
+    try:
+        columns = ['number', 'registered_on', 'sender', 'subject', 'pdf_path', 'originals_path']
+        return [dict(zip(columns, row)) for row in journal_db.execute(query, params)]
+    finally:
+        journal_db.close()
+
+
+def export_journal_to_csv(csv_path):
+    """Выгружает весь журнал из базы в CSV в прежнем формате."""
+    journal_db = open_journal_db()
+    try:
+        with open(csv_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['Входящий номер', 'Дата регистрации', 'Отправитель', 'Тема письма'])
+            for number, registered_on, sender, subject in journal_db.execute(
+                    "SELECT number, registered_on, sender, subject FROM journal ORDER BY number"):
+                try:
+                    date_str = datetime.date.fromisoformat(registered_on).strftime("%d.%m.%Y")
+                except ValueError:
+                    date_str = registered_on
+                writer.writerow([f"вх.№ {number}", date_str, sender, subject])
+    finally:
+        journal_db.close()
+    print(f"INFO: Журнал выгружен в {csv_path}.")
+
+
+# --- Полнотекстовый поиск по зарегистрированным письмам ---
+# Индекс SQLite FTS5 (таблица journal_fts в базе журнала): номер строки = входящий номер,
+# поля - тема, отправитель, текст письма и текст вложений. Письма добавляются в индекс
+# при регистрации, по одному, без перестроения индекса.
+_SEARCH_INDEX_AVAILABLE = None
+
+def _create_search_index(journal_db):
+    """Создает таблицу полнотекстового индекса; если SQLite собран без FTS5, поиск отключается."""
+    global _SEARCH_INDEX_AVAILABLE
+    try:
+        journal_db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS journal_fts USING fts5("
+            "subject, sender, body, attachments, tokenize='unicode61 remove_diacritics 2')")
+        _SEARCH_INDEX_AVAILABLE = True
+    except sqlite3.OperationalError as e:
+        if _SEARCH_INDEX_AVAILABLE is None:
+            print(f"ПРЕДУПРЕЖДЕНИЕ: SQLite без поддержки FTS5, полнотекстовый поиск недоступен: {e}")
+        _SEARCH_INDEX_AVAILABLE = False
 
-#
-# --- БЛОК 3: РЕГИСТРАЦИЯ И ФОРМИРОВАНИЕ ЖУРНАЛА ---
-# Финальный этап: переименование сохраненных PDF и создание CSV-журнала.
-#
 
-def register_saved_emails(emails_to_register):
+def _index_registered_email(journal_db, journal_num, email_data):
     """
-    Основная функция этапа 3. Запрашивает начальный номер, переименовывает
-    сохраненные PDF и создает/дополняет CSV-журнал.
+    Добавляет зарегистрированное письмо в полнотекстовый индекс: текст письма берется
+    из original_email.eml, текст вложений - из файлов в папке оригиналов. Если оригиналы
+    не сохранены (правило keep_pdf_only или ответ "нет"), индексируется текст итогового PDF.
+    Ошибка индексации не отменяет регистрацию.
     """
-    if not emails_to_register:
-        print("\n--- Нет писем для регистрации. Завершение работы. ---")
+    if not _SEARCH_INDEX_AVAILABLE:
         return
-    
-    print(f"\n--- Начат этап регистрации ({len(emails_to_register)} писем) ---")
-    
-    start_journal_num = prompt_for_starting_journal_number()
-    current_journal_num = start_journal_num
-    date_str_for_filename = datetime.datetime.now().strftime("%d.%m.%Y")
-    
-    # Проверяем, существует ли файл журнала, чтобы не перезаписывать заголовок
-    journal_exists = os.path.exists(JOURNAL_CSV_FILE)
-
     try:
-        with open(JOURNAL_CSV_FILE, 'a', newline='', encoding='utf-8-sig') as csvfile:
-            writer = csv.writer(csvfile)
-            
-            if not journal_exists:
-                writer.writerow(['Входящий номер', 'Дата регистрации', 'Отправитель', 'Тема письма'])
-            
-            for email_data in emails_to_register:
-                # Формируем новое имя файла
-                new_filename = f"вх.№ {current_journal_num} от {date_str_for_filename}.pdf"
-                old_filepath = email_data['pdf_path']
-                new_filepath = os.path.join(REGISTERED_DIR, new_filename)
-                
-                # Перемещаем и переименовываем PDF
-                try:
-                    shutil.move(old_filepath, new_filepath)
-                    
-                    # Записываем данные в журнал
-                    writer.writerow([
-                        f"вх.№ {current_journal_num}",
-                        date_str_for_filename,
-                        email_data['sender'],
-                        email_data['subject']
-                    ])
-                    
-                    print(f"  -> Зарегистрирован: {new_filename}")
-                    current_journal_num += 1
-                    
-                except Exception as e:
-                    print(f"  ERROR: Не удалось зарегистрировать файл '{os.path.basename(old_filepath)}': {e}")
+        body_text, attachments_text = _extract_originals_text(email_data.get('originals_path'), email_data.get('pdf_path'))
+        journal_db.execute(
+            "INSERT OR REPLACE INTO journal_fts (rowid, subject, sender, body, attachments) VALUES (?, ?, ?, ?, ?)",
+            (journal_num, _normalize_search_text(email_data['subject']), email_data['sender'],
+             _normalize_search_text(body_text), _normalize_search_text(attachments_text)))
+    except Exception as e:
+        print(f"  WARNING: Письмо вх.№ {journal_num} не добавлено в поисковый индекс: {e}")
 
-        print(f"\n--- Регистрация завершена. Журнал сохранен в: {JOURNAL_CSV_FILE} ---")
-        
+
+def _normalize_search_text(text):
+    """Токенизатор FTS5 не считает 'ё' и 'е' одной буквой - приводим к 'е' и текст, и запрос."""
+    return text.replace('ё', 'е').replace('Ё', 'Е')
+
+
+def _extract_originals_text(originals_path, pdf_path=None):
+    """
+    Возвращает (текст письма, текст вложений) из папки оригиналов письма. Если папки нет,
+    текстом письма считается текст PDF pdf_path (в нем уже есть письмо и вложения).
+    """
+    if not originals_path or not os.path.isdir(originals_path):
+        if pdf_path and os.path.exists(pdf_path):
+            return _extract_attachment_text(pdf_path, SEARCH_INDEX_MAX_CHARS), ""
+        return "", ""
+    body_text = ""
+    eml_path = os.path.join(originals_path, "original_email.eml")
+    # Очень большие письма (скачанные по частям) целиком в память не загружаем
+    if os.path.exists(eml_path) and os.path.getsize(eml_path) <= IMAP_LARGE_MESSAGE_BYTES:
+        with open(eml_path, 'rb') as f:
+            body_text = _extract_email_body(email.message_from_binary_file(f))[:SEARCH_INDEX_MAX_CHARS]
+
+    attachment_texts = []
+    for entry in load_originals_manifest(originals_path):
+        attachment_path = os.path.join(originals_path, entry["filename"])
+        # Для старых форматов (.doc, .xls) текст берется из PDF, полученного при конвертации
+        converted_path = os.path.join(originals_path, f"CONVERTED_{os.path.splitext(entry['filename'])[0]}.pdf")
+        text = _extract_attachment_text(attachment_path, SEARCH_INDEX_MAX_CHARS)
+        if not text and os.path.exists(converted_path):
+            text = _extract_attachment_text(converted_path, SEARCH_INDEX_MAX_CHARS)
+        attachment_texts.append(entry["filename"] + "\n" + text)
+    return body_text, "\n\n".join(attachment_texts)
+
+
+def _extract_attachment_text(path, max_chars):
+    """
+    Текст вложения для индекса: PDF (pypdf), обычный текст и HTML, документы Office Open XML
+    и OpenDocument (XML внутри zip). Для остальных форматов - пустая строка.
+    """
+    file_ext = os.path.splitext(path)[1].lower()
+    try:
+        if file_ext == '.pdf' and PYPDF_AVAILABLE:
+            from pypdf import PdfReader
+            texts, total = [], 0
+            with open(path, 'rb') as f:
+                for page in PdfReader(f).pages:
+                    page_text = page.extract_text() or ""
+                    texts.append(page_text)
+                    total += len(page_text)
+                    if total >= max_chars:
+                        break
+            return "\n".join(texts)[:max_chars]
+        if file_ext in ('.txt', '.csv', '.htm', '.html', '.xml'):
+            with open(path, 'rb') as f:
+                data = f.read(max_chars * 4)
+            try:
+                text = data.decode('utf-8')
+            except UnicodeDecodeError:
+                text = data.decode('cp1251', 'replace')
+            return (_html_to_text(text) if file_ext in ('.htm', '.html') else text)[:max_chars]
+        if file_ext in ('.docx', '.xlsx', '.xlsm', '.pptx', '.odt', '.ods', '.odp'):
+            import zipfile
+            with zipfile.ZipFile(path) as archive:
+                xml_names = [name for name in archive.namelist()
+                             if name in ('word/document.xml', 'xl/sharedStrings.xml', 'content.xml')
+                             or (name.startswith('ppt/slides/slide') and name.endswith('.xml'))]
+                texts = []
+                for name in xml_names:
+                    xml_text = archive.read(name).decode('utf-8', 'replace')
+                    texts.append(html.unescape(re.sub(r'<[^>]+>', ' ', xml_text)))
+                return re.sub(r'\s+', ' ', " ".join(texts))[:max_chars]
     except Exception as e:
-        print(f"CRITICAL: Ошибка при записи в CSV-журнал: {e}")
+        print(f"  WARNING: Не удалось извлечь текст вложения {os.path.basename(path)}: {e}")
+    return ""
+
+
+def search_registered_emails(query, limit=20):
+    """
+    Полнотекстовый поиск по зарегистрированным письмам (тема, отправитель, текст, вложения).
+    query - слова через пробел (ищутся письма со всеми словами, 'слово*' - по началу слова).
+    Возвращает список словарей: номер, дата, отправитель, тема, путь к PDF и фрагмент с совпадением.
+    """
+    terms = []
+    for word in _normalize_search_text(query).split():
+        is_prefix = word.endswith('*')
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ('*' if is_prefix else ''))
+    if not terms:
+        return []
+
+    journal_db = open_journal_db()
+    try:
+        if not _SEARCH_INDEX_AVAILABLE:
+            return []
+        rows = journal_db.execute(
+            "SELECT journal.number, journal.registered_on, journal.sender, journal.subject, journal.pdf_path, "
+            "snippet(journal_fts, -1, '[', ']', '...', 12) "
+            "FROM journal_fts JOIN journal ON journal.number = journal_fts.rowid "
+            "WHERE journal_fts MATCH ? ORDER BY rank LIMIT ?",
+            (" ".join(terms), limit))
+        columns = ['number', 'registered_on', 'sender', 'subject', 'pdf_path', 'snippet']
+        return [dict(zip(columns, row)) for row in rows]
+    finally:
+        journal_db.close()
 
 #
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ (взяты из вашего кода с минимальными изменениями) ---
@@ -372,6 +2021,10 @@ def setup_directories():
     os.makedirs(DOWNLOADED_PDF_DIR, exist_ok=True)
     os.makedirs(DOWNLOADED_ORIGINALS_DIR, exist_ok=True)
     os.makedirs(REGISTERED_DIR, exist_ok=True)
+    os.makedirs(BLOB_STORE_DIR, exist_ok=True)
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    if ARCHIVE_ORIGINALS:
+        os.makedirs(ORIGINALS_ARCHIVE_DIR, exist_ok=True)
     print("INFO: Папки готовы.")
 
 def open_file_for_review(filepath):
@@ -388,7 +2041,7 @@ def open_file_for_review(filepath):
         print(f"WARNING: Не удалось автоматически открыть файл. Пожалуйста, откройте его вручную. Ошибка: {e}")
 
 def prompt_for_starting_journal_number():
-    """Запрашивает у пользователя последний номер в журнале."""
+    """Запрашивает у пользователя последний номер в журнале (нужно только для пустого журнала)."""
     while True:
         try:
             last_num_str = input("Введите ПОСЛЕДНИЙ зарегистрированный номер входящего документа: ")
@@ -402,6 +2055,436 @@ def prompt_for_starting_journal_number():
         except ValueError:
             print("ERROR: Пожалуйста, введите корректное число.")
 
+# --- Метрики конвейера ---
+# Время и объем данных по этапам (скачивание, разбор MIME, HTML в текст, верстка PDF, подготовка
+# изображений - входит и в верстку, запись вложений, объединение PDF, конвертация Office) и счетчики
+# событий. Метрики письма собираются в потоке (и процессе пула), который его обрабатывает, и
+# возвращаются вместе с результатом; основной процесс суммирует их и пишет отчет METRICS_REPORT_FILE
+# и снимок METRICS_SNAPSHOT_FILE.
+# Пока PIPELINE_METRICS выключен, measure_stage возвращает общий пустой объект, а остальные
+# функции сразу выходят.
+_METRICS_LOCK = threading.Lock()
+_METRICS_TOTALS = {"stages": {}, "counters": {}}
+_METRICS_LOCAL = threading.local() # метрики письма, которое обрабатывает текущий поток
+_METRICS_RUN_ID = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+
+class _StageTimer:
+    """Замер одного этапа: with measure_stage('pdf_merge') as timer: ...; timer.nbytes = размер."""
+    __slots__ = ('stage', 'nbytes', 'started')
+
+    def __init__(self, stage, nbytes):
+        self.stage = stage
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        record_stage(self.stage, time.perf_counter() - self.started, self.nbytes)
+        return False
+
+class _NoStageTimer:
+    """Пустой замер при выключенных метриках (один общий объект)."""
+    __slots__ = ('nbytes',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
+_NO_STAGE_TIMER = _NoStageTimer()
+
+def measure_stage(stage, nbytes=0):
+    """Контекстный менеджер для замера времени этапа; объем данных можно задать сразу или через timer.nbytes."""
+    if not PIPELINE_METRICS:
+        return _NO_STAGE_TIMER
+    return _StageTimer(stage, nbytes)
+
+def record_stage(stage, seconds, nbytes=0):
+    """Добавляет замер этапа к метрикам текущего письма (или к общим итогам, если письма нет)."""
+    if not PIPELINE_METRICS:
+        return
+    email_metrics = getattr(_METRICS_LOCAL, 'email', None)
+    if email_metrics is not None:
+        _add_stage_sample(email_metrics["stages"], stage, seconds, nbytes)
+    else:
+        with _METRICS_LOCK:
+            _add_stage_sample(_METRICS_TOTALS["stages"], stage, seconds, nbytes)
+
+def count_event(name, amount=1):
+    """Увеличивает счетчик события (ошибки, конвертации, вложения и т.п.)."""
+    if not PIPELINE_METRICS:
+        return
+    email_metrics = getattr(_METRICS_LOCAL, 'email', None)
+    if email_metrics is not None:
+        email_metrics["counters"][name] = email_metrics["counters"].get(name, 0) + amount
+    else:
+        with _METRICS_LOCK:
+            _METRICS_TOTALS["counters"][name] = _METRICS_TOTALS["counters"].get(name, 0) + amount
+
+def _add_stage_sample(stages, stage, seconds, nbytes, calls=1):
+    entry = stages.get(stage)
+    if entry is None:
+        entry = stages[stage] = {"seconds": 0.0, "bytes": 0, "calls": 0}
+    entry["seconds"] += seconds
+    entry["bytes"] += nbytes
+    entry["calls"] += calls
+
+def begin_email_metrics():
+    """Начинает сбор метрик письма в текущем потоке."""
+    if PIPELINE_METRICS:
+        _METRICS_LOCAL.email = {"stages": {}, "counters": {}, "started": time.perf_counter()}
+
+def end_email_metrics():
+    """Заканчивает сбор метрик письма; возвращает словарь метрик (или None, если метрики выключены)."""
+    email_metrics = getattr(_METRICS_LOCAL, 'email', None)
+    _METRICS_LOCAL.email = None
+    if email_metrics is not None:
+        email_metrics["seconds"] = time.perf_counter() - email_metrics.pop("started")
+    return email_metrics
+
+def report_email_metrics(uid_str, email_metadata, email_metrics):
+    """В основном процессе: добавляет метрики письма к итогам и пишет строку письма в отчет."""
+    if not PIPELINE_METRICS:
+        return
+    is_ok = email_metadata is not None
+    with _METRICS_LOCK:
+        counters = _METRICS_TOTALS["counters"]
+        result_counter = 'emails_ok' if is_ok else 'emails_failed'
+        counters[result_counter] = counters.get(result_counter, 0) + 1
+        if email_metrics is None:
+            return # Процесс пула упал - кроме факта ошибки, данных нет
+        for stage, entry in email_metrics["stages"].items():
+            _add_stage_sample(_METRICS_TOTALS["stages"], stage, entry["seconds"], entry["bytes"], entry["calls"])
+        for name, amount in email_metrics["counters"].items():
+            counters[name] = counters.get(name, 0) + amount
+        _append_metrics_record({
+            "type": "email", "uid": uid_str, "ok": is_ok,
+            "unique_id": email_metadata["unique_id"] if is_ok else None,
+            "seconds": round(email_metrics["seconds"], 6),
+            "stages": email_metrics["stages"], "counters": email_metrics["counters"],
+        })
+
+def flush_metrics_report():
+    """Пишет строку с итогами в отчет и перезаписывает снимок метрик в формате Prometheus."""
+    if not PIPELINE_METRICS:
+        return
+    with _METRICS_LOCK:
+        _append_metrics_record({"type": "summary", "stages": _METRICS_TOTALS["stages"],
+                                "counters": _METRICS_TOTALS["counters"]})
+        lines = [
+            "# HELP email_pipeline_stage_seconds_total Время, затраченное на этап обработки писем.",
+            "# TYPE email_pipeline_stage_seconds_total counter",
+        ]
+        lines += [f'email_pipeline_stage_seconds_total{{stage="{stage}"}} {entry["seconds"]:.6f}'
+                  for stage, entry in sorted(_METRICS_TOTALS["stages"].items())]
+        lines += [
+            "# HELP email_pipeline_stage_bytes_total Объем данных, обработанных этапом.",
+            "# TYPE email_pipeline_stage_bytes_total counter",
+        ]
+        lines += [f'email_pipeline_stage_bytes_total{{stage="{stage}"}} {entry["bytes"]}'
+                  for stage, entry in sorted(_METRICS_TOTALS["stages"].items())]
+        lines += [
+            "# HELP email_pipeline_stage_calls_total Число выполнений этапа.",
+            "# TYPE email_pipeline_stage_calls_total counter",
+        ]
+        lines += [f'email_pipeline_stage_calls_total{{stage="{stage}"}} {entry["calls"]}'
+                  for stage, entry in sorted(_METRICS_TOTALS["stages"].items())]
+        lines += [
+            "# HELP email_pipeline_events_total Счетчики событий (письма, ошибки, конвертации, вложения).",
+            "# TYPE email_pipeline_events_total counter",
+        ]
+        lines += [f'email_pipeline_events_total{{event="{name}"}} {amount}'
+                  for name, amount in sorted(_METRICS_TOTALS["counters"].items())]
+        temp_path = METRICS_SNAPSHOT_FILE + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, METRICS_SNAPSHOT_FILE)
+
+def _append_metrics_record(record):
+    record = dict(record, run_id=_METRICS_RUN_ID, time=datetime.datetime.now().isoformat(timespec='seconds'))
+    with open(METRICS_REPORT_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+# --- Хранилище вложений по содержимому ---
+# Каждое уникальное вложение хранится один раз: BLOB_STORE_DIR/<первые 2 символа хеша>/<SHA-256>.
+# Папки писем ссылаются на него жесткими ссылками, поэтому число ссылок на файл в хранилище
+# (st_nlink - 1) - это число писем, использующих вложение (счетчик ссылок ведет файловая система,
+# что безопасно и для нескольких процессов пула).
+
+class _HashingWriter:
+    """Файлоподобный объект: считает SHA-256 и размер записанных данных и (если задан) пишет их в out_file."""
+
+    def __init__(self, out_file=None):
+        self.out_file = out_file
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        if self.out_file:
+            self.out_file.write(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+def _blob_path(digest):
+    """Путь к вложению в хранилище по его SHA-256 (папка создается при необходимости)."""
+    blob_dir = os.path.join(BLOB_STORE_DIR, digest[:2])
+    os.makedirs(blob_dir, exist_ok=True)
+    return os.path.join(blob_dir, digest)
+
+def _new_blob_temp_path():
+    """Уникальный временный файл в хранилище: после подсчета хеша он переименовывается в файл вложения."""
+    os.makedirs(BLOB_STORE_DIR, exist_ok=True)
+    return os.path.join(BLOB_STORE_DIR, f"tmp_{uuid.uuid4().hex}")
+
+def _store_attachment(hashing_writer, originals_folder_path, sanitized_fn, manifest_entries, write_payload=None, temp_path=None):
+    """
+    Кладет вложение в папку письма жесткой ссылкой на файл хранилища и добавляет его в манифест.
+    Если вложения с таким хешем в хранилище еще нет, оно создается из temp_path (уже декодированный
+    временный файл) или через write_payload(файл). Для дубликата на диск ничего не пишется.
+    """
+    blob_path = _blob_path(hashing_writer.hexdigest())
+    filepath = os.path.join(originals_folder_path, sanitized_fn)
+    if os.path.exists(filepath):
+        os.remove(filepath) # Вложение с тем же именем в этом же письме - как и раньше, побеждает последнее
+
+    # Несколько попыток: хранилище может удалить файл между созданием и ссылкой,
+    # если одновременно удаляется последнее письмо с тем же вложением
+    is_new_blob = False
+    for _ in range(3):
+        try:
+            os.link(blob_path, filepath)
+            break
+        except FileNotFoundError:
+            is_new_blob = True
+            if temp_path and os.path.exists(temp_path):
+                os.replace(temp_path, blob_path)
+            elif write_payload is None:
+                raise # Временный файл уже отдан хранилищу, а затем удален - данных больше нет
+            else:
+                new_temp_path = _new_blob_temp_path()
+                with open(new_temp_path, 'wb') as f:
+                    write_payload(f)
+                os.replace(new_temp_path, blob_path)
+        except OSError:
+            # Файловая система не поддерживает жесткие ссылки - храним копию (без экономии места)
+            shutil.copyfile(blob_path, filepath)
+            break
+    if temp_path and os.path.exists(temp_path):
+        os.remove(temp_path) # Такое вложение уже было в хранилище
+
+    manifest_entries[:] = [entry for entry in manifest_entries if entry["filename"] != sanitized_fn]
+    manifest_entries.append({"filename": sanitized_fn, "sha256": hashing_writer.hexdigest(), "size": hashing_writer.size})
+    count_event('attachments_stored' if is_new_blob else 'attachments_deduplicated')
+    print(f"  -> Сохранен оригинал вложения: {sanitized_fn}")
+
+def load_originals_manifest(originals_path):
+    """Список вложений письма из manifest.json его папки оригиналов (пустой, если манифеста нет)."""
+    manifest_path = os.path.join(originals_path, ORIGINALS_MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f).get("attachments", [])
+
+def remove_email_originals(originals_path):
+    """
+    Удаляет папку с оригиналами письма и освобождает его вложения в хранилище:
+    вложение удаляется из хранилища, когда на него больше не ссылается ни одно письмо.
+    """
+    manifest_entries = load_originals_manifest(originals_path)
+    shutil.rmtree(originals_path)
+    for entry in manifest_entries:
+        blob_path = os.path.join(BLOB_STORE_DIR, entry["sha256"][:2], entry["sha256"])
+        if os.path.exists(blob_path) and os.stat(blob_path).st_nlink <= 1:
+            os.remove(blob_path)
+
+# --- Архив оригиналов ---
+# Папки оригиналов зарегистрированных писем упаковываются в файлы-сегменты (один или несколько
+# в день, не больше ARCHIVE_SEGMENT_MAX_BYTES), в которые данные только дописываются.
+# Каждый файл письма сжимается отдельно (zlib), а индекс в SQLite хранит его сегмент, смещение
+# и размер, поэтому любой файл читается без распаковки сегмента. Одинаковые файлы (по SHA-256)
+# хранятся в архиве один раз.
+def open_originals_archive():
+    """Открывает (при необходимости создает) индекс архива оригиналов."""
+    os.makedirs(ORIGINALS_ARCHIVE_DIR, exist_ok=True)
+    archive_db = sqlite3.connect(ORIGINALS_ARCHIVE_INDEX_FILE, isolation_level=None, timeout=30)
+    archive_db.execute("PRAGMA journal_mode=WAL")
+    archive_db.executescript("""
+        CREATE TABLE IF NOT EXISTS archive_files (
+            email_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            segment TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            stored_size INTEGER NOT NULL,
+            compression TEXT NOT NULL,
+            PRIMARY KEY (email_id, filename)
+        );
+        CREATE INDEX IF NOT EXISTS archive_files_sha256 ON archive_files(sha256);
+    """)
+    return archive_db
+
+
+def _archive_registered_originals(archive_db, email_data):
+    """Упаковывает папку оригиналов зарегистрированного письма в архив; при ошибке папка остается."""
+    originals_path = email_data.get('originals_path')
+    if not originals_path or not os.path.isdir(originals_path):
+        return
+    try:
+        archive_email_originals(archive_db, originals_path)
+        print(f"  -> Оригиналы '{os.path.basename(originals_path)}' перенесены в архив.")
+    except Exception as e:
+        print(f"  WARNING: Не удалось поместить оригиналы '{os.path.basename(originals_path)}' в архив: {e}")
+
+
+def archive_email_originals(archive_db, originals_path):
+    """
+    Дописывает все файлы папки оригиналов в текущий сегмент архива, записывает их в индекс
+    и удаляет папку. Ключ письма в архиве - имя папки (уникальный идентификатор письма).
+    """
+    email_id = os.path.basename(os.path.normpath(originals_path))
+    manifest_hashes = {entry["filename"]: entry["sha256"] for entry in load_originals_manifest(originals_path)}
+    filenames = sorted(name for name in os.listdir(originals_path) if os.path.isfile(os.path.join(originals_path, name)))
+
+    archive_db.execute("BEGIN IMMEDIATE") # Один писатель: смещения в сегменте не должны пересекаться
+    try:
+        segment_name = _current_archive_segment()
+        segment_path = os.path.join(ORIGINALS_ARCHIVE_DIR, segment_name)
+        with open(segment_path, 'ab') as segment:
+            for filename in filenames:
+                file_path = os.path.join(originals_path, filename)
+                sha256 = manifest_hashes.get(filename) or _file_sha256(file_path)
+                stored = archive_db.execute(
+                    "SELECT segment, offset, stored_size, compression FROM archive_files WHERE sha256 = ? LIMIT 1",
+                    (sha256,)).fetchone()
+                if stored is None:
+                    offset = segment.tell()
+                    compression = _append_compressed_file(segment, file_path)
+                    stored = (segment_name, offset, segment.tell() - offset, compression)
+                archive_db.execute(
+                    "INSERT OR REPLACE INTO archive_files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (email_id, filename, sha256, os.path.getsize(file_path)) + tuple(stored))
+            segment.flush()
+            os.fsync(segment.fileno()) # Данные на диске раньше, чем индекс, который на них ссылается
+        archive_db.execute("COMMIT")
+    except Exception:
+        archive_db.execute("ROLLBACK")
+        raise
+    remove_email_originals(originals_path)
+
+
+def _current_archive_segment():
+    """Имя сегмента для записи: последний сегмент за сегодня, если он не превысил ARCHIVE_SEGMENT_MAX_BYTES."""
+    prefix = f"originals_{datetime.date.today().strftime('%Y%m%d')}_"
+    today_segments = sorted(name for name in os.listdir(ORIGINALS_ARCHIVE_DIR)
+                            if name.startswith(prefix) and name.endswith('.seg'))
+    if today_segments:
+        last_segment = today_segments[-1]
+        if os.path.getsize(os.path.join(ORIGINALS_ARCHIVE_DIR, last_segment)) < ARCHIVE_SEGMENT_MAX_BYTES:
+            return last_segment
+        return f"{prefix}{int(last_segment[len(prefix):-4]) + 1:03d}.seg"
+    return f"{prefix}001.seg"
+
+
+def _append_compressed_file(segment, file_path):
+    """
+    Дописывает файл в сегмент, сжимая его по частям. Если сжатие не уменьшило файл
+    (PDF, картинки, архивы), запись заменяется несжатой копией. Возвращает способ хранения.
+    """
+    start = segment.tell()
+    compressor = zlib.compressobj(6)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(IMAP_STREAM_CHUNK_BYTES), b''):
+            segment.write(compressor.compress(chunk))
+    segment.write(compressor.flush())
+    if segment.tell() - start < os.path.getsize(file_path):
+        return 'zlib'
+    segment.seek(start)
+    segment.truncate()
+    with open(file_path, 'rb') as f:
+        shutil.copyfileobj(f, segment, IMAP_STREAM_CHUNK_BYTES)
+    return 'none'
+
+
+def _file_sha256(file_path):
+    hashing_writer = _HashingWriter()
+    with open(file_path, 'rb') as f:
+        shutil.copyfileobj(f, hashing_writer, IMAP_STREAM_CHUNK_BYTES)
+    return hashing_writer.hexdigest()
+
+
+def list_archived_originals(email_id):
+    """Список файлов письма в архиве: [{'filename', 'size'}]. email_id - имя бывшей папки оригиналов."""
+    archive_db = open_originals_archive()
+    try:
+        rows = archive_db.execute(
+            "SELECT filename, size FROM archive_files WHERE email_id = ? ORDER BY filename", (email_id,))
+        return [{"filename": filename, "size": size} for filename, size in rows]
+    finally:
+        archive_db.close()
+
+
+def read_archived_original(email_id, filename, out_file):
+    """Записывает в out_file (открытый двоичный файл) один файл письма из архива, не распаковывая сегмент."""
+    archive_db = open_originals_archive()
+    try:
+        row = archive_db.execute(
+            "SELECT segment, offset, stored_size, compression FROM archive_files WHERE email_id = ? AND filename = ?",
+            (email_id, filename)).fetchone()
+    finally:
+        archive_db.close()
+    if row is None:
+        raise FileNotFoundError(f"В архиве нет файла '{filename}' письма {email_id}")
+    segment_name, offset, stored_size, compression = row
+    decompressor = zlib.decompressobj() if compression == 'zlib' else None
+    with open(os.path.join(ORIGINALS_ARCHIVE_DIR, segment_name), 'rb') as segment:
+        segment.seek(offset)
+        remaining = stored_size
+        while remaining > 0:
+            chunk = segment.read(min(IMAP_STREAM_CHUNK_BYTES, remaining))
+            if not chunk:
+                raise IOError(f"Сегмент архива {segment_name} поврежден (обрезан)")
+            remaining -= len(chunk)
+            out_file.write(decompressor.decompress(chunk) if decompressor else chunk)
+    if decompressor:
+        out_file.write(decompressor.flush())
+
+
+def extract_archived_email(email_id, destination_dir):
+    """Восстанавливает папку оригиналов письма из архива в destination_dir/email_id. Возвращает ее путь."""
+    folder = os.path.join(destination_dir, email_id)
+    os.makedirs(folder, exist_ok=True)
+    for entry in list_archived_originals(email_id):
+        with open(os.path.join(folder, entry["filename"]), 'wb') as f:
+            read_archived_original(email_id, entry["filename"], f)
+    return folder
+
+
+def archive_registered_originals():
+    """Переносит в архив папки оригиналов всех уже зарегистрированных писем (по журналу)."""
+    journal_db = open_journal_db()
+    try:
+        originals_paths = [row[0] for row in journal_db.execute(
+            "SELECT originals_path FROM journal WHERE originals_path IS NOT NULL ORDER BY number")]
+    finally:
+        journal_db.close()
+    archive_db = open_originals_archive()
+    archived = 0
+    try:
+        for originals_path in originals_paths:
+            if os.path.isdir(originals_path):
+                archive_email_originals(archive_db, originals_path)
+                archived += 1
+    finally:
+        archive_db.close()
+    print(f"INFO: В архив перенесены оригиналы {archived} писем.")
+
 def sanitize_filename(filename):
     """Очищает имя файла от недопустимых символов."""
     if not filename: return "untitled_attachment"
@@ -426,47 +2509,119 @@ def _extract_email_headers(msg):
     return headers
 
 def _extract_email_body(msg):
-    body = ""
-    if msg.is_multipart():
-        for part in msg.walk():
-            ctype = part.get_content_type()
-            cdispo = str(part.get('Content-Disposition'))
-            if ctype == 'text/plain' and 'attachment' not in cdispo:
-                body = part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8', 'replace')
-                break
-    else:
-        body = msg.get_payload(decode=True).decode(msg.get_content_charset() or 'utf-8', 'replace')
-    
-    if not body: # Если plain text не найден, пытаемся извлечь из HTML
-         for part in msg.walk():
-            if part.get_content_type() == 'text/html' and 'attachment' not in str(part.get('Content-Disposition')):
-                html_body = part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8', 'replace')
-                soup = BeautifulSoup(html_body, "html.parser")
-                body = soup.get_text(separator='\n')
-                break
+    """
+    Текст письма: text/plain, а если его нет - текст, извлеченный из text/html.
+    MIME-дерево обходится один раз (см. _scan_email_parts).
+    """
+    parts = _scan_email_parts(msg)
+    body = _decode_part_text(parts['plain']) if parts['plain'] else ""
+
+    if not body and parts['html']: # Если plain text не найден, пытаемся извлечь из HTML
+        body = _html_to_text(_decode_part_text(parts['html']))
+
+    if not body and not msg.is_multipart() and not parts['html']:
+        body = _decode_part_text(msg)
 
     return body
 
+def _scan_email_parts(msg):
+    """
+    Один проход по MIME-дереву письма. Возвращает словарь: первая часть text/plain ('plain')
+    и первая часть text/html ('html'). Вложения (Content-Disposition: attachment) пропускаются;
+    встроенные картинки сохраняются вместе с вложениями (см. _get_attachment_filename).
+    """
+    parts = {'plain': None, 'html': None}
+    for part in msg.walk():
+        if part.get_content_maintype() == 'multipart':
+            continue
+        cdispo = str(part.get('Content-Disposition'))
+        if 'attachment' in cdispo:
+            continue
+        ctype = part.get_content_type()
+        if ctype == 'text/plain' and parts['plain'] is None:
+            parts['plain'] = part
+        elif ctype == 'text/html' and parts['html'] is None:
+            parts['html'] = part
+    return parts
+
+def _decode_part_text(part):
+    """Декодирует текстовую часть письма в строку (неизвестная кодировка заменяется на utf-8)."""
+    payload = part.get_payload(decode=True) or b''
+    try:
+        return payload.decode(part.get_content_charset() or 'utf-8', 'replace')
+    except LookupError:
+        return payload.decode('utf-8', 'replace')
+
+def _html_to_text(html_body):
+    """
+    Текст из HTML с сохранением переносов строк, без содержимого script/style.
+    Быстрый путь - lxml; если lxml нет или документ он не разобрал - BeautifulSoup (html.parser).
+    """
+    with measure_stage('html_to_text', len(html_body)):
+        if LXML_AVAILABLE:
+            import lxml.html
+            import lxml.etree
+            try:
+                # Байты с явной кодировкой: строку с объявлением <?xml encoding?> (XHTML) lxml не принимает
+                root = lxml.html.document_fromstring(html_body.encode('utf-8', 'surrogatepass'),
+                                                     parser=lxml.html.HTMLParser(encoding='utf-8'))
+                # template, как и script/style, BeautifulSoup в текст не включает
+                lxml.etree.strip_elements(root, 'script', 'style', 'template', lxml.etree.Comment, with_tail=False)
+                return '\n'.join(root.itertext())
+            except (ValueError, lxml.etree.LxmlError):
+                pass
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(html_body, "html.parser")
+        return soup.get_text(separator='\n')
+
 # --- Функции для работы с PDF (из вашего кода) ---
-def _setup_pdf_canvas_and_styles(temp_report_path):
-    pdf_canvas = canvas.Canvas(temp_report_path, pagesize=A4)
+# Контекст отрисовки PDF (шрифты, стили, размеры страницы) создается один раз на процесс
+_PDF_RENDER_CONTEXT = None
+
+def get_pdf_render_context():
+    """
+    Возвращает контекст отрисовки PDF, общий для всех писем текущего процесса.
+    При первом вызове загружает reportlab, регистрирует шрифт (разбор TTF-файла) и создает стили;
+    каждый процесс пула создает свой контекст при обработке первого письма.
+    """
+    global _PDF_RENDER_CONTEXT
+    if _PDF_RENDER_CONTEXT is not None:
+        return _PDF_RENDER_CONTEXT
+
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
     width, height = A4
     margin = 20 * mm
     content_width = width - 2 * margin
     page_dims = {'width': width, 'height': height, 'margin': margin, 'content_width': content_width}
-    current_y = height - margin
     if os.path.exists(DEJAVU_SANS_FONT_PATH):
         pdfmetrics.registerFont(TTFont('DejaVuSans', DEJAVU_SANS_FONT_PATH))
         font_to_use = 'DejaVuSans'
     else:
         font_to_use = 'Helvetica'
-    styles_all = getSampleStyleSheet()
-    styleN = styles_all['Normal']; styleN.fontName = font_to_use; styleN.fontSize = 10
-    styleBody = styles_all['Normal']; styleBody.fontName = font_to_use; styleBody.fontSize = 9
+    # Отдельные стили на основе 'Normal', чтобы заголовки и тело письма не меняли друг друга
+    base_style = getSampleStyleSheet()['Normal']
+    styleN = ParagraphStyle('EmailHeader', parent=base_style, fontName=font_to_use, fontSize=10)
+    styleBody = ParagraphStyle('EmailBody', parent=base_style, fontName=font_to_use, fontSize=9)
     styles = {'N': styleN, 'Body': styleBody}
-    return pdf_canvas, styles, font_to_use, page_dims, current_y
+
+    _PDF_RENDER_CONTEXT = {'styles': styles, 'font': font_to_use, 'page_dims': page_dims}
+    return _PDF_RENDER_CONTEXT
+
+def _setup_pdf_canvas_and_styles(report_path_or_buffer):
+    from reportlab.pdfgen import canvas
+    render_context = get_pdf_render_context()
+    page_dims = render_context['page_dims']
+    pdf_canvas = canvas.Canvas(report_path_or_buffer, pagesize=(page_dims['width'], page_dims['height']))
+    current_y = page_dims['height'] - page_dims['margin']
+    return pdf_canvas, render_context['styles'], render_context['font'], page_dims, current_y
 
 def _add_paragraph_to_pdf_util(pdf_canvas, text, style, y_pos, page_dims):
+    from reportlab.platypus import Paragraph
     p = Paragraph(text.replace('\n', '<br/>'), style)
     p_w, p_h = p.wrapOn(pdf_canvas, page_dims['content_width'], page_dims['height'])
     if y_pos - p_h < page_dims['margin']:
@@ -476,26 +2631,199 @@ def _add_paragraph_to_pdf_util(pdf_canvas, text, style, y_pos, page_dims):
     p.drawOn(pdf_canvas, page_dims['margin'], y_pos - p_h)
     return y_pos - p_h
 
-def merge_pdfs(list_of_pdf_paths, output_merged_pdf_path):
+def _add_body_text_to_pdf(pdf_canvas, text, style, y_pos, page_dims):
+    """
+    Выводит текст письма любого размера: текст режется на абзацы не длиннее BODY_CHUNK_CHARS,
+    и каждый абзац переносится на следующие страницы по мере заполнения текущей.
+    Время и память растут линейно с размером текста.
+    """
+    from reportlab.platypus import Paragraph
+    for chunk in _iter_body_chunks(text, BODY_CHUNK_CHARS):
+        y_pos = _add_flowing_paragraph_to_pdf(pdf_canvas, Paragraph(chunk, style), y_pos, page_dims)
+    return y_pos
+
+def _iter_body_chunks(text, max_chars):
+    """
+    Генератор фрагментов разметки Paragraph из обычного текста: строки экранируются,
+    склеиваются через <br/>, а слишком длинные строки режутся на части по max_chars.
+    """
+    from xml.sax.saxutils import escape as xml_escape
+    lines, chunk_len = [], 0
+    for line in StringIO(text):
+        line = line.rstrip('\r\n')
+        for start in range(0, max(len(line), 1), max_chars):
+            piece = xml_escape(line[start:start + max_chars])
+            if lines and chunk_len + len(piece) > max_chars:
+                yield '<br/>'.join(lines)
+                lines, chunk_len = [], 0
+            lines.append(piece)
+            chunk_len += len(piece) + 5
+    if lines:
+        yield '<br/>'.join(lines)
+
+def _add_flowing_paragraph_to_pdf(pdf_canvas, paragraph, y_pos, page_dims):
+    """Рисует абзац с текущей позиции, разбивая его по страницам, если он не помещается."""
+    top_y = page_dims['height'] - page_dims['margin']
+    while True:
+        available_height = y_pos - page_dims['margin']
+        _, p_h = paragraph.wrap(page_dims['content_width'], available_height)
+        if p_h <= available_height:
+            paragraph.drawOn(pdf_canvas, page_dims['margin'], y_pos - p_h)
+            return y_pos - p_h
+
+        parts = paragraph.split(page_dims['content_width'], available_height)
+        if len(parts) < 2:
+            if y_pos == top_y:
+                # Не помещается даже на пустую страницу (одна огромная строка) - рисуем как есть
+                paragraph.drawOn(pdf_canvas, page_dims['margin'], y_pos - p_h)
+                return y_pos - p_h
+            # На остатке страницы не помещается ни одной строки - начинаем новую страницу
+        else:
+            first_part, paragraph = parts[0], parts[1]
+            _, first_h = first_part.wrap(page_dims['content_width'], available_height)
+            first_part.drawOn(pdf_canvas, page_dims['margin'], y_pos - first_h)
+        pdf_canvas.showPage()
+        y_pos = top_y
+
+def _add_images_to_pdf(pdf_canvas, originals_folder_path, image_paths, style, y_pos, page_dims):
+    """
+    Выводит изображения письма после текста: каждое - в свой размер, но не больше области
+    страницы, с новой страницы, если на текущей не помещается. Одинаковые картинки (по хешу)
+    выводятся один раз, всего не больше IMAGE_MAX_PER_EMAIL.
+    """
+    from reportlab.platypus import Image
+    hashes = {entry["filename"]: entry["sha256"] for entry in load_originals_manifest(originals_folder_path)}
+    top_y = page_dims['height'] - page_dims['margin']
+    max_height = top_y - page_dims['margin']
+    shown_hashes = set()
+    for image_path in image_paths:
+        sha256 = hashes.get(os.path.basename(image_path))
+        if sha256 in shown_hashes:
+            continue
+        if len(shown_hashes) >= IMAGE_MAX_PER_EMAIL:
+            y_pos = _add_paragraph_to_pdf_util(
+                pdf_canvas, f"<i>Показаны не все изображения письма (не больше {IMAGE_MAX_PER_EMAIL}), остальные - в оригиналах.</i>",
+                style, y_pos, page_dims)
+            break
+        prepared = get_prepared_image(image_path, sha256)
+        if prepared is None:
+            continue
+        prepared_path, width_px, height_px = prepared
+        shown_hashes.add(sha256)
+        # Размер на странице - по IMAGE_EMBED_DPI, но не больше области страницы
+        scale = min(72.0 / IMAGE_EMBED_DPI, page_dims['content_width'] / width_px, max_height / height_px)
+        width, height = width_px * scale, height_px * scale
+        if y_pos - height < page_dims['margin']:
+            pdf_canvas.showPage()
+            y_pos = top_y
+        Image(prepared_path, width=width, height=height).drawOn(pdf_canvas, page_dims['margin'], y_pos - height)
+        y_pos -= height + 6
+    return y_pos
+
+def get_prepared_image(image_path, sha256=None):
+    """
+    Изображение для вставки в PDF: повернутое по EXIF, уменьшенное до IMAGE_EMBED_DPI (при выводе
+    во всю область страницы) и пересжатое. Результат кэшируется в IMAGE_CACHE_DIR по хешу исходного
+    файла и параметрам, поэтому повторяющиеся логотипы и подписи обрабатываются один раз.
+    Возвращает (путь к подготовленному файлу, ширина, высота в пикселях) или None, если файл
+    не удалось прочитать как изображение или оно меньше IMAGE_MIN_SIZE_PX.
+    """
+    if sha256 is None:
+        sha256 = _file_sha256(image_path)
+    cache_key = f"{sha256}_{IMAGE_EMBED_DPI}_{IMAGE_JPEG_QUALITY}"
+    cache_dir = os.path.join(IMAGE_CACHE_DIR, sha256[:2])
+    for file_ext in ('.jpg', '.png', '.skip'):
+        cached_path = os.path.join(cache_dir, cache_key + file_ext)
+        if os.path.exists(cached_path):
+            count_event('images_cached')
+            return None if file_ext == '.skip' else _prepared_image_size(cached_path)
+
+    with measure_stage('image_prepare', os.path.getsize(image_path)) as timer:
+        prepared_path = _prepare_image(image_path, cache_dir, cache_key)
+        if prepared_path:
+            timer.nbytes = os.path.getsize(prepared_path)
+    count_event('images_prepared')
+    return _prepared_image_size(prepared_path) if prepared_path else None
+
+def _prepare_image(image_path, cache_dir, cache_key):
+    """Уменьшает и пересжимает изображение в кэш. Для неподходящих файлов кэширует пустую отметку '.skip'."""
+    from PIL import Image as PilImage, ImageOps
+    # Самый крупный нужный размер - вся область страницы при IMAGE_EMBED_DPI
+    page_dims = get_pdf_render_context()['page_dims']
+    max_size = (int(page_dims['content_width'] / 72 * IMAGE_EMBED_DPI),
+                int((page_dims['height'] - 2 * page_dims['margin']) / 72 * IMAGE_EMBED_DPI))
+    image = None
+    result_ext = '.skip'
+    try:
+        with PilImage.open(image_path) as source:
+            if min(source.size) >= IMAGE_MIN_SIZE_PX:
+                # Снимки с телефона часто хранятся повернутыми (флаг EXIF) - рамку поворачиваем так же,
+                # а само изображение поворачиваем уже уменьшенным
+                box = max_size[::-1] if source.getexif().get(0x0112, 1) in (5, 6, 7, 8) else max_size
+                # JPEG сразу декодируется уменьшенным в 2-8 раз - большие фотографии читаются быстро
+                source.draft('RGB', box)
+                has_alpha = source.mode in ('RGBA', 'LA', 'PA') or (source.mode == 'P' and 'transparency' in source.info)
+                image = source.convert('RGBA' if has_alpha else 'RGB')
+                image.thumbnail(box, PilImage.LANCZOS)
+                image = ImageOps.exif_transpose(image)
+                result_ext = '.png' if has_alpha else '.jpg'
+    except (OSError, ValueError, PilImage.DecompressionBombError) as e:
+        print(f"  WARNING: Изображение '{os.path.basename(image_path)}' не выведено в PDF: {e}")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cached_path = os.path.join(cache_dir, cache_key + result_ext)
+    temp_path = f"{cached_path}.{uuid.uuid4().hex}.tmp"
+    if image is None:
+        open(temp_path, 'wb').close()
+    elif result_ext == '.png':
+        image.save(temp_path, 'PNG', optimize=True)
+    else:
+        image.save(temp_path, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+    # Процессы пула могут готовить одну и ту же картинку одновременно - результат у них одинаковый
+    os.replace(temp_path, cached_path)
+    return cached_path if image is not None else None
+
+def _prepared_image_size(prepared_path):
+    from PIL import Image as PilImage
+    with PilImage.open(prepared_path) as image:
+        return prepared_path, image.size[0], image.size[1]
+
+def merge_pdfs(list_of_pdf_sources, output_merged_pdf_path):
+    """
+    Объединяет PDF (пути к файлам или буферы BytesIO) и записывает результат на диск один раз.
+    Файлы передаются pypdf открытыми, а не по пути: так pypdf читает из них только нужные
+    объекты страниц, а не загружает каждый файл в память целиком.
+    """
     if not PYPDF_AVAILABLE: return False
+    from pypdf import PdfWriter
     merger = PdfWriter()
+    opened_files = []
     try:
-        for pdf_path in list_of_pdf_paths:
-            if os.path.exists(pdf_path):
-                merger.append(pdf_path)
+        for pdf_source in list_of_pdf_sources:
+            if isinstance(pdf_source, str):
+                if not os.path.exists(pdf_source):
+                    continue
+                pdf_source = open(pdf_source, 'rb')
+                opened_files.append(pdf_source)
+            merger.append(pdf_source)
         with open(output_merged_pdf_path, "wb") as f_out:
             merger.write(f_out)
         return True
     except Exception as e:
         print(f"  ERROR: Ошибка при объединении PDF: {e}")
+        if os.path.exists(output_merged_pdf_path):
+            os.remove(output_merged_pdf_path) # Не оставляем недописанный файл
         return False
     finally:
         merger.close()
+        for f in opened_files:
+            f.close()
 
 # --- Функции конвертации MS Office (из вашего кода) ---
 if WIN32COM_AVAILABLE:
     def convert_document_to_pdf_msword(input_path, output_path):
         word = None; doc = None
+        import win32com.client
         try:
             word = win32com.client.Dispatch("Word.Application"); word.Visible = False
             doc = word.Documents.Open(os.path.abspath(input_path), ReadOnly=True)
@@ -509,6 +2837,7 @@ if WIN32COM_AVAILABLE:
 
     def convert_spreadsheet_to_pdf_msexcel(input_path, output_path):
         excel = None; workbook = None
+        import win32com.client
         try:
             excel = win32com.client.Dispatch("Excel.Application"); excel.Visible = False
             workbook = excel.Workbooks.Open(os.path.abspath(input_path), ReadOnly=True)
@@ -522,6 +2851,7 @@ if WIN32COM_AVAILABLE:
             
     def convert_presentation_to_pdf_msppt(input_path, output_path):
         powerpoint = None; presentation = None
+        import win32com.client
         try:
             powerpoint = win32com.client.Dispatch("PowerPoint.Application")
             presentation = powerpoint.Presentations.Open(os.path.abspath(input_path), ReadOnly=True, WithWindow=False)
@@ -533,18 +2863,323 @@ if WIN32COM_AVAILABLE:
             if presentation: presentation.Close()
             if powerpoint: powerpoint.Quit()
 
+# --- Выбор способа конвертации документов Office ---
+def submit_office_conversion(input_path, output_path):
+    """
+    Отправляет документ Office на конвертацию в PDF выбранным способом (OFFICE_CONVERTER_BACKEND).
+    Возвращает Future, результат которого - True при успешной конвертации.
+    MS Office конвертирует сразу (последовательно), LibreOffice - в пуле постоянных процессов.
+    """
+    if OFFICE_CONVERTER_BACKEND == 'libreoffice':
+        return get_libreoffice_pool().submit(input_path, output_path)
+
+    future = Future()
+    file_ext = os.path.splitext(input_path)[1].lower()
+    conv_func = None
+    if OFFICE_CONVERTER_BACKEND == 'win32com':
+        if file_ext in OFFICE_DOCUMENT_EXTENSIONS: conv_func = convert_document_to_pdf_msword
+        elif file_ext in OFFICE_SPREADSHEET_EXTENSIONS: conv_func = convert_spreadsheet_to_pdf_msexcel
+        elif file_ext in OFFICE_PRESENTATION_EXTENSIONS: conv_func = convert_presentation_to_pdf_msppt
+    future.set_result(bool(conv_func and conv_func(input_path, output_path)))
+    return future
+
+# --- Пул постоянных процессов LibreOffice ---
+# Каждый процесс LibreOffice запускается один раз (со своим профилем и портом) и принимает
+# задания через UNO; зависший или упавший процесс перезапускается.
+# Пул один на приложение и живет в основном процессе: процессы создания PDF отправляют ему
+# документы через OfficeConversionServer, поэтому всего запущено LIBREOFFICE_WORKERS экземпляров
+# LibreOffice, и документы всех писем стоят в одной очереди.
+_LIBREOFFICE_POOL = None
+_OFFICE_CONVERSION_SERVER = None
+# В процессе пула создания PDF: (адрес, ключ) OfficeConversionServer основного процесса
+_OFFICE_CONVERSION_ADDRESS = None
+_office_conversion_lock = threading.Lock()
+
+def get_libreoffice_pool():
+    """
+    Пул LibreOffice для текущего процесса: в основном процессе - сам пул (создается при первой
+    конвертации и закрывается при выходе), в процессе пула создания PDF - клиент общего пула.
+    """
+    global _LIBREOFFICE_POOL
+    with _office_conversion_lock:
+        if _LIBREOFFICE_POOL is None:
+            if _OFFICE_CONVERSION_ADDRESS:
+                _LIBREOFFICE_POOL = OfficeConversionClient(*_OFFICE_CONVERSION_ADDRESS)
+            else:
+                _LIBREOFFICE_POOL = LibreOfficeConverterPool(LIBREOFFICE_WORKERS, LIBREOFFICE_JOB_TIMEOUT)
+            multiprocessing.util.Finalize(_LIBREOFFICE_POOL, _LIBREOFFICE_POOL.shutdown, exitpriority=10)
+        return _LIBREOFFICE_POOL
+
+def get_office_conversion_server():
+    """Сервер заданий общего пула LibreOffice (в основном процессе); запускается при первом вызове."""
+    global _OFFICE_CONVERSION_SERVER
+    pool = get_libreoffice_pool()
+    with _office_conversion_lock:
+        if _OFFICE_CONVERSION_SERVER is None:
+            _OFFICE_CONVERSION_SERVER = OfficeConversionServer(pool)
+        return _OFFICE_CONVERSION_SERVER
+
+
+class OfficeConversionServer:
+    """
+    Принимает задания на конвертацию от процессов пула создания PDF (multiprocessing.connection
+    на localhost, с ключом) и ставит их в общий пул LibreOffice. Каждое соединение обслуживается
+    своим потоком: задание - пара путей, ответ - True/False после конвертации.
+    """
+
+    def __init__(self, pool):
+        from multiprocessing.connection import Listener
+        self.pool = pool
+        authkey = os.urandom(32)
+        self.listener = Listener(('127.0.0.1', 0), authkey=authkey)
+        self.address = (self.listener.address, authkey)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                return # Сервер закрыт
+            except Exception as e: # Соединение с неверным ключом
+                print(f"WARNING: Отклонено соединение с сервером конвертации: {e}")
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    input_path, output_path = conn.recv()
+                except (EOFError, OSError):
+                    return # Процесс пула завершился
+                conn.send(self.pool.submit(input_path, output_path).result())
+
+
+class OfficeConversionClient:
+    """
+    В процессе пула создания PDF: отправляет документы в общий пул LibreOffice основного процесса.
+    Документы одного письма отправляются параллельно (до LIBREOFFICE_WORKERS), у каждого потока
+    свое соединение с сервером.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, LIBREOFFICE_WORKERS))
+
+    def submit(self, input_path, output_path):
+        """Ставит документ в очередь общего пула; возвращает Future с результатом (True/False)."""
+        return self.executor.submit(self._convert, os.path.abspath(input_path), os.path.abspath(output_path))
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def _convert(self, input_path, output_path):
+        from multiprocessing.connection import Client
+        try:
+            if getattr(self.local, 'conn', None) is None:
+                self.local.conn = Client(self.address, authkey=self.authkey)
+            self.local.conn.send((input_path, output_path))
+            return self.local.conn.recv()
+        except (EOFError, OSError) as e:
+            print(f"  ERROR: Нет связи с пулом LibreOffice основного процесса: {e}")
+            self.local.conn = None
+            return False
+
+
+class LibreOfficeConverterPool:
+    """
+    Очередь заданий на конвертацию и набор потоков, каждый из которых владеет своим
+    процессом LibreOffice. Процессы запускаются при первом задании и живут до закрытия пула.
+    """
+
+    def __init__(self, size, job_timeout):
+        self.job_timeout = job_timeout
+        self.jobs = queue.Queue()
+        self.threads = [threading.Thread(target=self._worker_loop, daemon=True) for _ in range(max(1, size))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, input_path, output_path):
+        """Ставит документ в очередь; возвращает Future с результатом (True/False)."""
+        future = Future()
+        self.jobs.put((input_path, output_path, future))
+        return future
+
+    def shutdown(self):
+        """Останавливает потоки и завершает процессы LibreOffice."""
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join(timeout=self.job_timeout)
+
+    def _worker_loop(self):
+        worker = None
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    return
+                input_path, output_path, future = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if worker is None or not worker.is_alive():
+                    if worker:
+                        worker.stop()
+                    try:
+                        worker = LibreOfficeWorker()
+                    except Exception as e:
+                        print(f"  ERROR: Не удалось запустить LibreOffice: {e}")
+                        worker = None
+                        future.set_result(False)
+                        continue
+                future.set_result(self._run_job(worker, input_path, output_path))
+                if not worker.is_alive():
+                    worker.stop() # Упал или был остановлен по тайм-ауту - следующий запустится заново
+                    worker = None
+        finally:
+            if worker:
+                worker.stop()
+
+    def _run_job(self, worker, input_path, output_path):
+        # Если конвертация зависла, процесс LibreOffice убивается, и вызов UNO завершается ошибкой
+        watchdog = threading.Timer(self.job_timeout, worker.kill)
+        watchdog.start()
+        try:
+            worker.convert(input_path, output_path)
+            print(f"  -> Сконвертировано в PDF (LibreOffice): {os.path.basename(input_path)}")
+            return True
+        except Exception as e:
+            if not watchdog.is_alive():
+                print(f"  ERROR: Тайм-аут конвертации LibreOffice ({self.job_timeout} с): {os.path.basename(input_path)}")
+            else:
+                print(f"  ERROR: Ошибка конвертации LibreOffice: {e}")
+            return False
+        finally:
+            watchdog.cancel()
+
+
+class LibreOfficeWorker:
+    """Один постоянный процесс LibreOffice в режиме headless, управляемый через UNO."""
+
+    def __init__(self):
+        import uno
+        # Свой профиль для каждого процесса - иначе параллельные экземпляры LibreOffice мешают друг другу
+        self.profile_dir = tempfile.mkdtemp(prefix="lo_profile_")
+        self.port = _find_free_port()
+        uno_url = f"socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+        self.process = subprocess.Popen(
+            [LIBREOFFICE_PATH, '--headless', '--invisible', '--nologo', '--norestore', '--nodefault', '--nolockcheck',
+             f"-env:UserInstallation={uno.systemPathToFileUrl(self.profile_dir)}", f"--accept={uno_url}"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local_context)
+        deadline = time.monotonic() + LIBREOFFICE_START_TIMEOUT
+        while True:
+            try:
+                context = resolver.resolve(f"uno:{uno_url}")
+                break
+            except Exception:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError("LibreOffice не запустился")
+                time.sleep(0.2)
+        self.desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+
+    def convert(self, input_path, output_path):
+        import uno
+        from com.sun.star.beans import PropertyValue
+        file_ext = os.path.splitext(input_path)[1].lower()
+        if file_ext in OFFICE_SPREADSHEET_EXTENSIONS: filter_name = "calc_pdf_Export"
+        elif file_ext in OFFICE_PRESENTATION_EXTENSIONS: filter_name = "impress_pdf_Export"
+        else: filter_name = "writer_pdf_Export"
+        document = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(os.path.abspath(input_path)), "_blank", 0,
+            (PropertyValue(Name="Hidden", Value=True), PropertyValue(Name="ReadOnly", Value=True)))
+        if document is None:
+            raise RuntimeError("LibreOffice не смог открыть документ")
+        try:
+            document.storeToURL(uno.systemPathToFileUrl(os.path.abspath(output_path)),
+                                (PropertyValue(Name="FilterName", Value=filter_name),))
+        finally:
+            document.close(True)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.is_alive():
+            self.process.kill()
+
+    def stop(self):
+        try:
+            if self.is_alive():
+                self.desktop.terminate()
+                self.process.wait(timeout=10)
+        except Exception:
+            pass
+        self.kill()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+
+def _find_free_port():
+    """Свободный TCP-порт на localhost для UNO-соединения с LibreOffice."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
 #
 # --- ГЛАВНЫЙ БЛОК ИСПОЛНЕНИЯ ---
 #
 if __name__ == "__main__":
+    # Нужно для пула процессов в сборке PyInstaller
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description="Скачивание, просмотр и регистрация входящих писем.")
+    parser.add_argument('--daemon', action='store_true',
+                        help="режим службы: не завершаться, а ждать новые письма (IMAP IDLE) и обрабатывать их сразу")
+    parser.add_argument('--search', metavar='ТЕКСТ',
+                        help="найти зарегистрированные письма по тексту письма и вложений и завершить работу")
+    parser.add_argument('--check-mail', action='store_true',
+                        help="только проверить, есть ли новые письма, и завершить работу "
+                             "(код выхода 0 - есть новые письма, 1 - нет, 2 - ошибка)")
+    parser.add_argument('--archive-originals', action='store_true',
+                        help="перенести оригиналы всех зарегистрированных писем в сжатый архив и завершить работу")
+    args = parser.parse_args()
+
+    if args.check_mail:
+        new_mail_count = check_new_mail()
+        sys.exit(2 if new_mail_count is None else (0 if new_mail_count else 1))
+
+    if args.archive_originals:
+        archive_registered_originals()
+        sys.exit(0)
+
+    if args.search:
+        for hit in search_registered_emails(args.search):
+            print(f"вх.№ {hit['number']} от {hit['registered_on']} | {hit['sender']} | {hit['subject']}")
+            print(f"    {hit['snippet']}")
+            print(f"    {hit['pdf_path']}")
+        sys.exit(0)
+
     # 0. Создаем папки
     setup_directories()
+    print_dependency_report()
     
-    # 1. Этап скачивания
-    downloaded_emails = download_all_unseen_emails()
+    # Этапы связаны потоково: просмотр первого письма начинается, пока остальные
+    # еще скачиваются, а сохраненные письма регистрируются сразу после решения.
+    # 1. Этап скачивания (в фоновом потоке, не больше PIPELINE_QUEUE_SIZE писем в очереди).
+    # Прогресс скачивания сохраняется до просмотра, поэтому письма, не просмотренные
+    # в прерванном запуске, берутся из папки скачанных PDF и показываются первыми
+    unreviewed_emails = find_unreviewed_emails()
+    email_source = run_ingestion_daemon() if args.daemon else iter_downloaded_emails()
+    downloaded_emails = stream_in_background(itertools.chain(unreviewed_emails, email_source), PIPELINE_QUEUE_SIZE)
     
     # 2. Этап принятия решений
-    emails_for_registration = process_user_decisions(downloaded_emails)
+    emails_for_registration = iter_user_decisions(downloaded_emails)
     
     # 3. Этап регистрации
     register_saved_emails(emails_for_registration)
@@ -1,8 +1,12 @@
 # -*- mode: python ; coding: utf-8 -*-
+import os
 
+# PYINSTALLER_ONEDIR=1 - сборка в папку (dist/PythonApplication1/): запускается без распаковки
+# во временную папку при каждом старте, поэтому стартует быстрее однофайловой сборки.
+ONEDIR = os.getenv('PYINSTALLER_ONEDIR', '0') == '1'
 
 a = Analysis(
-    ['PythonApplication1.py'],
+    ['PythonApp2.py'],
     pathex=[],
     binaries=[],
     datas=[('DejaVuSans.ttf', '.')],
@@ -19,9 +23,9 @@ pyz = PYZ(a.pure)
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.datas,
+    *([] if ONEDIR else [a.binaries, a.datas]),
     [],
+    exclude_binaries=ONEDIR,
     name='PythonApplication1',
     debug=False,
     bootloader_ignore_signals=False,
@@ -36,3 +40,14 @@ exe = EXE(
     codesign_identity=None,
     entitlements_file=None,
 )
+
+if ONEDIR:
+    coll = COLLECT(
+        exe,
+        a.binaries,
+        a.datas,
+        strip=False,
+        upx=True,
+        upx_exclude=[],
+        name='PythonApplication1',
+    )
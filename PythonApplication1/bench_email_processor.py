@@ -0,0 +1,579 @@
+"""
+Бенчмарк обработки почты (PythonApp2.py) без реального почтового сервера.
+
+Создает синтетический набор писем (.eml) заданного размера, с нужной долей HTML-писем
+и набором вложений, раздает его встроенным IMAP-сервером на 127.0.0.1 и прогоняет
+скачивание и создание PDF (download_all_unseen_emails) без диалогов с пользователем.
+Печатает писем в секунду, МБ в секунду и пиковое потребление памяти (RSS).
+В режиме imap по умолчанию прогоняет оба способа скачивания (IMAP_FETCH_MODE single и batch)
+и печатает время каждого.
+
+Примеры:
+    python bench_email_processor.py --messages 500
+    python bench_email_processor.py --messages 100 --rtt-ms 20 --fetch-mode single
+    python bench_email_processor.py --messages 200 --html-ratio 0.8 --attachments pdf:0.5,docx:0.2 --rtt-ms 20
+    python bench_email_processor.py --mode render --json-out bench_results.jsonl
+    python bench_email_processor.py --mode render --workers 1 --messages 1 --attachments '' --body-kb 10240
+    python bench_email_processor.py --mode daemon --messages 20 [--no-idle --poll-interval 2]
+    python bench_email_processor.py --mode setup --messages 500
+"""
+import argparse
+import contextlib
+import datetime
+import imaplib
+import io
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from email.message import EmailMessage
+
+try:
+    import resource # Нет на Windows - там пиковая память не измеряется
+except ImportError:
+    resource = None
+
+# Слова для текста писем (кириллица, как в реальной почте)
+_WORDS = ("письмо договор счет оплата поставка акт сверки приложение срок документ просим "
+          "сообщить подтвердить направляем копию уважением отдел бухгалтерия заявка номер "
+          "invoice order report january delivery").split()
+
+# Типы вложений: расширение -> (тип MIME, подтип)
+_ATTACHMENT_TYPES = {
+    'pdf': ('application', 'pdf'),
+    'docx': ('application', 'vnd.openxmlformats-officedocument.wordprocessingml.document'),
+    'xlsx': ('application', 'vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'jpg': ('image', 'jpeg'),
+    'bin': ('application', 'octet-stream'),
+}
+
+
+# --- Синтетический набор писем ---
+def generate_corpus(count, seed=1, html_ratio=0.5, attachment_mix=None, body_words=400, attachment_kb=64, body_kb=None):
+    """
+    Создает count писем (сырые байты RFC822). html_ratio - доля писем только с HTML-телом,
+    attachment_mix - {расширение: вероятность наличия такого вложения в письме}.
+    body_kb - вместо тела из body_words слов текстовое тело такого размера из строк журнала
+    (как выгрузки логов и длинные пересланные переписки), для проверки верстки больших тел.
+    Один и тот же seed дает один и тот же набор писем.
+    """
+    rng = random.Random(seed)
+    attachment_mix = attachment_mix or {}
+    pdf_sample = _make_sample_pdf(max(1, attachment_kb // 8))
+    corpus = []
+    for i in range(count):
+        msg = EmailMessage()
+        msg['From'] = f"Отправитель {i % 37} <sender{i % 37}@example.ru>"
+        msg['To'] = "office@example.ru"
+        msg['Subject'] = f"Тестовое письмо {i}: " + " ".join(rng.choice(_WORDS) for _ in range(5))
+        msg['Date'] = "Mon, 15 Jan 2024 10:%02d:00 +0300" % (i % 60)
+        paragraphs = [" ".join(rng.choice(_WORDS) for _ in range(40)) for _ in range(max(1, body_words // 40))]
+        if body_kb:
+            msg.set_content(_make_log_body(rng, body_kb))
+        elif rng.random() < html_ratio:
+            html_body = "<html><head><style>p {margin: 0}</style></head><body>"
+            html_body += "".join(f"<p>{p}</p><table><tr><td>{i}</td><td>{p[:30]}</td></tr></table>" for p in paragraphs)
+            msg.set_content(html_body + "</body></html>", subtype='html')
+        else:
+            msg.set_content("\n\n".join(paragraphs))
+        for extension, probability in attachment_mix.items():
+            if rng.random() >= probability:
+                continue
+            maintype, subtype = _ATTACHMENT_TYPES.get(extension, ('application', 'octet-stream'))
+            if extension == 'pdf':
+                payload = pdf_sample
+            elif extension == 'jpg':
+                payload = _make_sample_photo(rng, attachment_kb)
+            else:
+                payload = rng.randbytes(attachment_kb * 1024)
+            msg.add_attachment(payload, maintype=maintype, subtype=subtype, filename=f"вложение_{i}.{extension}")
+        corpus.append(bytes(msg))
+    return corpus
+
+
+def _make_log_body(rng, body_kb):
+    """Текст из строк журнала размером около body_kb КБ (в UTF-8)."""
+    lines = []
+    size = 0
+    while size < body_kb * 1024:
+        line = (f"2024-01-15 10:{len(lines) // 60 % 60:02d}:{len(lines) % 60:02d} INFO [worker-{rng.randrange(8)}] "
+                + " ".join(rng.choice(_WORDS) for _ in range(rng.randrange(4, 16))) + f" <id={rng.randrange(10 ** 6)}> & ok")
+        lines.append(line)
+        size += len(line.encode('utf-8')) + 1
+    return "\n".join(lines)
+
+
+def _make_sample_pdf(pages):
+    """Небольшой PDF (reportlab) для вложений-PDF."""
+    from reportlab.pdfgen import canvas
+    buffer = io.BytesIO()
+    pdf_canvas = canvas.Canvas(buffer)
+    for page in range(pages):
+        pdf_canvas.drawString(100, 750, f"Attachment page {page + 1}")
+        pdf_canvas.showPage()
+    pdf_canvas.save()
+    return buffer.getvalue()
+
+
+def _make_sample_photo(rng, attachment_kb):
+    """JPEG, похожий на фотографию (плавный фон и шум), размером около attachment_kb: 3 МБ - примерно 6 Мпикс."""
+    from PIL import Image
+    pixels = attachment_kb * 1024 * 2 # Такой снимок в JPEG (качество 90) занимает около 0,5 байта на пиксель
+    width = max(64, int((pixels * 4 / 3) ** 0.5))
+    height = width * 3 // 4
+    tile = (width // 16 + 1, height // 16 + 1)
+    background = Image.frombytes('RGB', tile, rng.randbytes(tile[0] * tile[1] * 3)).resize((width, height), Image.BICUBIC)
+    noise = Image.frombytes('L', (width, height), rng.randbytes(width * height)).convert('RGB')
+    buffer = io.BytesIO()
+    Image.blend(background, noise, 0.2).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def parse_attachment_mix(text):
+    """'pdf:0.3,docx:0.1' -> {'pdf': 0.3, 'docx': 0.1}."""
+    mix = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        extension, _, probability = item.partition(':')
+        mix[extension.lower()] = float(probability or 1)
+    return mix
+
+
+# --- Встроенный IMAP-сервер ---
+class LocalImapServer:
+    """
+    Минимальный IMAP-сервер в отдельном потоке: одна папка с письмами corpus (UID = номер + 1).
+    Поддерживает команды, которые использует PythonApp2.py: CAPABILITY, LOGIN, SELECT, NOOP, IDLE,
+    UID SEARCH (UNSEEN, ALL, UID n:*), UID FETCH (RFC822, RFC822.SIZE, BODY.PEEK[]<n.m>),
+    UID STORE, LOGOUT. rtt_ms - задержка ответа на каждую команду (имитация сети);
+    ответ отсчитывается от получения команды, поэтому конвейер команд работает как с настоящим сервером.
+    Новые письма добавляются методом add_message: соединения в IDLE получают "* n EXISTS" сразу,
+    остальные - с ответом на следующую команду (как NOOP у настоящего сервера).
+    idle=False - сервер без IDLE (команда отклоняется), для проверки перехода на опрос.
+    """
+
+    def __init__(self, corpus, rtt_ms=0, idle=True):
+        self.corpus = list(corpus)
+        self.rtt = rtt_ms / 1000.0
+        self.idle = idle
+        self.capabilities = b'IMAP4rev1 IDLE' if idle else b'IMAP4rev1'
+        self.seen = set()
+        self.connections = 0 # Сколько раз клиенты подключались (переподключения службы видны здесь)
+        self.new_mail = threading.Condition()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+
+    def add_message(self, raw_email):
+        """Кладет новое письмо в папку (UID - следующий по порядку) и будит соединения в IDLE."""
+        with self.new_mail:
+            self.corpus.append(raw_email)
+            self.new_mail.notify_all()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return # Сервер закрыт
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        commands = queue.Queue()
+
+        def read_commands():
+            try:
+                for line in conn.makefile('rb'):
+                    commands.put((time.monotonic(), line))
+            except OSError:
+                pass # Клиент оборвал соединение
+            commands.put(None)
+
+        threading.Thread(target=read_commands, daemon=True).start()
+        conn.sendall(b'* OK [CAPABILITY ' + self.capabilities + b'] benchmark server ready\r\n')
+        known_count = len(self.corpus) # Сколько писем уже сообщено этому соединению
+        with conn:
+            while True:
+                item = commands.get()
+                if item is None:
+                    return
+                received_at, line = item
+                delay = received_at + self.rtt - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                tag, _, command = line.strip().partition(b' ')
+                if self.idle and command.upper() == b'IDLE':
+                    known_count = self._idle(conn, commands, known_count)
+                    if known_count is None:
+                        return
+                    conn.sendall(tag + b' OK IDLE terminated\r\n')
+                    continue
+                try:
+                    response = self._handle(command)
+                except Exception as e:
+                    response = b'', b'BAD ' + str(e).encode()
+                # Письма, пришедшие после прошлой команды, сообщаются вместе с ответом (как у настоящего сервера)
+                untagged = response[0]
+                if len(self.corpus) > known_count and not command.upper().startswith((b'SELECT', b'EXAMINE', b'LOGOUT')):
+                    untagged = b'* %d EXISTS\r\n' % len(self.corpus) + untagged
+                known_count = len(self.corpus)
+                conn.sendall(untagged + tag + b' ' + response[1] + b'\r\n')
+                if command.upper().startswith(b'LOGOUT'):
+                    return
+
+    def _idle(self, conn, commands, known_count):
+        """
+        Режим IDLE: сообщает "* n EXISTS" о каждом новом письме, пока клиент не пришлет DONE.
+        Возвращает число сообщенных писем или None, если клиент закрыл соединение.
+        """
+        conn.sendall(b'+ idling\r\n')
+        while True:
+            with self.new_mail:
+                if len(self.corpus) == known_count:
+                    self.new_mail.wait(0.05)
+                count = len(self.corpus)
+            if count > known_count:
+                known_count = count
+                conn.sendall(b'* %d EXISTS\r\n' % count)
+            try:
+                item = commands.get_nowait()
+            except queue.Empty:
+                continue
+            if item is None:
+                return None
+            if item[1].strip().upper() == b'DONE':
+                return known_count
+
+    def _handle(self, command):
+        """Возвращает (непомеченные ответы, итог команды)."""
+        upper = command.upper()
+        if upper.startswith(b'UID '):
+            command, upper = command[4:], upper[4:]
+        if upper.startswith(b'CAPABILITY'):
+            return b'* CAPABILITY ' + self.capabilities + b'\r\n', b'OK CAPABILITY completed'
+        if upper.startswith(b'LOGIN') or upper.startswith(b'NOOP'):
+            return b'', b'OK completed'
+        if upper.startswith(b'SELECT') or upper.startswith(b'EXAMINE'):
+            count = len(self.corpus)
+            untagged = b'* %d EXISTS\r\n* OK [UIDVALIDITY 1] UIDs valid\r\n* OK [UIDNEXT %d] next\r\n' % (count, count + 1)
+            return untagged, b'OK [READ-WRITE] SELECT completed'
+        if upper.startswith(b'SEARCH'):
+            return b'* SEARCH ' + b' '.join(str(uid).encode() for uid in self._search(upper)) + b'\r\n', b'OK SEARCH completed'
+        if upper.startswith(b'FETCH'):
+            return self._fetch(command), b'OK FETCH completed'
+        if upper.startswith(b'STORE'):
+            self.seen.update(self._uid_set(command.split()[1]))
+            return b'', b'OK STORE completed'
+        if upper.startswith(b'LOGOUT'):
+            return b'* BYE logging out\r\n', b'OK LOGOUT completed'
+        return b'', b'BAD unknown command'
+
+    def _search(self, criteria):
+        all_uids = range(1, len(self.corpus) + 1)
+        range_match = re.search(rb'UID (\d+):\*', criteria)
+        if range_match:
+            # Как настоящий сервер: 'N:*' включает последнее письмо, даже если его UID меньше N
+            return [uid for uid in all_uids if uid >= int(range_match.group(1))] or list(all_uids)[-1:]
+        if b'UNSEEN' in criteria:
+            return [uid for uid in all_uids if uid not in self.seen]
+        return list(all_uids)
+
+    def _uid_set(self, set_spec):
+        uids = []
+        for part in set_spec.decode().split(','):
+            first, _, last = part.partition(':')
+            last = len(self.corpus) if last == '*' else int(last or first)
+            uids.extend(range(int(first), last + 1))
+        return [uid for uid in uids if 1 <= uid <= len(self.corpus)]
+
+    def _fetch(self, command):
+        set_spec = command.split()[1]
+        partial = re.search(rb'BODY\.PEEK\[\]<(\d+)\.(\d+)>', command)
+        out = []
+        for uid in self._uid_set(set_spec):
+            message = self.corpus[uid - 1]
+            if b'RFC822.SIZE' in command.upper():
+                out.append(b'* %d FETCH (UID %d RFC822.SIZE %d)\r\n' % (uid, uid, len(message)))
+            elif partial:
+                offset, length = int(partial.group(1)), int(partial.group(2))
+                chunk = message[offset:offset + length]
+                out.append(b'* %d FETCH (UID %d BODY[]<%d> {%d}\r\n' % (uid, uid, offset, len(chunk)) + chunk + b')\r\n')
+            else:
+                self.seen.add(uid)
+                out.append(b'* %d FETCH (UID %d RFC822 {%d}\r\n' % (uid, uid, len(message)) + message + b')\r\n')
+        return b''.join(out)
+
+
+# --- Запуск бенчмарка ---
+def _peak_rss_mb():
+    """Пиковый RSS основного процесса и (завершенных) процессов пула, МБ; None, если измерить нельзя."""
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024 # ru_maxrss: байты на macOS, КБ на Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return round(own / 2 ** 20, 1), round(children / 2 ** 20, 1)
+
+
+def run_daemon_benchmark(app, corpus, rtt_ms, verbose, idle, interval):
+    """
+    Режим службы (run_ingestion_daemon): встроенный сервер начинает с пустой папки, письма набора
+    приходят по одному, следующее - через interval сек. после обработки предыдущего.
+    Если interval больше DAEMON_IDLE_TIMEOUT, ожидание IDLE успевает закончиться без писем.
+    Возвращает (число обработанных писем, время, сек., список задержек от прихода письма до его PDF, сек.,
+    число подключений к серверу).
+    """
+    server = LocalImapServer([], rtt_ms, idle=idle)
+    original_imap_ssl = imaplib.IMAP4_SSL
+    imaplib.IMAP4_SSL = lambda host, port=None, **kwargs: imaplib.IMAP4('127.0.0.1', server.port)
+    app.IMAP_SERVER, app.MAIL_RU_EMAIL, app.MAIL_RU_PASSWORD = '127.0.0.1', 'bench@example.ru', 'bench'
+    processed = queue.Queue()
+
+    def consume():
+        for email_metadata in app.run_ingestion_daemon():
+            processed.put(time.perf_counter())
+
+    latencies = []
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            # Служба не завершается сама - поток остается ждать писем до выхода из программы
+            threading.Thread(target=consume, daemon=True).start()
+            started = time.perf_counter()
+            for raw_email in corpus:
+                time.sleep(interval)
+                arrived_at = time.perf_counter()
+                server.add_message(raw_email)
+                try:
+                    latencies.append(processed.get(timeout=max(60, app.DAEMON_POLL_INTERVAL * 3)) - arrived_at)
+                except queue.Empty:
+                    break # Письмо не обработано - служба не работает, дальше ждать нечего
+            return len(latencies), time.perf_counter() - started, latencies, server.connections
+    finally:
+        imaplib.IMAP4_SSL = original_imap_ssl
+        server.close()
+
+
+def run_benchmark(app, corpus, mode, rtt_ms, verbose):
+    """
+    Прогоняет обработку набора писем в режиме 'imap' (встроенный сервер + download_all_unseen_emails)
+    или 'render' (только создание PDF, без IMAP). Возвращает (число обработанных писем, время, сек.).
+    """
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    if mode == 'render':
+        with output:
+            started = time.perf_counter()
+            rendered = [email_metadata for _, email_metadata in
+                        app._render_emails(((str(i + 1), raw) for i, raw in enumerate(corpus)), app.RENDER_WORKERS)]
+            return sum(1 for email_metadata in rendered if email_metadata), time.perf_counter() - started
+
+    server = LocalImapServer(corpus, rtt_ms)
+    original_imap_ssl = imaplib.IMAP4_SSL
+    # Приложение подключается по SSL; встроенный сервер работает без шифрования
+    imaplib.IMAP4_SSL = lambda host, port=None, **kwargs: imaplib.IMAP4('127.0.0.1', server.port)
+    app.IMAP_SERVER, app.MAIL_RU_EMAIL, app.MAIL_RU_PASSWORD = '127.0.0.1', 'bench@example.ru', 'bench'
+    try:
+        with output:
+            started = time.perf_counter()
+            downloaded = app.download_all_unseen_emails()
+            return len(downloaded), time.perf_counter() - started
+    finally:
+        imaplib.IMAP4_SSL = original_imap_ssl
+        server.close()
+
+
+def _old_setup_pdf_canvas_and_styles(app, report_buffer):
+    """Подготовка PDF письма до get_pdf_render_context: шрифт регистрируется и стили создаются для каждого письма."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+    pdf_canvas = canvas.Canvas(report_buffer, pagesize=A4)
+    width, height = A4
+    margin = 20 * mm
+    page_dims = {'width': width, 'height': height, 'margin': margin, 'content_width': width - 2 * margin}
+    if os.path.exists(app.DEJAVU_SANS_FONT_PATH):
+        pdfmetrics.registerFont(TTFont('DejaVuSans', app.DEJAVU_SANS_FONT_PATH))
+        font_to_use = 'DejaVuSans'
+    else:
+        font_to_use = 'Helvetica'
+    styles_all = getSampleStyleSheet()
+    styleN = styles_all['Normal']; styleN.fontName = font_to_use; styleN.fontSize = 10
+    styleBody = styles_all['Normal']; styleBody.fontName = font_to_use; styleBody.fontSize = 9
+    return pdf_canvas, {'N': styleN, 'Body': styleBody}, font_to_use, page_dims, height - margin
+
+
+def run_setup_benchmark(app, count):
+    """
+    Подготовка PDF (холст, шрифт, стили) для count писем: прежний способ (все заново для каждого письма)
+    против _setup_pdf_canvas_and_styles с контекстом get_pdf_render_context, который создается один раз
+    (первое письмо, как в новом процессе, включает его создание). Возвращает (сек. прежним способом, сек. новым).
+    """
+    started = time.perf_counter()
+    for _ in range(count):
+        _old_setup_pdf_canvas_and_styles(app, io.BytesIO())
+    old_seconds = time.perf_counter() - started
+
+    app._PDF_RENDER_CONTEXT = None
+    started = time.perf_counter()
+    for _ in range(count):
+        app._setup_pdf_canvas_and_styles(io.BytesIO())
+    return old_seconds, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк скачивания и обработки писем на синтетических данных.")
+    parser.add_argument('--messages', type=int, default=200, help="число писем в наборе")
+    parser.add_argument('--seed', type=int, default=1, help="зерно генератора (одинаковое зерно - одинаковый набор)")
+    parser.add_argument('--html-ratio', type=float, default=0.5, help="доля писем с HTML-телом (0..1)")
+    parser.add_argument('--body-words', type=int, default=400, help="примерное число слов в теле письма")
+    parser.add_argument('--body-kb', type=int, help="текстовое тело из строк журнала такого размера, КБ (вместо --body-words)")
+    parser.add_argument('--attachments', default='pdf:0.2,docx:0.1,jpg:0.2,bin:0.1',
+                        help="вложения: расширение:вероятность через запятую ('' - без вложений)")
+    parser.add_argument('--attachment-kb', type=int, default=64, help="размер вложения, КБ")
+    parser.add_argument('--mode', choices=['imap', 'render', 'daemon', 'setup'], default='imap',
+                        help="imap - скачивание со встроенного сервера и создание PDF, render - только создание PDF, "
+                             "daemon - режим службы: письма приходят по одному, измеряется задержка до их PDF, "
+                             "setup - подготовка PDF (шрифт, стили) на --messages писем: прежняя против общей на процесс")
+    parser.add_argument('--fetch-mode', choices=['single', 'batch', 'both'], default='both',
+                        help="режим imap: скачивание по одному письму, пакетами (IMAP_FETCH_MODE) или оба прогона подряд")
+    parser.add_argument('--font', help="режим setup: файл шрифта TTF (по умолчанию DejaVuSans.ttf из папки программы)")
+    parser.add_argument('--no-idle', action='store_true', help="режим daemon: сервер без IDLE (служба опрашивает ящик)")
+    parser.add_argument('--poll-interval', type=float, default=2,
+                        help="режим daemon: интервал опроса ящика без IDLE, сек. (DAEMON_POLL_INTERVAL)")
+    parser.add_argument('--idle-timeout', type=int,
+                        help="режим daemon: наибольшее ожидание в IDLE, сек. (DAEMON_IDLE_TIMEOUT); меньше "
+                             "--arrival-interval - проверка, что по тайм-ауту соединение не переоткрывается")
+    parser.add_argument('--arrival-interval', type=float, default=0.5,
+                        help="режим daemon: пауза между обработкой письма и приходом следующего, сек.")
+    parser.add_argument('--rtt-ms', type=float, default=0, help="задержка сети встроенного сервера, мс")
+    parser.add_argument('--workers', type=int, help="число процессов создания PDF (по умолчанию RENDER_WORKERS)")
+    parser.add_argument('--keep', action='store_true', help="не удалять рабочую папку с результатами")
+    parser.add_argument('--verbose', action='store_true', help="показывать вывод приложения")
+    parser.add_argument('--json-out', help="дописать результат строкой JSON в этот файл (для сравнения прогонов)")
+    args = parser.parse_args()
+
+    corpus, corpus_mb = [], 0.0
+    if args.mode != 'setup': # Подготовке PDF письма не нужны
+        corpus = generate_corpus(args.messages, args.seed, args.html_ratio, parse_attachment_mix(args.attachments),
+                                 args.body_words, args.attachment_kb, args.body_kb)
+        corpus_mb = sum(len(raw) for raw in corpus) / 2 ** 20
+        print(f"Набор: {len(corpus)} писем, {corpus_mb:.1f} МБ (seed={args.seed}).")
+
+    # Приложение создает папки email_processor в текущей папке - работаем во временной
+    work_dir = tempfile.mkdtemp(prefix="email_bench_")
+    json_out = os.path.abspath(args.json_out) if args.json_out else None
+    previous_dir = os.getcwd()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(work_dir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            import PythonApp2 as app
+            app.setup_directories()
+        # Конвертация Office зависит от установленных программ - в бенчмарке не участвует
+        app.OFFICE_CONVERTER_BACKEND = None
+        if args.workers:
+            app.RENDER_WORKERS = args.workers
+        latencies = connections = None
+        runs = [] # (способ скачивания, обработано писем, время)
+        if args.mode == 'setup':
+            # Программа ищет шрифт в текущей папке, а бенчмарк работает во временной - берем шрифт из папки программы
+            app.DEJAVU_SANS_FONT_PATH = args.font or os.path.join(os.path.dirname(os.path.abspath(__file__)), "DejaVuSans.ttf")
+            old_seconds, new_seconds = run_setup_benchmark(app, args.messages)
+        elif args.mode == 'daemon':
+            app.DAEMON_POLL_INTERVAL = args.poll_interval
+            if args.idle_timeout:
+                app.DAEMON_IDLE_TIMEOUT = args.idle_timeout
+            processed, elapsed, latencies, connections = run_daemon_benchmark(app, corpus, args.rtt_ms, args.verbose,
+                                                                 not args.no_idle, args.arrival_interval)
+            runs.append((None, processed, elapsed))
+        elif args.mode == 'imap':
+            for fetch_mode in (['single', 'batch'] if args.fetch_mode == 'both' else [args.fetch_mode]):
+                # У каждого прогона своя папка: иначе второй найдет состояние синхронизации первого и ничего не скачает
+                os.makedirs(fetch_mode)
+                os.chdir(fetch_mode)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    app.setup_directories()
+                app.IMAP_FETCH_MODE = fetch_mode
+                runs.append((fetch_mode,) + run_benchmark(app, corpus, args.mode, args.rtt_ms, args.verbose))
+                os.chdir(work_dir)
+        else:
+            runs.append((None,) + run_benchmark(app, corpus, args.mode, args.rtt_ms, args.verbose))
+    finally:
+        os.chdir(previous_dir)
+        if args.keep:
+            print(f"Результаты сохранены в {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.mode == 'setup':
+        font = app.get_pdf_render_context()['font']
+        result = {
+            "time": datetime.datetime.now().isoformat(timespec='seconds'), "mode": args.mode,
+            "messages": args.messages, "font": font,
+            "old_ms_per_email": round(old_seconds / args.messages * 1000, 3),
+            "new_ms_per_email": round(new_seconds / args.messages * 1000, 3),
+        }
+        print(f"Подготовка PDF ({font}), на письмо: прежняя {result['old_ms_per_email']} мс, "
+              f"общая на процесс {result['new_ms_per_email']} мс (x{old_seconds / new_seconds:.0f}).")
+        if json_out:
+            with open(json_out, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        return
+
+    peak_rss = _peak_rss_mb()
+    for fetch_mode, processed, elapsed in runs:
+        result = {
+            "time": datetime.datetime.now().isoformat(timespec='seconds'),
+            "mode": args.mode, "messages": len(corpus), "processed": processed, "corpus_mb": round(corpus_mb, 2),
+            "body_kb": args.body_kb,
+            "workers": app.RENDER_WORKERS, "rtt_ms": args.rtt_ms, "seconds": round(elapsed, 3),
+            "messages_per_sec": round(processed / elapsed, 2) if elapsed else None,
+            "mb_per_sec": round(corpus_mb / elapsed, 2) if elapsed else None,
+            "peak_rss_mb": peak_rss[0] if peak_rss else None,
+            "peak_rss_children_mb": peak_rss[1] if peak_rss else None,
+        }
+        if fetch_mode:
+            result["fetch_mode"] = fetch_mode
+        if latencies:
+            result.update(idle=not args.no_idle, latency_median_ms=round(statistics.median(latencies) * 1000, 1),
+                          latency_max_ms=round(max(latencies) * 1000, 1), idle_timeout=app.DAEMON_IDLE_TIMEOUT,
+                          connections=connections)
+        print(f"{f'Скачивание {fetch_mode}: ' if fetch_mode else ''}Обработано {processed}/{len(corpus)} писем "
+              f"за {elapsed:.2f} с ({result['messages_per_sec']} писем/с, {result['mb_per_sec']} МБ/с).")
+        if json_out:
+            with open(json_out, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    if len(runs) == 2 and runs[1][2]:
+        print(f"Пакетное скачивание быстрее поштучного в {runs[0][2] / runs[1][2]:.1f} раза.")
+    if latencies:
+        print(f"Задержка от прихода письма до PDF ({'IDLE' if not args.no_idle else 'опрос'}): "
+              f"медиана {result['latency_median_ms']} мс, максимум {result['latency_max_ms']} мс; "
+              f"подключений к серверу: {connections}.")
+    if peak_rss:
+        # Память считается за весь процесс - при двух прогонах это пик по обоим
+        print(f"Пиковая память (RSS): основной процесс {peak_rss[0]} МБ, процессы пула до {peak_rss[1]} МБ.")
+    if any(processed < len(corpus) for _, processed, _ in runs):
+        print("WARNING: Не все письма обработаны - запустите с --verbose, чтобы увидеть ошибки.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    # Нужно для пула процессов (Windows, PyInstaller)
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,175 @@
+"""
+Бенчмарк извлечения текста из HTML-писем (_html_to_text в PythonApp2.py): быстрый путь (lxml)
+против BeautifulSoup (html.parser) на одном и том же наборе писем.
+
+Для каждого письма берется HTML-часть (как в _extract_email_body), текст извлекается обоими
+способами несколько раз подряд; печатаются писем в секунду и МБ HTML в секунду для каждого способа
+и сравнение результатов: сколько писем дали одинаковый текст (без учета пробелов в начале и конце),
+сколько - одинаковый с точностью до пробелов, и разница для первых отличающихся писем.
+
+Набор писем - файлы .eml из папки (--eml-dir: настоящие рассылки, выгруженные из почты)
+или синтетические рассылки (таблицы верстки, встроенные стили, скрипты, условные комментарии).
+
+Примеры:
+    python bench_html_to_text.py
+    python bench_html_to_text.py --eml-dir saved_newsletters --repeat 5
+    python bench_html_to_text.py --messages 300 --json-out html_to_text.jsonl
+"""
+import argparse
+import contextlib
+import datetime
+import difflib
+import email
+import glob
+import io
+import json
+import os
+import random
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Слова для текста рассылок
+_WORDS = ("скидка акция заказ доставка бесплатно новинка подписка товар каталог цена сегодня только "
+          "выгодно клиент магазин sale offer new order free delivery").split()
+
+
+# --- Синтетический набор рассылок ---
+def generate_newsletters(count, seed=1):
+    """Создает count HTML-рассылок (сырые байты RFC822), похожих на маркетинговые письма."""
+    from email.message import EmailMessage
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(count):
+        words = lambda n: " ".join(rng.choice(_WORDS) for _ in range(n))
+        cards = "".join(
+            f'<td style="padding:10px;border:1px solid #eee" width="33%"><img src="cid:img{j}" width="180" alt="{words(2)}">'
+            f'<p style="font:14px Arial;color:#333;margin:0">{words(6)}</p><p><b>{rng.randrange(100, 9999)}&nbsp;&#8381;</b> '
+            f'<s>{rng.randrange(100, 9999)}</s></p><a href="https://shop.example.ru/p/{j}" style="color:#fff;background:#e33">Купить</a></td>'
+            + ('</tr><tr>' if j % 3 == 2 else '')
+            for j in range(rng.randrange(6, 30)))
+        html_body = (
+            '<!DOCTYPE html><html><head><meta charset="utf-8"><style>td {font-family: Arial} .hide {display:none}</style>'
+            f'<script>var track = "{rng.randrange(10 ** 9)}"; function t() {{ return track; }}</script></head>'
+            '<body style="margin:0"><!--[if mso]><table><tr><td><![endif]-->'
+            f'<div class="hide">{words(20)}</div><table width="600" align="center"><tr><td><h1>{words(4)}</h1>'
+            f'<p>{words(40)}<br>{words(30)}<br/>{words(10)} &amp; {words(3)} &lt;акция&gt;</p></td></tr>'
+            f'<tr>{cards}</tr><tr><td><ul>' + "".join(f"<li>{words(8)}</li>" for _ in range(rng.randrange(3, 10)))
+            + f'</ul><p style="font-size:11px">{words(60)} <a href="https://example.ru/unsubscribe">Отписаться</a></p></td></tr>'
+            '</table><!--[if mso]></td></tr></table><![endif]--><img src="https://t.example.ru/open.gif" width="1" height="1">'
+            '</body></html>')
+        msg = EmailMessage()
+        msg['From'] = f"Магазин {i % 11} <news{i % 11}@shop.example.ru>"
+        msg['To'] = "office@example.ru"
+        msg['Subject'] = f"Рассылка {i}: {words(4)}"
+        msg.set_content(html_body, subtype='html')
+        corpus.append(bytes(msg))
+    return corpus
+
+
+def load_eml_dir(eml_dir):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(eml_dir, "*.eml"))):
+        with open(path, 'rb') as f:
+            corpus.append(f.read())
+    return corpus
+
+
+# --- Запуск бенчмарка ---
+def extract_html_parts(app, corpus):
+    """HTML-части писем (строки), выбранные так же, как в _extract_email_body; письма без HTML пропускаются."""
+    html_bodies = []
+    for raw_email in corpus:
+        html_part = app._scan_email_parts(email.message_from_bytes(raw_email))['html']
+        if html_part is not None:
+            html_bodies.append(app._decode_part_text(html_part))
+    return html_bodies
+
+
+def time_engine(app, html_bodies, use_lxml, repeat):
+    """Извлекает текст всех писем выбранным способом repeat раз; возвращает (лучшее время, сек., тексты)."""
+    app.LXML_AVAILABLE = use_lxml
+    best = None
+    texts = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        texts = [app._html_to_text(html_body) for html_body in html_bodies]
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, texts
+
+
+def compare_texts(lxml_texts, bs4_texts, show_diffs):
+    """
+    Сравнивает результаты: (число одинаковых без учета пробелов в начале и конце, число одинаковых
+    без учета любых пробелов и переносов); печатает разницу для первых show_diffs отличающихся писем.
+    """
+    identical = same_words = 0
+    shown = 0
+    for number, (lxml_text, bs4_text) in enumerate(zip(lxml_texts, bs4_texts), start=1):
+        if lxml_text.strip() == bs4_text.strip():
+            identical += 1
+            same_words += 1
+            continue
+        if lxml_text.split() == bs4_text.split():
+            same_words += 1
+            continue
+        if shown < show_diffs:
+            shown += 1
+            print(f"\nПисьмо {number}: тексты различаются")
+            diff = difflib.unified_diff(bs4_text.split('\n'), lxml_text.split('\n'), 'BeautifulSoup', 'lxml', lineterm='', n=1)
+            for line in list(diff)[:20]:
+                print(f"    {line}")
+    return identical, same_words
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк извлечения текста из HTML-писем: lxml против BeautifulSoup.")
+    parser.add_argument('--eml-dir', help="папка с письмами .eml (по умолчанию - синтетические рассылки)")
+    parser.add_argument('--messages', type=int, default=100, help="число синтетических рассылок")
+    parser.add_argument('--seed', type=int, default=1, help="зерно генератора синтетических рассылок")
+    parser.add_argument('--repeat', type=int, default=3, help="число проходов по набору (берется лучшее время)")
+    parser.add_argument('--show-diffs', type=int, default=3, help="сколько различий в тексте показать")
+    parser.add_argument('--json-out', help="дописать результат строкой JSON в этот файл (для сравнения прогонов)")
+    args = parser.parse_args()
+
+    sys.path.insert(0, APP_DIR)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import PythonApp2 as app
+    if not app.LXML_AVAILABLE:
+        print("CRITICAL: Библиотека lxml не установлена - сравнивать не с чем.")
+        sys.exit(1)
+
+    corpus = load_eml_dir(args.eml_dir) if args.eml_dir else generate_newsletters(args.messages, args.seed)
+    html_bodies = extract_html_parts(app, corpus)
+    if not html_bodies:
+        print("CRITICAL: В наборе нет писем с HTML.")
+        sys.exit(1)
+    html_mb = sum(len(html_body.encode('utf-8')) for html_body in html_bodies) / 2 ** 20
+    print(f"Набор: {len(corpus)} писем, из них с HTML {len(html_bodies)} ({html_mb:.1f} МБ HTML).")
+
+    lxml_seconds, lxml_texts = time_engine(app, html_bodies, True, args.repeat)
+    bs4_seconds, bs4_texts = time_engine(app, html_bodies, False, args.repeat)
+    for name, seconds in (("lxml", lxml_seconds), ("BeautifulSoup", bs4_seconds)):
+        print(f"{name:<14} {len(html_bodies) / seconds:>8.1f} писем/с  {html_mb / seconds:>7.2f} МБ/с")
+    print(f"Ускорение: x{bs4_seconds / lxml_seconds:.1f}")
+
+    identical, same_words = compare_texts(lxml_texts, bs4_texts, args.show_diffs)
+    print(f"\nОдинаковый текст: {identical}/{len(html_bodies)}; "
+          f"одинаковый с точностью до пробелов и переносов: {same_words}/{len(html_bodies)}.")
+
+    if args.json_out:
+        result = {
+            "time": datetime.datetime.now().isoformat(timespec='seconds'),
+            "messages": len(html_bodies), "html_mb": round(html_mb, 2),
+            "lxml_messages_per_sec": round(len(html_bodies) / lxml_seconds, 1),
+            "bs4_messages_per_sec": round(len(html_bodies) / bs4_seconds, 1),
+            "identical": identical, "same_words": same_words,
+        }
+        with open(args.json_out, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
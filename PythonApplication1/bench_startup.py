@@ -0,0 +1,143 @@
+"""
+Бенчмарк времени запуска обработки почты (PythonApp2.py) из исходников и из сборки PyInstaller.
+
+Каждый сценарий запускается отдельным процессом несколько раз подряд, печатаются минимальное
+и медианное время до завершения процесса:
+    help        - запуск с --help: интерпретатор, импорт модуля и разбор аргументов;
+    check-mail  - быстрая проверка почты (--check-mail) без настроек почты: все, что
+                  выполняется до подключения к серверу.
+Для исходников дополнительно проверяется, что тяжелые библиотеки (reportlab, pypdf, bs4, lxml...)
+не загружаются при импорте, и измеряется, сколько стоит их загрузка при создании первого PDF.
+
+Примеры:
+    python bench_startup.py
+    python bench_startup.py --exe dist/PythonApplication1.exe --repeat 10
+    python bench_startup.py --exe dist/PythonApplication1/PythonApplication1.exe --json-out startup.jsonl
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_SCRIPT = os.path.join(APP_DIR, "PythonApp2.py")
+
+# Сценарий -> аргументы командной строки приложения
+SCENARIOS = {
+    'help': ['--help'],
+    'check-mail': ['--check-mail'],
+}
+
+# Библиотеки, которые должны загружаться только при создании PDF
+HEAVY_MODULES = ('reportlab', 'pypdf', 'bs4', 'lxml', 'PIL', 'asyncio', 'win32com', 'uno')
+
+# Импорт приложения и создание PDF одного письма в отдельном процессе (для исходников)
+_FIRST_PDF_PROBE = """
+import json, sys, time
+sys.path.insert(0, {app_dir!r})
+started = time.perf_counter()
+import PythonApp2 as app
+imported = time.perf_counter()
+heavy = sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy!r}))
+from bench_email_processor import generate_corpus
+raw_email = generate_corpus(1, html_ratio=1.0, attachment_mix={{'pdf': 1.0}})[0]
+app.setup_directories()
+app.OFFICE_CONVERTER_BACKEND = None
+before_pdf = time.perf_counter()
+app._process_downloaded_email(raw_email, '1')
+first_pdf = time.perf_counter()
+app._process_downloaded_email(raw_email, '2')
+second_pdf = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - started) * 1000, "heavy_modules_at_import": heavy,
+                  "first_pdf_ms": (first_pdf - before_pdf) * 1000, "next_pdf_ms": (second_pdf - first_pdf) * 1000}}))
+"""
+
+
+def _app_environment():
+    """Окружение процесса приложения: настройки почты пустые (пустые значения не заменяются из .env)."""
+    env = dict(os.environ)
+    env.update({'IMAP_SERVER': '', 'MAIL_RU_EMAIL': '', 'MAIL_RU_PASSWORD': '',
+                'MAIL_ACCOUNTS_FILE': os.path.join('email_processor', 'no_accounts.json'),
+                'PYTHONDONTWRITEBYTECODE': '1'})
+    return env
+
+
+def time_command(command, work_dir, repeat):
+    """Запускает команду repeat раз (плюс один прогрев) и возвращает список времен, сек."""
+    timings = []
+    for attempt in range(repeat + 1):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=work_dir, env=_app_environment(),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - started
+        if attempt: # Первый запуск - прогрев кэша файловой системы (и распаковки onefile-сборки)
+            timings.append(elapsed)
+    return timings
+
+
+def probe_first_pdf(work_dir):
+    """Время импорта, загруженные при импорте тяжелые библиотеки и стоимость первого PDF (исходники)."""
+    code = _FIRST_PDF_PROBE.format(app_dir=APP_DIR, heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', code], cwd=work_dir, env=_app_environment(),
+                            capture_output=True, text=True, encoding='utf-8')
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith('{'):
+            return json.loads(line)
+    print(f"WARNING: Не удалось измерить создание первого PDF:\n{result.stderr}")
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк времени запуска из исходников и из сборки PyInstaller.")
+    parser.add_argument('--exe', action='append', default=[],
+                        help="путь к собранному приложению (можно указать несколько раз: onefile и onedir)")
+    parser.add_argument('--no-source', action='store_true', help="не измерять запуск из исходников")
+    parser.add_argument('--repeat', type=int, default=5, help="число запусков каждого сценария")
+    parser.add_argument('--json-out', help="дописать результаты строками JSON в этот файл (для сравнения прогонов)")
+    args = parser.parse_args()
+
+    targets = [] if args.no_source else [("source", [sys.executable, APP_SCRIPT])]
+    targets += [(exe, [os.path.abspath(exe)]) for exe in args.exe]
+    if not targets:
+        parser.error("нечего измерять: укажите --exe или уберите --no-source")
+
+    json_out = os.path.abspath(args.json_out) if args.json_out else None
+    # Приложение создает папки email_processor в текущей папке - работаем во временной
+    work_dir = tempfile.mkdtemp(prefix="email_startup_")
+    results = []
+    try:
+        for target_name, command in targets:
+            for scenario, scenario_args in SCENARIOS.items():
+                timings = time_command(command + scenario_args, work_dir, args.repeat)
+                result = {"target": target_name, "scenario": scenario, "repeat": args.repeat,
+                          "min_ms": round(min(timings) * 1000, 1),
+                          "median_ms": round(statistics.median(timings) * 1000, 1)}
+                results.append(result)
+                print(f"{target_name:<30} {scenario:<12} мин. {result['min_ms']:>8.1f} мс   медиана {result['median_ms']:>8.1f} мс")
+
+        if not args.no_source:
+            probe = probe_first_pdf(work_dir)
+            if probe:
+                print(f"\nИмпорт PythonApp2: {probe['import_ms']:.1f} мс; первый PDF (с загрузкой библиотек): "
+                      f"{probe['first_pdf_ms']:.1f} мс; следующий PDF: {probe['next_pdf_ms']:.1f} мс.")
+                if probe['heavy_modules_at_import']:
+                    print(f"WARNING: При импорте загружаются тяжелые библиотеки: {', '.join(probe['heavy_modules_at_import'])}")
+                results.append(dict(probe, target="source", scenario="first-pdf"))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if json_out:
+        run_time = datetime.datetime.now().isoformat(timespec='seconds')
+        with open(json_out, 'a', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(dict(result, time=run_time), ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
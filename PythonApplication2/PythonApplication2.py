@@ -1,15 +1,26 @@
 ﻿# -*- coding: utf-8 -*-
 
 import os
+import re
 import time
 import csv
+import json
+import random
+import argparse
+import threading
+import uuid
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+from urllib.parse import urljoin, urldefrag, urlsplit
+import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 # --- LOAD CONFIGURATION ---
 # Load variables from the .env file (where login and password are stored)
@@ -26,8 +37,54 @@ LOGIN_URL = "https://lepolek.pl/logowanie"
 # Path to your chromedriver.exe.
 DRIVER_PATH = ""
 
-# Output filename for the results
-OUTPUT_FILE = "scraped_data_auto.csv"
+# Output filename for the results (.csv, or .parquet for a folder of Parquet files - needs pyarrow).
+# Rows are appended as pages are scraped; rows already in the file (same drug_name and active_substance) are skipped
+OUTPUT_FILE = os.getenv("SCRAPER_OUTPUT_FILE", "scraped_data_auto.csv")
+# Rows are written to the output in batches of this size; the checkpoint is updated after each batch
+OUTPUT_BATCH_SIZE = int(os.getenv("SCRAPER_OUTPUT_BATCH_SIZE", "200"))
+
+# How data pages are fetched:
+#   "http"    - Selenium is used only to log in; its session cookies are handed to a pooled
+#               keep-alive HTTP client, which downloads data pages directly (much faster, no browser
+#               per page). Pages whose items are not in the HTML (rendered by JavaScript) fall back to the browser.
+#   "browser" - every page is opened in Chrome (the old mode)
+FETCH_MODE = os.getenv("SCRAPER_FETCH_MODE", "http")
+# Maximum number of keep-alive connections per host in the HTTP client
+HTTP_POOL_SIZE = int(os.getenv("SCRAPER_HTTP_POOL_SIZE", "8"))
+# Timeout of one HTTP request (seconds)
+HTTP_TIMEOUT = int(os.getenv("SCRAPER_HTTP_TIMEOUT", "30"))
+
+# --- CRAWL SETTINGS (--urls / --seed) ---
+# Number of pages downloaded at the same time (keep it within SCRAPER_HTTP_POOL_SIZE)
+CRAWL_WORKERS = int(os.getenv("SCRAPER_CRAWL_WORKERS", "4"))
+# Maximum requests per second to one host
+CRAWL_RATE_PER_HOST = float(os.getenv("SCRAPER_CRAWL_RATE_PER_HOST", "2"))
+# How many times a failed page is retried (network errors, 429 and 5xx), with a growing pause
+CRAWL_MAX_RETRIES = int(os.getenv("SCRAPER_CRAWL_MAX_RETRIES", "3"))
+CRAWL_BACKOFF_SECONDS = float(os.getenv("SCRAPER_CRAWL_BACKOFF_SECONDS", "1"))
+# Stop after this many pages (protection against endless pagination)
+CRAWL_MAX_PAGES = int(os.getenv("SCRAPER_CRAWL_MAX_PAGES", "1000"))
+# Links to other pages of the same catalogue, followed when crawling from a seed URL
+PAGINATION_SELECTOR = os.getenv("SCRAPER_PAGINATION_SELECTOR", "a[rel~='next'], .pagination a")
+# Responses worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# --- PARSING SETTINGS ---
+# CSS selectors of the data on a listing page, read from this JSON file (missing keys keep the defaults):
+#   "container"        - the part of the page with the listing; only it is parsed, so headers, menus and
+#                        footers cannot add rows ("" - the whole page)
+#   "item"             - one drug inside the container
+#   "drug_name", "active_substance" - the element inside the item whose text is taken
+SELECTORS_FILE = os.getenv("SCRAPER_SELECTORS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "scraper_selectors.json"))
+DEFAULT_SELECTORS = {"container": "main", "item": "article", "drug_name": "h2", "active_substance": "p"}
+# HTML parser for data pages:
+#   "lxml"        - lxml with selectors compiled once to XPath (fast; needs lxml and cssselect)
+#   "html.parser" - BeautifulSoup, building only the container's subtree
+#   "auto"        - lxml if installed, otherwise html.parser
+PARSER_ENGINE = os.getenv("SCRAPER_PARSER", "auto")
+
+# Browser identity; the HTTP client sends the same one, so the site sees one client
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 
 # --- MAIN SCRIPT CODE ---
 
@@ -35,7 +92,7 @@ def setup_driver():
     """Configures and starts the Selenium web driver."""
     options = webdriver.ChromeOptions()
     options.add_argument("--start-maximized")
-    options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
+    options.add_argument(f"user-agent={USER_AGENT}")
     if DRIVER_PATH:
         service = Service(executable_path=DRIVER_PATH)
         driver = webdriver.Chrome(service=service, options=options)
@@ -90,53 +147,494 @@ def scrape_page_data(driver, url):
         
         time.sleep(2) # Дополнительная пауза для прогрузки всех элементов
         html_content = driver.page_source
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Находим все контейнеры с препаратами (тег <article>)
-        items = soup.select('article')
-        
-        if not items:
+        scraped_results = extract_items(html_content)
+        if scraped_results is None:
             print("No articles found on the page. Please check the selectors if the page structure has changed.")
+        return scraped_results
+
+    except Exception as e:
+        print(f"An error occurred while scraping data: {e}")
+        return None
+
+def load_selectors(filename=SELECTORS_FILE):
+    """Reads the listing selectors from the JSON file; the defaults are used for missing keys or a missing file."""
+    selectors = dict(DEFAULT_SELECTORS)
+    if os.path.exists(filename):
+        with open(filename, 'r', encoding='utf-8') as f:
+            selectors.update(json.load(f))
+    return selectors
+
+class ItemExtractor:
+    """
+    Extracts drug names and active substances from listing pages with the given selectors
+    (see SELECTORS_FILE). Only the container is parsed and the selectors are compiled once,
+    so a page costs one pass of the parser instead of a full document tree plus a selector
+    compilation per item. Pagination links (PAGINATION_SELECTOR) come from the same pass.
+    Can be used from several crawl workers at once.
+    """
+    FIELDS = ('drug_name', 'active_substance')
+    # Простой селектор контейнера (тег, #id, .class), по которому BeautifulSoup строит только его поддерево
+    SIMPLE_SELECTOR = re.compile(r'^([a-zA-Z][\w-]*)?(?:#([\w-]+))?(?:\.([\w-]+))?$')
+
+    def __init__(self, selectors=None, engine=PARSER_ENGINE):
+        self.selectors = selectors or load_selectors()
+        missing = [key for key in ('item',) + self.FIELDS if not self.selectors.get(key)]
+        if missing:
+            raise ValueError(f"Selectors {', '.join(missing)} must not be empty (see {SELECTORS_FILE}).")
+        if engine == "auto":
+            engine = "lxml" if self._lxml_installed() else "html.parser"
+        if engine not in ("lxml", "html.parser"):
+            raise ValueError(f"Unknown HTML parser '{engine}' (expected lxml, html.parser or auto).")
+        self.engine = engine
+        self.local = threading.local() # Скомпилированные XPath lxml - свои в каждом потоке
+        self.strainer = self._container_strainer(self.selectors['container'])
+        # Проверяем селекторы сразу, а не на первой странице
+        self._compiled()
+
+    @staticmethod
+    def _lxml_installed():
+        return importlib.util.find_spec('lxml') is not None and importlib.util.find_spec('cssselect') is not None
+
+    def _container_strainer(self, container):
+        match = self.SIMPLE_SELECTOR.match(container or "")
+        if self.engine != "html.parser" or not container or not match:
             return None
+        tag_name, element_id, class_name = match.groups()
+        attrs = {}
+        if element_id:
+            attrs['id'] = element_id
+        if class_name:
+            attrs['class'] = class_name
+        return SoupStrainer(tag_name, attrs=attrs)
 
-        scraped_results = []
-        print(f"Found {len(items)} items to scrape.")
+    def _compiled(self):
+        compiled = getattr(self.local, 'selectors', None)
+        if compiled is None:
+            compiled = {}
+            for key in ('container', 'item') + self.FIELDS:
+                selector = self.selectors[key]
+                compiled[key] = self._compile_selector(selector) if selector else None
+            compiled['pagination'] = self._compile_selector(PAGINATION_SELECTOR)
+            if self.engine == "lxml":
+                from lxml import etree
+                compiled['text'] = etree.XPath("descendant-or-self::text()[not(ancestor::script or ancestor::style)]")
+            self.local.selectors = compiled
+        return compiled
 
+    def _compile_selector(self, selector):
+        if self.engine == "lxml":
+            from lxml.cssselect import CSSSelector
+            return CSSSelector(selector, translator='html')
+        import soupsieve
+        return soupsieve.compile(selector)
+
+    def extract(self, html_content):
+        """Returns the list of items of the page, or None if it has no container or no items."""
+        return self.extract_page(html_content)[0]
+
+    def extract_page(self, html_content, page_url=None):
+        """
+        Returns (the items of the page as extract does, the pagination links of the page).
+        Links are looked for only if page_url is given: they are made absolute against it,
+        and only links to the same host are kept (without #fragments).
+        """
+        compiled = self._compiled()
+        with_links = page_url is not None
+        if self.engine == "lxml":
+            document = self._parse_lxml(html_content)
+            container, items = self._find_items_lxml(document, compiled)
+            hrefs = [link.get('href') for link in compiled['pagination'](document)] if with_links else []
+        else:
+            # Ссылки пагинации могут быть вне контейнера - тогда разбираем страницу целиком
+            document = BeautifulSoup(html_content, 'html.parser', parse_only=None if with_links else self.strainer)
+            container, items = self._find_items_soup(document, compiled)
+            hrefs = [link.get('href') for link in compiled['pagination'].select(document)] if with_links else []
+        links = _same_host_links(hrefs, page_url) if with_links else []
+        return self._item_rows(container, items, compiled), links
+
+    def _item_rows(self, container, items, compiled):
+        if container is None or not items:
+            return None
+
+        scraped_results = []
         for item in items:
-            # Извлекаем данные из каждого контейнера
-            try:
-                # Название препарата находится в теге <h2>
-                drug_name = item.select_one('h2').get_text(strip=True)
-                # Действующее вещество находится в теге <p>
-                active_substance = item.select_one('p').get_text(strip=True)
-                
-                scraped_results.append({
-                    'drug_name': drug_name, 
-                    'active_substance': active_substance
-                })
-            except AttributeError:
-                # Пропускаем, если у элемента нет h2 или p
-                continue
-                
+            values = [self._field_text(item, compiled[field], compiled) for field in self.FIELDS]
+            # Пропускаем элементы без названия или вещества
+            if all(values):
+                scraped_results.append(dict(zip(self.FIELDS, values)))
         return scraped_results
 
-    except Exception as e:
-        print(f"An error occurred while scraping data: {e}")
+    @staticmethod
+    def _parse_lxml(html_content):
+        import lxml.html
+        if isinstance(html_content, str):
+            # Байты с явной кодировкой: строку с объявлением <?xml encoding?> lxml не принимает
+            html_content = html_content.encode('utf-8')
+        return lxml.html.document_fromstring(html_content, parser=lxml.html.HTMLParser(encoding='utf-8'))
+
+    def _find_items_lxml(self, document, compiled):
+        container = document
+        if compiled['container'] is not None:
+            containers = compiled['container'](document)
+            container = containers[0] if containers else None
+        if container is None:
+            return None, []
+        return container, compiled['item'](container)
+
+    def _find_items_soup(self, soup, compiled):
+        container = soup
+        if compiled['container'] is not None:
+            container = compiled['container'].select_one(soup)
+        if container is None:
+            return None, []
+        return container, compiled['item'].select(container)
+
+    def _field_text(self, item, selector, compiled):
+        if self.engine == "lxml":
+            elements = selector(item)
+            text = " ".join(compiled['text'](elements[0])) if elements else ""
+        else:
+            element = selector.select_one(item)
+            text = element.get_text(" ") if element is not None else ""
+        # Пробелы между вложенными тегами сохраняем, лишние схлопываем
+        return " ".join(text.split())
+
+_item_extractor = None
+_item_extractor_lock = threading.Lock()
+
+def _get_item_extractor():
+    global _item_extractor
+    with _item_extractor_lock:
+        if _item_extractor is None:
+            _item_extractor = ItemExtractor()
+            print(f"Parsing pages with {_item_extractor.engine}, selectors: {_item_extractor.selectors}")
+    return _item_extractor
+
+def extract_items(html_content):
+    """Extracts drug names and active substances from the HTML of a data page (None if it has no articles)."""
+    return extract_page(html_content)[0]
+
+def extract_page(html_content, page_url=None):
+    """
+    Like extract_items, but also returns the pagination links of the page when page_url is given:
+    (items or None, links). The page is parsed once for both.
+    """
+    scraped_results, links = _get_item_extractor().extract_page(html_content, page_url)
+    if scraped_results is not None:
+        print(f"Found {len(scraped_results)} items to scrape.")
+    return scraped_results, links
+
+def create_http_session(driver):
+    """
+    Creates a keep-alive HTTP session that continues the browser's logged-in session:
+    the browser's cookies and User-Agent are copied into a requests.Session with a connection pool.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    for cookie in driver.get_cookies():
+        session.cookies.set(cookie["name"], cookie["value"],
+                            domain=cookie.get("domain", ""), path=cookie.get("path", "/"),
+                            secure=cookie.get("secure", False))
+    print(f"Handed {len(session.cookies)} browser cookies to the HTTP client.")
+    return session
+
+def fetch_page_html(session, url):
+    """Downloads a page through the HTTP session. Returns the HTML, or None if the site sent us back to the login page."""
+    response = session.get(url, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    if is_login_redirect(response):
+        print("The site redirected to the login page: the session has expired or the cookies were not accepted.")
+        return None
+    return response.text
+
+def is_login_redirect(response):
+    """True if the site answered with the login page (the session is not logged in)."""
+    return response.url.split("?")[0].rstrip("/") == LOGIN_URL.rstrip("/")
+
+def scrape_page_data_http(session, url, driver=None):
+    """
+    Scrapes a data page without the browser: the page is downloaded by the HTTP session and parsed
+    by extract_items. If the page has no articles in its HTML (they are rendered by JavaScript)
+    and a driver is given, the page is scraped in the browser instead.
+    """
+    try:
+        print(f"Fetching data page: {url}")
+        html_content = fetch_page_html(session, url)
+    except requests.RequestException as e:
+        print(f"An error occurred while fetching the page: {e}")
         return None
 
-def save_to_csv(data, filename):
-    """Saves data to a CSV file."""
-    if not data:
-        print("No data to save.")
-        return
-    with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=data[0].keys())
-        writer.writeheader()
-        writer.writerows(data)
-    print(f"Data successfully saved to {filename}")
+    if html_content is None:
+        return None
+    scraped_results = extract_items(html_content)
+    if scraped_results is None and driver is not None:
+        print("No articles in the page HTML, opening it in the browser...")
+        return scrape_page_data(driver, url)
+    if scraped_results is None:
+        print("No articles found on the page. Please check the selectors if the page structure has changed.")
+    return scraped_results
+
+# --- CRAWL ---
+
+class HostRateLimiter:
+    """Spaces out requests to each host to at most `rate` per second (shared by all crawl workers)."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def fetch_with_retries(session, url, rate_limiter):
+    """
+    Downloads a page, retrying network errors, 429 and 5xx responses up to CRAWL_MAX_RETRIES times
+    with exponential backoff (or the server's Retry-After). Returns the HTML, or None if the page
+    could not be downloaded or the site redirected to the login page.
+    """
+    for attempt in range(CRAWL_MAX_RETRIES + 1):
+        rate_limiter.wait(url)
+        try:
+            response = session.get(url, timeout=HTTP_TIMEOUT)
+            if response.status_code not in RETRY_STATUS_CODES:
+                response.raise_for_status()
+                if is_login_redirect(response):
+                    print(f"Redirected to the login page instead of {url}: the session has expired.")
+                    return None
+                return response.text
+            error = f"HTTP {response.status_code}"
+            retry_after = response.headers.get("Retry-After", "")
+        except requests.HTTPError as e:
+            print(f"Failed to fetch {url}: {e}")
+            return None # 4xx - повтор не поможет
+        except requests.RequestException as e:
+            error, retry_after = str(e), ""
+        if attempt == CRAWL_MAX_RETRIES:
+            print(f"Failed to fetch {url} after {attempt + 1} attempts: {error}")
+            return None
+        delay = float(retry_after) if retry_after.isdigit() else CRAWL_BACKOFF_SECONDS * 2 ** attempt * random.uniform(1, 1.5)
+        print(f"Fetching {url} failed ({error}), retrying in {delay:.1f} s...")
+        time.sleep(delay)
+
+def _same_host_links(hrefs, page_url):
+    """Absolute URLs of the other catalogue pages linked from a page (same host only, without #fragments)."""
+    host = urlsplit(page_url).netloc
+    links = []
+    for href in hrefs:
+        if href:
+            url = urldefrag(urljoin(page_url, href))[0]
+            if urlsplit(url).netloc == host:
+                links.append(url)
+    return links
+
+def _crawl_page(session, url, rate_limiter, discover_pages):
+    """
+    Runs in a crawl worker: downloads and parses one page.
+    Returns (downloaded, items or None if the page has no articles, pagination links).
+    """
+    html_content = fetch_with_retries(session, url, rate_limiter)
+    if html_content is None:
+        return False, None, []
+    items, links = extract_page(html_content, url if discover_pages else None)
+    return True, items, links
+
+def crawl(session, start_urls, discover_pages=False, driver=None, workers=CRAWL_WORKERS, skip_urls=()):
+    """
+    Scrapes many pages concurrently through the HTTP session: `workers` pages are downloaded at a time,
+    at most CRAWL_RATE_PER_HOST requests per second go to each host, and every URL is visited once.
+    URLs in skip_urls (already scraped by an interrupted run) are neither downloaded nor followed.
+    With discover_pages, pagination links (PAGINATION_SELECTOR) found on each page are crawled too.
+    Pages without articles in their HTML are opened in the browser if a driver is given
+    (in this thread: the driver cannot be shared between threads).
+    Generator of (page URL, list of items with their 'source_url' or None if the page could not be
+    downloaded, pagination links found on the page).
+    """
+    rate_limiter = HostRateLimiter(CRAWL_RATE_PER_HOST)
+    visited = set(skip_urls)
+    pending = {}
+    submitted = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(url):
+            nonlocal submitted
+            url = urldefrag(url.strip())[0]
+            if url and url not in visited and submitted < CRAWL_MAX_PAGES:
+                visited.add(url)
+                submitted += 1
+                pending[executor.submit(_crawl_page, session, url, rate_limiter, discover_pages)] = url
+
+        for url in start_urls:
+            submit(url)
+        while pending:
+            done, _ = wait_futures(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = pending.pop(future)
+                try:
+                    downloaded, items, links = future.result()
+                except Exception as e:
+                    print(f"An error occurred while scraping {url}: {e}")
+                    downloaded, items, links = False, None, []
+                if not downloaded:
+                    yield url, None, []
+                    continue
+                for link in links:
+                    submit(link)
+                if items is None and driver is not None:
+                    print(f"No articles in the HTML of {url}, opening it in the browser...")
+                    items = scrape_page_data(driver, url)
+                items = items or []
+                for item in items:
+                    item['source_url'] = url
+                print(f"Scraped {len(items)} items from {url} ({submitted - len(pending)}/{submitted} pages done).")
+                yield url, items, links
+    if submitted >= CRAWL_MAX_PAGES:
+        print(f"Stopped at the page limit (SCRAPER_CRAWL_MAX_PAGES = {CRAWL_MAX_PAGES}).")
+
+def read_url_list(filename):
+    """Reads a list of URLs (one per line; empty lines and lines starting with # are skipped)."""
+    with open(filename, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+# --- OUTPUT ---
+
+class ResultSink:
+    """
+    Incremental output of scraped rows. Rows are appended to the CSV file (or added as new files
+    to the Parquet folder) in batches of OUTPUT_BATCH_SIZE, so a crash loses at most one batch,
+    and a row with the same (drug_name, active_substance) as one already written is skipped.
+
+    Next to the output, a checkpoint file (<output>.checkpoint) lists scraped pages ("done") and
+    discovered pages still to scrape ("queued"). It is updated only after the batch containing
+    the page's rows is written, so an interrupted crawl resumes from it without losing rows.
+    finish() removes the checkpoint when a crawl has completed.
+    """
+    FIELDNAMES = ['drug_name', 'active_substance', 'source_url']
+
+    def __init__(self, filename, batch_size=OUTPUT_BATCH_SIZE):
+        self.filename = filename
+        self.parquet = filename.lower().endswith('.parquet')
+        self.batch_size = max(1, batch_size)
+        self.checkpoint_file = filename + ".checkpoint"
+        self.rows = []
+        self.checkpoint_lines = []
+        self.rows_written = 0
+        self.seen_keys = self._read_existing_keys()
+        self.completed_urls, self.queued_urls = self._read_checkpoint()
+        if self.completed_urls:
+            print(f"Resuming: {len(self.completed_urls)} pages already scraped, "
+                  f"{len(self.queued_urls - self.completed_urls)} discovered pages still to scrape.")
+
+    def _read_existing_keys(self):
+        if self.parquet:
+            if not os.path.isdir(self.filename) or not os.listdir(self.filename):
+                return set()
+            import pyarrow.parquet as pq
+            table = pq.read_table(self.filename, columns=['drug_name', 'active_substance'])
+            return set(zip(table.column('drug_name').to_pylist(), table.column('active_substance').to_pylist()))
+        if not os.path.exists(self.filename):
+            return set()
+        with open(self.filename, 'r', newline='', encoding='utf-8') as csvfile:
+            return {(row.get('drug_name'), row.get('active_substance')) for row in csv.DictReader(csvfile)}
+
+    def _read_checkpoint(self):
+        completed, queued = set(), set()
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    state, _, url = line.rstrip('\n').partition('\t')
+                    (completed if state == 'done' else queued).add(url)
+        return completed, queued
+
+    def pending_urls(self):
+        """Pages discovered by the interrupted crawl but not scraped yet."""
+        return sorted(self.queued_urls - self.completed_urls)
+
+    def add_page(self, url, items, links=()):
+        """Adds the rows of a scraped page; the page is marked done (and its links queued) with the next batch."""
+        for item in items:
+            key = (item['drug_name'], item['active_substance'])
+            if key not in self.seen_keys:
+                self.seen_keys.add(key)
+                self.rows.append(item)
+        self.checkpoint_lines.extend(f"queued\t{link}\n" for link in links if link not in self.queued_urls)
+        self.queued_urls.update(links)
+        self.checkpoint_lines.append(f"done\t{url}\n")
+        self.completed_urls.add(url)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered rows, then records their pages in the checkpoint."""
+        if self.rows:
+            if self.parquet:
+                self._write_parquet_part(self.rows)
+            else:
+                self._append_csv(self.rows)
+            self.rows_written += len(self.rows)
+            self.rows = []
+        if self.checkpoint_lines:
+            with open(self.checkpoint_file, 'a', encoding='utf-8') as f:
+                f.writelines(self.checkpoint_lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self.checkpoint_lines = []
+
+    def _append_csv(self, rows):
+        is_new = not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0
+        fieldnames = self.FIELDNAMES
+        if not is_new:
+            # Дописываем в колонки существующего файла (в старых файлах нет source_url)
+            with open(self.filename, 'r', newline='', encoding='utf-8') as csvfile:
+                fieldnames = next(csv.reader(csvfile), None) or self.FIELDNAMES
+        with open(self.filename, 'a', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
+            if is_new:
+                writer.writeheader()
+            writer.writerows(rows)
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+
+    def _write_parquet_part(self, rows):
+        # Каждая партия - отдельный файл папки: недописанный файл не портит уже записанные
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        os.makedirs(self.filename, exist_ok=True)
+        table = pa.Table.from_pylist([{name: row.get(name) for name in self.FIELDNAMES} for row in rows],
+                                     schema=pa.schema([(name, pa.string()) for name in self.FIELDNAMES]))
+        part_name = f"part-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+        temp_path = os.path.join(self.filename, f".{part_name}.tmp")
+        pq.write_table(table, temp_path, compression='zstd')
+        os.replace(temp_path, os.path.join(self.filename, part_name))
+
+    def finish(self, completed=True):
+        """Writes the last batch; if the crawl completed, the checkpoint is no longer needed."""
+        self.flush()
+        if completed and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+        print(f"{self.rows_written} new rows saved to {self.filename}.")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrapes drug names and active substances after logging in.")
+    parser.add_argument('--urls', metavar='FILE', help="crawl all URLs listed in this file (one per line)")
+    parser.add_argument('--seed', metavar='URL', help="crawl this page and every catalogue page reachable through its pagination")
+    parser.add_argument('--workers', type=int, default=CRAWL_WORKERS, help="number of pages downloaded at the same time")
+    parser.add_argument('--rate', type=float, help="maximum requests per second to one host")
+    parser.add_argument('--output', metavar='FILE', default=OUTPUT_FILE,
+                        help="CSV file, or .parquet folder, the rows are appended to (an interrupted crawl resumes from it)")
+    args = parser.parse_args()
+    if args.rate:
+        CRAWL_RATE_PER_HOST = args.rate
+
     if not WEBSITE_LOGIN or not WEBSITE_PASSWORD:
         print("Error: Login or password not found in the .env file. Please check it.")
     else:
@@ -144,11 +642,36 @@ if __name__ == "__main__":
         try:
             driver = setup_driver()
             if login_to_website(driver):
-                target_url = input("Login complete. Now, please paste the URL of the page to scrape and press Enter: ")
-                
-                results = scrape_page_data(driver, target_url)
-                if results:
-                    save_to_csv(results, OUTPUT_FILE)
+                sink = ResultSink(args.output)
+                if args.urls or args.seed:
+                    # Crawl mode: pages go through the HTTP client, the browser only for JavaScript pages.
+                    # Pages scraped by an interrupted run are skipped, pages it discovered are resumed
+                    start_urls = (read_url_list(args.urls) if args.urls else [args.seed]) + sink.pending_urls()
+                    session = create_http_session(driver)
+                    completed = False
+                    try:
+                        for url, items, links in crawl(session, start_urls, discover_pages=bool(args.seed), driver=driver,
+                                                       workers=args.workers, skip_urls=sink.completed_urls):
+                            if items is not None: # Недоступные страницы не отмечаем - их скачает следующий запуск
+                                sink.add_page(url, items, links)
+                        completed = True
+                    finally:
+                        sink.finish(completed)
+                else:
+                    target_url = input("Login complete. Now, please paste the URL of the page to scrape and press Enter: ")
+
+                    if FETCH_MODE == "http":
+                        session = create_http_session(driver)
+                        results = scrape_page_data_http(session, target_url, driver)
+                    else:
+                        results = scrape_page_data(driver, target_url)
+                    if results:
+                        for item in results:
+                            item['source_url'] = target_url
+                        sink.add_page(target_url, results)
+                    else:
+                        print("No data to save.")
+                    sink.finish()
         finally:
             if driver:
                 print("Closing browser...")
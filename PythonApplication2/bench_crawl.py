@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Checks and benchmark of the HTTP scraping path (PythonApplication2.py) against a local catalogue server.
+
+The server imitates the site: data pages need the login cookie (otherwise a 302 to the login page),
+listing pages have articles and a pagination block (links with #fragments, a rel="next" link and
+a link to another host), some pages can answer 503/429 (with Retry-After) a given number of times,
+and some pages render their articles with JavaScript. Every request is logged, so the checks can
+count what the scraper actually sent.
+
+Checks (each prints PASS or FAIL, the exit code is 1 if any failed):
+    cookies      - create_http_session takes the browser's cookies (a fake driver), the pages are
+                   scraped over HTTP, and without the cookies is_login_redirect catches the login page
+    pagination   - crawl from the first page finds every page once, ignoring #fragments and other hosts
+    retry        - 503 answers are retried, a 429 with Retry-After waits that long, and a page failing
+                   more than SCRAPER_CRAWL_MAX_RETRIES times is given up
+    rate-limit   - with several workers, requests are spaced to SCRAPER_CRAWL_RATE_PER_HOST per second
+    dedupe       - a URL list with repeated URLs, #fragments and skip_urls downloads each page once
+The benchmark then crawls the catalogue with 1 and --workers workers and prints pages per second.
+
+Examples:
+    python bench_crawl.py
+    python bench_crawl.py --pages 200 --delay 0.1 --workers 8 --json-out crawl.jsonl
+    python bench_crawl.py --checks-only
+"""
+import argparse
+import collections
+import contextlib
+import datetime
+import http.server
+import io
+import json
+import re
+import socketserver
+import sys
+import threading
+import time
+
+import requests
+
+import PythonApplication2 as scraper
+
+SESSION_COOKIE = ("sessionid", "bench-session")
+
+
+class CatalogServer:
+    """Local catalogue site on 127.0.0.1 with a random port (see the module docstring)."""
+
+    def __init__(self, pages=40, per_page=20, delay=0.0, flaky=None, js_pages=()):
+        self.pages, self.per_page, self.delay = pages, per_page, delay
+        self.flaky = {page: list(statuses) for page, statuses in (flaky or {}).items()}
+        self.js_pages = set(js_pages)
+        self.lock = threading.Lock()
+        self.requests = [] # (время, путь) каждого запроса
+        self.connections = set()
+        catalog = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                catalog._handle(self)
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def page_url(self, page):
+        return f"{self.base_url}/katalog?page={page}"
+
+    def page_html(self, page):
+        articles = "".join(f'<article><h2>Lek {page}-{i}</h2><p>Substancja {(page * self.per_page + i) % 97}</p></article>'
+                           for i in range(self.per_page))
+        numbers = "".join(f'<a href="/katalog?page={n}#top">{n}</a>'
+                          for n in range(max(1, page - 3), min(self.pages, page + 3) + 1))
+        next_link = f'<a rel="next" href="/katalog?page={page + 1}">Dalej</a>' if page < self.pages else ''
+        return (f'<html><body><header><h2>Wstęp</h2><p>Wstęp</p></header><main>{articles}'
+                f'<nav class="pagination">{numbers}{next_link}<a href="http://other.example/katalog?page=2">x</a></nav>'
+                f'</main></body></html>')
+
+    def _handle(self, request):
+        with self.lock:
+            self.requests.append((time.monotonic(), request.path))
+            self.connections.add(request.client_address)
+        if request.path.startswith('/logowanie'):
+            return self._send(request, 200, '<html><body><form>Logowanie</form></body></html>')
+        if f"{SESSION_COOKIE[0]}={SESSION_COOKIE[1]}" not in (request.headers.get('Cookie') or ''):
+            return self._send(request, 302, '', {'Location': '/logowanie'})
+        time.sleep(self.delay)
+        match = re.search(r'page=(\d+)', request.path)
+        page = int(match.group(1)) if match else 1
+        with self.lock:
+            statuses = self.flaky.get(page)
+            status = statuses.pop(0) if statuses else None
+        if status:
+            return self._send(request, status, 'error', {'Retry-After': '1'} if status == 429 else {})
+        if page > self.pages:
+            return self._send(request, 404, 'not found')
+        if page in self.js_pages:
+            return self._send(request, 200, '<html><body><main id="app"></main><script>render()</script></body></html>')
+        self._send(request, 200, self.page_html(page))
+
+    @staticmethod
+    def _send(request, status, body, headers=None):
+        data = body.encode('utf-8')
+        request.send_response(status)
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.send_header('Content-Type', 'text/html; charset=utf-8')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def request_counts(self):
+        """How many times each path was requested."""
+        return collections.Counter(path for _, path in self.requests)
+
+    def max_requests_per_second(self):
+        times = [t for t, _ in self.requests]
+        return max((sum(1 for other in times if t <= other < t + 1) for t in times), default=0)
+
+
+class FakeDriver:
+    """Stands in for the logged-in Selenium driver: only get_cookies is used by create_http_session."""
+
+    def __init__(self, cookies):
+        self.cookies = cookies
+
+    def get_cookies(self):
+        return self.cookies
+
+
+@contextlib.contextmanager
+def serve_catalog(**options):
+    """Starts a CatalogServer and points the scraper's LOGIN_URL at its login page for the duration."""
+    catalog = CatalogServer(**options)
+    saved_login_url, scraper.LOGIN_URL = scraper.LOGIN_URL, catalog.base_url + "/logowanie"
+    try:
+        yield catalog
+    finally:
+        scraper.LOGIN_URL = saved_login_url
+        catalog.close()
+
+
+def logged_in_session():
+    driver = FakeDriver([{'name': SESSION_COOKIE[0], 'value': SESSION_COOKIE[1],
+                          'domain': '127.0.0.1', 'path': '/', 'secure': False}])
+    return scraper.create_http_session(driver)
+
+
+def run_crawl(start_urls, discover_pages, workers, skip_urls=()):
+    """Crawls quietly with a logged-in session; returns ({page URL: items or None}, seconds)."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        session = logged_in_session()
+        started = time.perf_counter()
+        pages = {url: items for url, items, _ in scraper.crawl(session, start_urls, discover_pages=discover_pages,
+                                                                 workers=workers, skip_urls=skip_urls)}
+        return pages, time.perf_counter() - started
+
+
+# --- Проверки: каждая возвращает список (описание, пройдена ли) ---
+def check_cookies():
+    with serve_catalog(pages=3, per_page=5, js_pages={3}) as catalog, contextlib.redirect_stdout(io.StringIO()):
+        session = logged_in_session()
+        items = scraper.scrape_page_data_http(session, catalog.page_url(1))
+        js_items = scraper.scrape_page_data_http(session, catalog.page_url(3))
+        anonymous = requests.Session()
+        anonymous_items = scraper.scrape_page_data_http(anonymous, catalog.page_url(1))
+        login_redirect = scraper.is_login_redirect(anonymous.get(catalog.page_url(2)))
+        logged_in_redirect = scraper.is_login_redirect(session.get(catalog.page_url(2)))
+    return [
+        ("browser cookie handed to the session", session.cookies.get(SESSION_COOKIE[0]) == SESSION_COOKIE[1]),
+        ("page scraped over HTTP", items is not None and len(items) == 5 and items[0]['drug_name'] == "Lek 1-0"),
+        ("JavaScript page without a driver gives no items", js_items is None),
+        ("no cookie: login page detected, no items", anonymous_items is None and login_redirect),
+        ("logged in: not a login redirect", not logged_in_redirect),
+    ]
+
+
+def check_pagination():
+    with serve_catalog(pages=30, per_page=10) as catalog:
+        pages, _ = run_crawl([catalog.page_url(1)], True, 4)
+    counts = catalog.request_counts()
+    return [
+        ("every page found", sorted(pages) == sorted(catalog.page_url(n) for n in range(1, 31))),
+        ("every page requested once", len(counts) == 30 and set(counts.values()) == {1}),
+        ("all rows scraped with their page", sum(len(items or []) for items in pages.values()) == 300 and all(
+            item['source_url'] == url for url, items in pages.items() for item in items or [])),
+    ]
+
+
+def check_retry():
+    give_up = [503] * (scraper.CRAWL_MAX_RETRIES + 1)
+    with serve_catalog(pages=12, per_page=5, flaky={4: [503, 503], 7: [429], 9: give_up}) as catalog:
+        pages, _ = run_crawl([catalog.page_url(n) for n in range(1, 13)], False, 4)
+    counts = catalog.request_counts()
+    page7_times = [t for t, path in catalog.requests if path.endswith('page=7')]
+    return [
+        ("503 twice, then scraped", counts['/katalog?page=4'] == 3 and len(pages[catalog.page_url(4)] or []) == 5),
+        ("429 waits Retry-After", len(page7_times) == 2 and page7_times[1] - page7_times[0] >= 0.95
+         and pages[catalog.page_url(7)] is not None),
+        ("given up after the retries", counts['/katalog?page=9'] == len(give_up) and pages[catalog.page_url(9)] is None),
+    ]
+
+
+def check_rate_limit():
+    rate = 5
+    saved_rate, scraper.CRAWL_RATE_PER_HOST = scraper.CRAWL_RATE_PER_HOST, rate
+    try:
+        with serve_catalog(pages=15, per_page=5) as catalog:
+            pages, seconds = run_crawl([catalog.page_url(n) for n in range(1, 16)], False, 8)
+    finally:
+        scraper.CRAWL_RATE_PER_HOST = saved_rate
+    # Запросы идут с интервалом 1/rate, поэтому в окно длиной 1 с может попасть rate + 1 из них
+    busiest = catalog.max_requests_per_second()
+    times = sorted(t for t, _ in catalog.requests)
+    average = (len(times) - 1) / (times[-1] - times[0])
+    return [
+        (f"{rate} requests per second with 8 workers (average {average:.2f}, busiest second {busiest})",
+         average <= rate * 1.05 and busiest <= rate + 1),
+        (f"all pages scraped ({seconds:.1f} s)", len(pages) == 15),
+    ]
+
+
+def check_dedupe():
+    with serve_catalog(pages=10, per_page=5) as catalog:
+        start_urls = ([catalog.page_url(n) for n in range(1, 11)] + [catalog.page_url(n) + "#top" for n in range(1, 11)]
+                      + [f" {catalog.page_url(5)} ", catalog.page_url(2)])
+        pages, _ = run_crawl(start_urls, True, 4, skip_urls=[catalog.page_url(10)])
+    counts = catalog.request_counts()
+    return [
+        ("each page requested once", set(counts.values()) == {1}),
+        ("skipped page neither downloaded nor followed", '/katalog?page=10' not in counts and len(pages) == 9),
+    ]
+
+
+CHECKS = [("cookies", check_cookies), ("pagination", check_pagination), ("retry", check_retry),
+          ("rate-limit", check_rate_limit), ("dedupe", check_dedupe)]
+
+
+def run_checks():
+    """Runs all checks (no rate limit unless the check sets one, short backoff); True if all of them passed."""
+    saved = scraper.CRAWL_RATE_PER_HOST, scraper.CRAWL_BACKOFF_SECONDS
+    scraper.CRAWL_RATE_PER_HOST, scraper.CRAWL_BACKOFF_SECONDS = 0, 0.05
+    all_passed = True
+    try:
+        for name, check in CHECKS:
+            for description, passed in check():
+                all_passed = all_passed and passed
+                print(f"{'PASS' if passed else 'FAIL'}  {name:<11} {description}")
+    finally:
+        scraper.CRAWL_RATE_PER_HOST, scraper.CRAWL_BACKOFF_SECONDS = saved
+    return all_passed
+
+
+def run_benchmark(pages, per_page, delay, workers):
+    """Crawls the catalogue from its first page with 1 and `workers` workers; returns a list of results."""
+    saved_rate, scraper.CRAWL_RATE_PER_HOST = scraper.CRAWL_RATE_PER_HOST, 0
+    results = []
+    try:
+        for worker_count in sorted({1, workers}):
+            with serve_catalog(pages=pages, per_page=per_page, delay=delay) as catalog:
+                crawled, seconds = run_crawl([catalog.page_url(1)], True, worker_count)
+            rows = sum(len(items or []) for items in crawled.values())
+            print(f"{worker_count:>3} workers  {len(crawled) / seconds:>8.1f} pages/s  {len(crawled)} pages, "
+                  f"{rows} rows, {len(catalog.connections)} connections")
+            results.append({"workers": worker_count, "pages": len(crawled), "rows": rows, "delay": delay,
+                            "pages_per_second": round(len(crawled) / seconds, 1)})
+    finally:
+        scraper.CRAWL_RATE_PER_HOST = saved_rate
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks and benchmark of the HTTP crawl against a local catalogue server.")
+    parser.add_argument('--pages', type=int, default=100, help="pages in the benchmark catalogue")
+    parser.add_argument('--items', type=int, default=50, help="items on each benchmark page")
+    parser.add_argument('--delay', type=float, default=0.05, help="server response time, seconds")
+    parser.add_argument('--workers', type=int, default=scraper.CRAWL_WORKERS, help="crawl workers to compare with 1 worker")
+    parser.add_argument('--checks-only', action='store_true', help="run the checks without the benchmark")
+    parser.add_argument('--json-out', help="append the benchmark results as JSON lines to this file (to compare runs)")
+    args = parser.parse_args()
+
+    passed = run_checks()
+    if not args.checks_only:
+        print()
+        results = run_benchmark(args.pages, args.items, args.delay, args.workers)
+        if args.json_out:
+            run_time = datetime.datetime.now().isoformat(timespec='seconds')
+            with open(args.json_out, 'a', encoding='utf-8') as f:
+                for result in results:
+                    f.write(json.dumps(dict(result, time=run_time), ensure_ascii=False) + "\n")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
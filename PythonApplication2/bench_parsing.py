@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of listing page parsing (extract_items in PythonApplication2.py) on saved HTML pages.
+
+Each parser extracts the items of every page several times; pages per second, rows found and
+the first row are printed, so both speed and extraction results can be compared:
+    old          - the previous parser: BeautifulSoup tree of the whole page, select('article'),
+                   then select_one('h2') / select_one('p') in each item
+    html.parser  - ItemExtractor with BeautifulSoup, parsing only the container
+    lxml         - ItemExtractor with lxml and compiled selectors (needs lxml and cssselect)
+Without --html-dir, synthetic listing pages (header, menu, scripts, product cards, footer) are used;
+--save-fixtures writes them out, so the same pages can be reused or replaced with pages saved from the site.
+
+Examples:
+    python bench_parsing.py
+    python bench_parsing.py --html-dir saved_pages --repeat 5
+    python bench_parsing.py --pages 50 --items 200 --save-fixtures saved_pages --json-out parsing.jsonl
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import time
+
+from bs4 import BeautifulSoup
+
+import PythonApplication2 as scraper
+
+
+def old_extract_items(html_content):
+    """The parser used before ItemExtractor, kept for comparison."""
+    soup = BeautifulSoup(html_content, 'html.parser')
+    scraped_results = []
+    for item in soup.select('article'):
+        try:
+            scraped_results.append({'drug_name': item.select_one('h2').get_text(strip=True),
+                                    'active_substance': item.select_one('p').get_text(strip=True)})
+        except AttributeError:
+            continue
+    return scraped_results or None
+
+
+def generate_page(page_number, items):
+    """A listing page shaped like the site: an intro article in the header, a long menu, inline scripts and styles."""
+    menu = "".join(f'<li><a href="/kategoria/{i}" class="menu-item">Kategoria {i}</a></li>' for i in range(300))
+    cards = "".join(
+        f'<article class="product"><a href="/lek/{page_number}-{i}"><img src="/img/{i}.jpg" alt=""></a>'
+        f'<h2 class="name"><span>Lek {page_number}-{i}</span> 10 mg</h2><p class="substance">Substancja {i % 97}</p>'
+        f'<div class="meta"><span>Rx</span><span>Refundowany</span><button>Dodaj</button></div></article>'
+        for i in range(items))
+    return (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>Leki</title>'
+            f'<script>{"var a = 1;" * 2000}</script><style>{".a {color: red}" * 500}</style></head>'
+            f'<body><header><article><h2>Wstęp</h2><p>Wstęp</p></article><nav><ul>{menu}</ul></nav></header>'
+            f'<main><h1>Leki</h1>{cards}<nav class="pagination"><a href="?page={page_number + 1}" rel="next">Dalej</a></nav></main>'
+            f'<footer>{"<p>Stopka</p>" * 200}</footer></body></html>')
+
+
+def load_pages(html_dir):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(html_dir, "*.htm*"))):
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            pages.append(f.read())
+    return pages
+
+
+def time_parser(extract, pages, repeat):
+    """Returns (best pages per second over `repeat` passes, results of the last pass)."""
+    best = 0.0
+    results = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        results = [extract(page) for page in pages]
+        best = max(best, len(pages) / (time.perf_counter() - started))
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the old and new listing page parsers.")
+    parser.add_argument('--html-dir', help="folder with saved listing pages (*.html); synthetic pages if not given")
+    parser.add_argument('--pages', type=int, default=30, help="number of synthetic pages")
+    parser.add_argument('--items', type=int, default=100, help="items on each synthetic page")
+    parser.add_argument('--repeat', type=int, default=3, help="passes over the pages for each parser (the best one is reported)")
+    parser.add_argument('--save-fixtures', metavar='DIR', help="write the synthetic pages to this folder")
+    parser.add_argument('--json-out', help="append the results as JSON lines to this file (to compare runs)")
+    args = parser.parse_args()
+
+    if args.html_dir:
+        pages = load_pages(args.html_dir)
+        if not pages:
+            parser.error(f"no *.html files in {args.html_dir}")
+    else:
+        pages = [generate_page(n, args.items) for n in range(1, args.pages + 1)]
+        if args.save_fixtures:
+            os.makedirs(args.save_fixtures, exist_ok=True)
+            for n, page in enumerate(pages, start=1):
+                with open(os.path.join(args.save_fixtures, f"page_{n:03d}.html"), 'w', encoding='utf-8') as f:
+                    f.write(page)
+    total_mb = sum(len(page.encode('utf-8')) for page in pages) / 1e6
+    print(f"{len(pages)} pages, {total_mb:.1f} MB of HTML")
+
+    parsers = [("old", old_extract_items), ("html.parser", scraper.ItemExtractor(engine="html.parser").extract)]
+    if scraper.ItemExtractor._lxml_installed():
+        parsers.append(("lxml", scraper.ItemExtractor(engine="lxml").extract))
+    else:
+        print("WARNING: lxml or cssselect is not installed, the lxml parser is skipped.")
+
+    results = []
+    baseline = None
+    for name, extract in parsers:
+        pages_per_second, page_results = time_parser(extract, pages, args.repeat)
+        rows = [row for page_rows in page_results if page_rows for row in page_rows]
+        baseline = baseline or pages_per_second
+        first_row = f"{rows[0]['drug_name']} | {rows[0]['active_substance']}" if rows else "-"
+        print(f"{name:<12} {pages_per_second:>8.1f} pages/s  x{pages_per_second / baseline:<5.1f} "
+              f"{len(rows):>7} rows   first row: {first_row}")
+        results.append({"parser": name, "pages": len(pages), "html_mb": round(total_mb, 2),
+                        "pages_per_second": round(pages_per_second, 1), "rows": len(rows)})
+
+    if args.json_out:
+        run_time = datetime.datetime.now().isoformat(timespec='seconds')
+        with open(args.json_out, 'a', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(dict(result, time=run_time), ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()